@@ -0,0 +1,182 @@
+import warnings
+from collections import namedtuple
+from typing import Dict, Iterable, List, Sequence, Tuple, Union
+
+import numpy as np
+
+from meet_page_parser import Sex
+from record_page_parser import Record
+from record_store import MISSING, Columns
+
+# One row per record. `laps` holds the cumulative split times in centiseconds
+# as the result pages show them, masked where a record has no value.
+LapMatrix = namedtuple('LapMatrix',
+                       ('time_cs', 'laps', 'lap_count', 'age_cls', 'sex'))
+
+GroupBy = Union[str, Sequence[str]]
+
+
+def _masked(values: np.ndarray) -> np.ma.MaskedArray:
+    return np.ma.masked_equal(values, MISSING)
+
+
+def from_records(records: Iterable[Record],
+                 sex: Union[Sex, Sequence[Sex]] = None) -> LapMatrix:
+    # Laps are gathered with one join over the records' int arrays and
+    # scattered into the matrix in a single step.
+    records = list(records)
+    n = len(records)
+    counts = np.fromiter((len(r.lap_cs or ()) for r in records),
+                         dtype=np.int64,
+                         count=n)
+    flat = np.frombuffer(b''.join(r.lap_cs.tobytes() for r in records
+                                  if r.lap_cs),
+                         dtype=np.int32)
+    laps = np.full((n, int(counts.max()) if n else 0), MISSING, np.int32)
+    rows = np.repeat(np.arange(n), counts)
+    cols = np.arange(len(flat)) - np.repeat(np.cumsum(counts) - counts,
+                                            counts)
+    laps[rows, cols] = flat
+    time_cs = np.fromiter(
+        (r.record_cs if r.record_cs is not None else MISSING
+         for r in records),
+        dtype=np.int32,
+        count=n)
+    if sex is None or isinstance(sex, Sex):
+        sexes = np.full(n, sex.name if sex else '', dtype=object)
+    else:
+        sexes = np.array([s.name if s else '' for s in sex], dtype=object)
+    age_cls = np.array([r.age_cls or '' for r in records], dtype=object)
+    return LapMatrix(_masked(time_cs), _masked(laps),
+                     counts.astype(np.int32), age_cls, sexes)
+
+
+def from_results(results: Iterable) -> LapMatrix:
+    # Rows returned by ResultsStore.query, which know the race's sex.
+    results = list(results)
+    return from_records([r.record for r in results],
+                        [r.sex for r in results])
+
+
+def from_columns(columns: Columns, age_cls: List[str]) -> LapMatrix:
+    # Columns of a RecordStore; `age_cls` is its age_cls dictionary. The
+    # memory-mapped arrays are used as they are, without copying.
+    n = len(columns.time_cs)
+    return LapMatrix(_masked(columns.time_cs), _masked(columns.laps),
+                     columns.lap_count.astype(np.int32),
+                     np.array(age_cls, dtype=object)[columns.age_cls],
+                     np.full(n, '', dtype=object))
+
+
+def _complete(m: LapMatrix) -> np.ndarray:
+    # Rows whose last split is the final time, i.e. no laps are missing.
+    last = m.laps.filled(MISSING)[np.arange(len(m.lap_count)),
+                                  np.maximum(m.lap_count - 1, 0)]
+    return (m.lap_count > 0) & (last != MISSING) & (
+        last == m.time_cs.filled(MISSING))
+
+
+def _full_lap_count(m: LapMatrix) -> int:
+    # The lap count of a complete record: the most common count among rows
+    # whose last split is the final time.
+    if not len(m.lap_count) or not m.laps.shape[1]:
+        return 0
+    complete = _complete(m)
+    if not complete.any():
+        return int(m.lap_count.max())
+    return int(np.bincount(m.lap_count[complete]).argmax())
+
+
+def lap_splits(m: LapMatrix) -> np.ma.MaskedArray:
+    # Time of each lap: differences between consecutive cumulative splits.
+    laps = m.laps.astype(np.int64)
+    prev = np.ma.concatenate(
+        [np.ma.zeros((len(laps), 1), dtype=np.int64), laps[:, :-1]], axis=1)
+    return laps - prev
+
+
+def leg_splits(m: LapMatrix, legs: int,
+               full_lap_count: int = None) -> np.ma.MaskedArray:
+    # Time of each of `legs` equal legs of the race (4 for the strokes of
+    # an IM). A record split every 25m and one split every 50m both give
+    # the same legs; legs a record has no split for are masked.
+    n = len(m.lap_count)
+    if not m.laps.shape[1]:
+        return np.ma.masked_all((n, legs), dtype=np.int64)
+    full = full_lap_count or _full_lap_count(m)
+    step = np.where(_complete(m) & (m.lap_count % legs == 0),
+                    m.lap_count // legs, full // legs)
+    idx = step[:, None] * np.arange(1, legs + 1) - 1
+    valid = (step[:, None] > 0) & (idx < m.lap_count[:, None])
+    idx = np.clip(idx, 0, m.laps.shape[1] - 1)
+    cum = np.take_along_axis(m.laps.filled(MISSING), idx, axis=1)
+    mask = ~valid | (cum == MISSING)
+    cum = np.ma.array(cum.astype(np.int64), mask=mask)
+    prev = np.ma.concatenate(
+        [np.ma.zeros((n, 1), dtype=np.int64), cum[:, :-1]], axis=1)
+    return cum - prev
+
+
+def split_deltas(m: LapMatrix, legs: int,
+                 full_lap_count: int = None) -> np.ma.MaskedArray:
+    # How much slower (positive) or faster each leg was than an even pace.
+    return leg_splits(m, legs, full_lap_count) - (
+        m.time_cs.astype(np.float64)[:, None] / legs)
+
+
+def fade_ratio(m: LapMatrix,
+               full_lap_count: int = None) -> np.ma.MaskedArray:
+    # Second half over first half; above 1 means the swimmer slowed down.
+    halves = leg_splits(m, 2, full_lap_count).astype(np.float64)
+    return halves[:, 1] / halves[:, 0]
+
+
+def groups(m: LapMatrix, by: GroupBy = ('age_cls', 'sex')
+           ) -> Tuple[List[Tuple[str, ...]], np.ndarray]:
+    # Distinct group keys and, for each row, the index of its key.
+    by = (by, ) if isinstance(by, str) else tuple(by)
+    if not by:
+        return [()], np.zeros(len(m.lap_count), dtype=np.int64)
+    labels = np.array(['\x1f'.join(t) for t in zip(*(getattr(m, b)
+                                                    for b in by))],
+                      dtype=object)
+    uniq, inverse = np.unique(labels.astype(str), return_inverse=True)
+    return [tuple(u.split('\x1f')) for u in uniq], inverse
+
+
+def percentiles(values: np.ma.MaskedArray,
+                m: LapMatrix,
+                q: Sequence[float] = (10, 25, 50, 75, 90),
+                by: GroupBy = ('age_cls', 'sex')
+                ) -> Dict[Tuple[str, ...], np.ndarray]:
+    # Per group, an array of len(q) percentiles (times the number of legs
+    # for 2-D values). Masked values are left out.
+    keys, inverse = groups(m, by)
+    filled = np.ma.asarray(values).astype(np.float64).filled(np.nan)
+    ret = {}
+    for i, key in enumerate(keys):
+        v = filled[inverse == i]
+        with warnings.catch_warnings():
+            # A leg nobody in the group has a split for gives NaN.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            ret[key] = np.nanpercentile(v, q, axis=0) if len(v) else np.full(
+                (len(q), ) + v.shape[1:], np.nan)
+    return ret
+
+
+def histograms(values: np.ma.MaskedArray,
+               m: LapMatrix,
+               bins: Union[int, Sequence[float]] = 20,
+               by: GroupBy = ('age_cls', 'sex')
+               ) -> Dict[Tuple[str, ...], Tuple[np.ndarray, np.ndarray]]:
+    # Per group (counts, edges) of 1-D values. Every group shares the same
+    # edges so the histograms can be compared bin by bin.
+    values = np.ma.asarray(values)
+    valid = ~np.ma.getmaskarray(values)
+    edges = np.histogram_bin_edges(values.compressed(), bins)
+    keys, inverse = groups(m, by)
+    data = values.filled(0)
+    return {
+        key: (np.histogram(data[valid & (inverse == i)], edges)[0], edges)
+        for i, key in enumerate(keys)
+    }
@@ -0,0 +1,169 @@
+import asyncio
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Dict, List, Tuple
+
+from fetcher import Fetcher
+from meet_page_parser import MeetPageParser, Race
+from month_page_parser import Meet, MonthPageParser
+from rate_limiter import HostRateLimiter
+from record_page_parser import Record, RecordPageParser
+
+logger = getLogger(__name__)
+
+
+class AsyncCrawler:
+    def __init__(self,
+                 concurrency: int = 4,
+                 rate: float = 1.0,
+                 burst: int = 1,
+                 fetcher: Fetcher = None,
+                 backend: str = 'bs4'):
+        self.concurrency = concurrency
+        self.backend = backend
+        self.limiter = HostRateLimiter(rate=rate, burst=burst)
+        self.fetcher = fetcher or Fetcher()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.__semaphore = None
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def __fetch(self, url: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(self.executor, self.fetcher.cached,
+                                          url)
+        if body is not None:
+            return body
+        # The semaphore is created lazily so that it binds to the loop that
+        # actually runs the crawl.
+        if not self.__semaphore:
+            self.__semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.__semaphore:
+            await self.limiter.acquire_async(url)
+            logger.info(url)
+            return await loop.run_in_executor(self.executor,
+                                              self.fetcher.fetch, url)
+
+    async def __parse(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args,
+                                          self.backend)
+
+    async def fetch_years(self, url: str) -> List[str]:
+        body = await self.__fetch(url)
+        return await self.__parse(_parse_years, body)
+
+    async def fetch_meets(self, baseurl: str, year: str,
+                          month: str) -> List[Meet]:
+        url = '{}?{}'.format(baseurl,
+                             urllib.parse.urlencode({
+                                 'Y': year,
+                                 'M': month
+                             }))
+        body = await self.__fetch(url)
+        return await self.__parse(_parse_meets, body, int(year), int(month))
+
+    async def fetch_races(self, baseurl: str,
+                          q_params: Dict[str, str]) -> List[Race]:
+        params = dict(q_params)
+        url = '{}?{}'.format(baseurl + params.pop('action'),
+                             urllib.parse.urlencode(params))
+        body = await self.__fetch(url)
+        return await self.__parse(_parse_races, body)
+
+    async def fetch_records(self, baseurl: str,
+                            q_params: Dict[str, str]) -> List[Record]:
+        params = dict(q_params)
+        url = baseurl + params.pop('action')
+        body = await self.__fetch('{}?{}'.format(
+            url, urllib.parse.urlencode(params)))
+        params, classes, known = await self.__parse(_parse_classes, body,
+                                                    params)
+
+        async def fetch_class(cls: str) -> List[Record]:
+            if cls in known:
+                return known[cls]
+            cls_params = dict(params, Cls=cls)
+            cls_body = await self.__fetch('{}?{}'.format(
+                url, urllib.parse.urlencode(cls_params)))
+            return await self.__parse(_parse_records, cls_body, cls_params,
+                                      classes[cls])
+
+        rs = []
+        for records in await asyncio.gather(
+                *[fetch_class(cls) for cls in classes.keys()]):
+            rs.extend(records or [])
+        return rs
+
+    async def crawl_all(self, base_url: str) -> List[Record]:
+        years = await self.fetch_years(base_url)
+        meets = await asyncio.gather(*[
+            self.fetch_meets(base_url, y, m) for y in years
+            for m in range(1, 13)
+        ])
+        races = await asyncio.gather(*[
+            self.fetch_races(base_url, meet.q_params) for ms in meets
+            for meet in ms or []
+        ])
+        records = await asyncio.gather(*[
+            self.fetch_records(base_url, r.q_params) for rs in races
+            for r in rs
+        ])
+        return [r for rs in records for r in rs]
+
+
+def _parse_years(body: bytes, backend: str) -> List[str]:
+    p = MonthPageParser.from_source(body, backend=backend)
+    return p.get_available_years()
+
+
+def _parse_meets(body: bytes, year: int, month: int,
+                 backend: str) -> List[Meet]:
+    p = MonthPageParser.from_source(
+        body, year=year, month=month, backend=backend)
+    return p.get_meets()
+
+
+def _parse_races(body: bytes, backend: str) -> List[Race]:
+    return MeetPageParser.from_source(body, backend=backend).get_races()
+
+
+def _parse_classes(
+        body: bytes, q_params: Dict[str, str], backend: str
+) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, List[Record]]]:
+    # The race page's params and classes, and the records it already shows
+    p = RecordPageParser.from_source(body, backend=backend)
+    params = p.get_query_params() or q_params
+    classes = p.get_available_classes()
+    if not classes:
+        classes = {'999': 'DUMMY'}  # Put the wildcard class
+    return params, classes, p.get_known_records(params, classes)
+
+
+def _parse_records(body: bytes, q_params: Dict[str, str], age_cls: str,
+                   backend: str) -> List[Record]:
+    p = RecordPageParser.from_source(body, q_params, age_cls, backend=backend)
+    return p.get_records()
+
+
+def crawl_records(base_url: str,
+                  record_page_params: Dict[str, str],
+                  concurrency: int = 4,
+                  rate: float = 1.0,
+                  burst: int = 1,
+                  fetcher: Fetcher = None,
+                  backend: str = 'bs4') -> List[Record]:
+    async def run():
+        async with AsyncCrawler(concurrency, rate, burst, fetcher,
+                                backend) as c:
+            return await c.fetch_records(base_url, record_page_params)
+
+    return asyncio.run(run())
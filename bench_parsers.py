@@ -0,0 +1,166 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from typing import Dict, List
+
+from meet_page_parser import MeetPageParser
+from month_page_parser import MonthPageParser
+from parser_base import BACKENDS, sniff_encoding
+from record_page_parser import RecordPageParser
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'testdata')
+
+BASELINE = os.path.join(TESTDATA, 'bench_baseline.json')
+
+# `scale` replicates the rows of the fixture's result table to make a large
+# page out of a small one.
+Case = namedtuple('Case', ('name', 'fixture', 'scale'))
+
+CASES = [
+    Case('month', 'month.html', 1),
+    Case('meet', 'meet.html', 1),
+    Case('record_lap', 'record_lap.html', 1),
+    Case('record_lap_large', 'record_lap.html', 100),
+    Case('record_nolap', 'record_nolap.html', 1),
+    Case('record_nolap_large', 'record_nolap.html', 200),
+    Case('record_relay', 'record_relay.html', 1),
+    Case('record_relay_large', 'record_relay.html', 200),
+]
+
+Result = namedtuple('Result',
+                    ('pages_per_sec', 'rows_per_sec', 'rows', 'peak_kb'))
+
+
+def read(name: str) -> bytes:
+    with open(os.path.join(TESTDATA, name), 'rb') as f:
+        return f.read()
+
+
+def replicate_rows(body: bytes, scale: int) -> bytes:
+    # Repeats everything between the header row of the page's last table
+    # and its closing tag.
+    if scale <= 1:
+        return body
+    encoding = sniff_encoding(body)
+    text = body.decode(encoding)
+    end = text.rindex('</table>')
+    start = text.rindex('</th></tr>', 0, end) + len('</th></tr>')
+    return (text[:start] + text[start:end] * scale + text[end:]).encode(
+        encoding)
+
+
+def case_body(case: Case) -> bytes:
+    return replicate_rows(read(case.fixture), case.scale)
+
+
+def parse(case: Case, body: bytes, backend: str) -> list:
+    if case.fixture == 'month.html':
+        return MonthPageParser.from_source(
+            body, year=2023, month=2, backend=backend).get_meets()
+    if case.fixture == 'meet.html':
+        return MeetPageParser.from_source(body, backend=backend).get_races()
+    p = RecordPageParser.from_source(body, backend=backend)
+    classes = p.get_available_classes()
+    cls = list(classes)[-1]
+    params = dict(p.get_query_params(), Cls=cls)
+    return RecordPageParser.from_source(
+        body, params, classes[cls], backend=backend).get_records()
+
+
+def run(case: Case, backend: str, min_time: float = 0.5) -> Result:
+    body = case_body(case)
+    rows = len(parse(case, body, backend))
+
+    pages = 0
+    gc.collect()
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time or pages < 3:
+        parse(case, body, backend)
+        pages += 1
+        elapsed = time.perf_counter() - start
+
+    # Measured on a run of its own: tracing allocations slows parsing down.
+    tracemalloc.start()
+    parse(case, body, backend)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return Result(pages / elapsed, pages * rows / elapsed, rows,
+                  peak / 1024)
+
+
+def run_all(cases: List[Case] = None,
+            backends=BACKENDS,
+            min_time: float = 0.5) -> Dict[str, Dict]:
+    return {
+        '{}/{}'.format(c.name, b): run(c, b, min_time)._asdict()
+        for c in cases or CASES for b in backends
+    }
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict],
+            tolerance: float = 0.3) -> List[str]:
+    # Anything slower, or peaking higher in memory, than the baseline by
+    # more than `tolerance` is a regression. A changed row count means the
+    # parser's output changed.
+    regressions = []
+    for k, r in sorted(results.items()):
+        b = baseline.get(k)
+        if not b:
+            continue
+        if r['rows'] != b['rows']:
+            regressions.append('{}: {} rows, baseline has {}'.format(
+                k, r['rows'], b['rows']))
+        if r['pages_per_sec'] < b['pages_per_sec'] * (1 - tolerance):
+            regressions.append('{}: {:.1f} pages/sec, baseline {:.1f}'.format(
+                k, r['pages_per_sec'], b['pages_per_sec']))
+        if r['peak_kb'] > b['peak_kb'] * (1 + tolerance):
+            regressions.append('{}: peak {:.0f} KiB, baseline {:.0f}'.format(
+                k, r['peak_kb'], b['peak_kb']))
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description='Benchmark the page parsers.')
+    ap.add_argument('--baseline', default=BASELINE)
+    ap.add_argument('--update', action='store_true',
+                    help='write the results as the new baseline')
+    ap.add_argument('--tolerance', type=float, default=0.3)
+    ap.add_argument('--min-time', type=float, default=0.5,
+                    help='seconds to spend on each case and backend')
+    ap.add_argument('--backend', choices=BACKENDS, action='append')
+    ap.add_argument('cases', nargs='*', help='case names, default all')
+    args = ap.parse_args(argv)
+
+    cases = [c for c in CASES if not args.cases or c.name in args.cases]
+    results = run_all(cases, args.backend or BACKENDS, args.min_time)
+    print('{:28} {:>10} {:>12} {:>6} {:>9}'.format('case', 'pages/s',
+                                                   'rows/s', 'rows',
+                                                   'peak KiB'))
+    for k, r in results.items():
+        print('{:28} {:10.1f} {:12.0f} {:6d} {:9.0f}'.format(
+            k, r['pages_per_sec'], r['rows_per_sec'], r['rows'],
+            r['peak_kb']))
+
+    if args.update:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+            f.write('\n')
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for r in regressions:
+        print('REGRESSION', r)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,313 @@
+import argparse
+import os
+import posixpath
+import sys
+import urllib.parse
+from collections import OrderedDict, namedtuple
+from typing import (Dict, Iterable, Iterator, List, Optional, TextIO, Tuple,
+                    Union)
+
+# Only the standard library is imported up front: the crawler, the parsers
+# (bs4, lxml) and the stores load once there is something to crawl, so that
+# `--help`, `--dry-run` and runs with nothing to do start fast.
+
+PROMPT = 'tdsystemのRecord.phpのlinkを入力してください: '
+
+# What the site assumes for a Record.php link that leaves these out
+RECORD_DEFAULTS = {'S': '2', 'Lap': '1', 'Cls': '999', 'L': '1', 'P': '1'}
+
+Target = namedtuple('Target', ('kind', 'base_url', 'q_params'))
+
+MeetKey = Tuple[str, str, str, str]  # (base_url, Y, M, G)
+
+
+class MeetBatch:
+    # What to crawl of one meet: the whole of it when its ProList.php link
+    # was given, otherwise the races linked to, by P.
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.q_params: Optional[Dict[str, str]] = None
+        self.races: Dict[str, Dict[str, str]] = OrderedDict()
+
+
+def parse_target(url: str) -> Target:
+    # Repeated keys keep their last value, as PHP reads them:
+    # ProList.php?Y=2023&M=2&G=0&GL=0&G=48 is meet 48.
+    u = urllib.parse.urlsplit(url.strip())
+    if not u.scheme or not u.netloc:
+        raise ValueError('Not a URL: {}'.format(url))
+    directory, action = posixpath.split(u.path)
+    base_url = '{}://{}{}/'.format(u.scheme, u.netloc,
+                                   directory.rstrip('/'))
+    params = dict(urllib.parse.parse_qsl(u.query))
+    missing = [k for k in ('Y', 'M', 'G') if not params.get(k)]
+    if missing:
+        raise ValueError('{} is missing {}'.format(url, ', '.join(missing)))
+    if action == 'Record.php':
+        return Target('race', base_url,
+                      dict(RECORD_DEFAULTS, **params, action=action))
+    if action == 'ProList.php':
+        return Target('meet', base_url, dict(params, action=action))
+    raise ValueError('Neither Record.php nor ProList.php: {}'.format(url))
+
+
+def plan(targets: Iterable[Target]) -> Dict[MeetKey, MeetBatch]:
+    # Groups the targets by meet, in the order they first came. A race is
+    # crawled once however many links (of whichever class) point at it, and
+    # not at all on its own when its whole meet is crawled.
+    batches: Dict[MeetKey, MeetBatch] = OrderedDict()
+    for t in targets:
+        q = t.q_params
+        key = (t.base_url, q['Y'], q['M'], q['G'])
+        batch = batches.get(key)
+        if batch is None:
+            batch = batches[key] = MeetBatch(t.base_url)
+        if t.kind == 'meet':
+            batch.q_params = q
+            batch.races.clear()
+        elif batch.q_params is None:
+            batch.races.setdefault(q['P'], q)
+    return batches
+
+
+def read_urls(args: argparse.Namespace,
+              stdin: TextIO = sys.stdin) -> Iterator[str]:
+    # Files are opened one at a time, and closed once read.
+    sources: List[Union[str, Iterable[str]]] = [args.urls]
+    for path in args.file or []:
+        sources.append(stdin if path == '-' else path)
+    if not args.urls and not args.file:
+        if stdin.isatty():
+            sources.append([input(PROMPT)])
+        else:
+            sources.append(stdin)
+    for source in sources:
+        if isinstance(source, str):
+            with open(source, encoding='utf-8') as f:
+                yield from lines(f)
+        else:
+            yield from lines(source)
+
+
+def lines(it: Iterable[str]) -> Iterator[str]:
+    for line in it:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def run(batches: Dict[MeetKey, MeetBatch], args: argparse.Namespace) -> int:
+    # One batch over every meet: the fetcher (with its connection pool and
+    # cache) and the rate limiter are shared by all of it. Returns the number
+    # of pages that failed.
+    from contextlib import ExitStack
+
+    from crawler import Crawler
+    from fetcher import Fetcher
+    from http_cache import ResponseCache
+    from page_archive import PageArchive
+    from rate_limiter import HostRateLimiter
+    from swimmer_index import SwimmerIndex
+
+    with ExitStack() as stack:
+        cache = archive = None
+        if args.cache:
+            cache = ResponseCache(args.cache)
+            stack.callback(cache.close)
+        if args.archive:
+            archive = PageArchive(args.archive)
+            stack.callback(archive.close)
+        Crawler.fetcher = Fetcher(cache, archive=archive)
+        stack.callback(Crawler.fetcher.close)
+        Crawler.limiter = HostRateLimiter(rate=args.rate, burst=args.burst)
+        Crawler.backend = args.backend
+        Crawler.streaming = args.stream
+        sink = open_output(args)
+        if sink is not None:
+            stack.enter_context(sink)
+        store = open_store(args)
+        if store is not None:
+            stack.callback(store.close)
+        failed = crawl(batches, args, sink, store)
+        if store is not None:
+            SwimmerIndex(store).update()
+    return failed
+
+
+def crawl(batches: Dict[MeetKey, MeetBatch], args: argparse.Namespace, sink,
+          store) -> int:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from crawler import Crawler
+
+    failed = 0
+
+    def fetch_races(base_url: str, q_params: Dict[str, str]):
+        # The header row of a meet page parses into a race without P.
+        races = Crawler.fetch_races(base_url, q_params)
+        return [(dict(r.q_params), r) for r in races if r.q_params.get('P')]
+
+    with ThreadPoolExecutor(args.workers) as executor:
+        # A meet's name, dates, course and venue are only on its month's
+        # page, which the store wants as well: one fetch per month.
+        months = {}
+        if store is not None:
+            for key in batches:
+                if key[:3] not in months:
+                    months[key[:3]] = executor.submit(Crawler.fetch_meets,
+                                                      *key[:3])
+        # Likewise the sex, distance and style of a race are only on its
+        # meet's page, fetched once per meet for the store even when only
+        # some of its races were linked to.
+        race_lists = {
+            key: executor.submit(fetch_races, batch.base_url, batch.q_params
+                                 or meet_params(key))
+            for key, batch in batches.items()
+            if batch.q_params is not None or store is not None
+        }
+        races = {}
+        jobs = []
+        for key, batch in batches.items():
+            if batch.q_params is not None:
+                try:
+                    listed = race_lists[key].result()
+                except Exception as e:
+                    print('{}: {!r}'.format(
+                        describe(key), e), file=sys.stderr)
+                    failed += 1
+                    continue
+                races[key] = {q['P']: race for q, race in listed}
+                targets = [q for q, _ in listed]
+            else:
+                targets = list(batch.races.values())
+            jobs += [(key, q,
+                      executor.submit(Crawler.fetch_records, batch.base_url,
+                                      q)) for q in targets]
+        for key, future in race_lists.items():
+            if key in races:
+                continue
+            try:
+                races[key] = {q['P']: race for q, race in future.result()}
+            except Exception as e:
+                # As for the month: the records are stored without it.
+                print('{}: {!r}'.format(describe(key), e), file=sys.stderr)
+                failed += 1
+        meets = {}
+        for month, future in months.items():
+            try:
+                for m in future.result():
+                    meets[month + (m.q_params.get('G'), )] = m
+            except Exception as e:
+                # The records are stored all the same, without the meet's
+                # details.
+                print('{}?Y={}&M={}: {!r}'.format(*month, e), file=sys.stderr)
+                failed += 1
+        for key, q, future in jobs:
+            try:
+                records = future.result()
+            except Exception as e:
+                print('{} P={}: {!r}'.format(describe(key), q['P'], e),
+                      file=sys.stderr)
+                failed += 1
+                continue
+            print('{} P={}: {} records'.format(describe(key), q['P'],
+                                               len(records)),
+                  file=sys.stderr)
+            for r in records:
+                if args.verbose:
+                    print(r)
+                if sink is not None:
+                    sink.write(r)
+            if store is not None:
+                store.add(meets.get(key),
+                          races.get(key, {}).get(q['P']), records)
+    return failed
+
+
+def meet_params(key: MeetKey) -> Dict[str, str]:
+    # A meet's page as the month page's form asks for it
+    _, y, m, g = key
+    return {'Y': y, 'M': m, 'G': g, 'GL': '0', 'action': 'ProList.php'}
+
+
+def describe(key: MeetKey) -> str:
+    return '{}ProList.php?Y={}&M={}&G={}'.format(*key)
+
+
+def open_output(args: argparse.Namespace):
+    if not args.output:
+        return None
+    from sinks import open_sink
+
+    # Each run writes its records afresh.
+    if os.path.exists(args.output):
+        os.remove(args.output)
+    return open_sink(args.output)
+
+
+def open_store(args: argparse.Namespace):
+    if not args.store:
+        return None
+    from results_store import ResultsStore
+
+    return ResultsStore(args.store)
+
+
+def parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(
+        description='Crawl the results behind Record.php and ProList.php '
+        'links. Links are taken from the arguments, from --file, or from '
+        'stdin when neither is given.')
+    ap.add_argument('urls', nargs='*', metavar='URL')
+    ap.add_argument('-f', '--file', action='append',
+                    help="file of links, one per line ('-' for stdin)")
+    ap.add_argument('-o', '--output', default='records.pickle',
+                    help='.pickle, .jsonl, .csv or .sqlite3 to write '
+                    "records to ('' for none)")
+    ap.add_argument('--store', help='results store to upsert records into')
+    ap.add_argument('--cache', default='http_cache.sqlite3',
+                    help="response cache ('' for none)")
+    ap.add_argument('--archive',
+                    help='archive every page fetched here (import the cache '
+                    'into it first: page_archive.py ARCHIVE import CACHE)')
+    ap.add_argument('--rate', type=float, default=0.2,
+                    help='requests/sec for the whole batch')
+    ap.add_argument('--burst', type=int, default=1)
+    ap.add_argument('--workers', type=int, default=4,
+                    help='pages fetched at once')
+    ap.add_argument('--backend', choices=('bs4', 'lxml'), default='bs4')
+    ap.add_argument('--stream', action='store_true',
+                    help='parse pages while they download')
+    ap.add_argument('--dry-run', action='store_true',
+                    help='print what would be crawled and exit')
+    ap.add_argument('-v', '--verbose', action='store_true',
+                    help='print every record')
+    return ap
+
+
+def main(argv: List[str] = None) -> int:
+    args = parser().parse_args(argv)
+    targets = []
+    errors = 0
+    for url in read_urls(args):
+        try:
+            targets.append(parse_target(url))
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            errors += 1
+    batches = plan(targets)
+    if args.dry_run:
+        for key, batch in batches.items():
+            print('{}\t{}'.format(
+                describe(key),
+                'all races' if batch.q_params is not None else ' '.join(
+                    'P={}'.format(p) for p in batch.races)))
+        return 1 if errors else 0
+    if batches:
+        errors += run(batches, args)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
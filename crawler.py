@@ -1,12 +1,16 @@
-import pickle
+import io
 import time
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from logging import INFO, Formatter, StreamHandler, getLogger
-from typing import Dict, List
-from bs4 import BeautifulSoup
-import re
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+from fetcher import Fetcher, full_url
+from frontier import Child, Frontier, FrontierItem
+from http_cache import normalize_url
 from meet_page_parser import MeetPageParser, Race
 from month_page_parser import Meet, MonthPageParser
+from rate_limiter import HostRateLimiter
 from record_page_parser import Record, RecordPageParser
 
 logger = getLogger(__name__)
@@ -18,27 +22,40 @@ logger.addHandler(handler)
 
 
 class Crawler:
-    prev = None
     INTERVAL_SEC = 5
+    FANOUT_WORKERS = 4
+    limiter = HostRateLimiter(rate=1 / INTERVAL_SEC, burst=1)
+    fetcher = Fetcher()
+    backend = 'bs4'
+    # Parse meet pages and the pages of single classes while they download,
+    # on lxml whatever the backend
+    streaming = False
 
     @staticmethod
     def __fetch(url):
-        if Crawler.prev:
-            past = time.time() - Crawler.prev
-            wait = 0 if past > Crawler.INTERVAL_SEC else Crawler.INTERVAL_SEC
-            time.sleep(wait)
-        Crawler.prev = time.time()
-        if type(url) is str:
+        url = full_url(url)
+        body = Crawler.fetcher.cached(url)
+        if body is None:
+            Crawler.limiter.acquire(url)
             logger.info(url)
-        else:
-            logger.info(url.get_full_url())
-        #print("url is ......",url)
-        return urllib.request.urlopen(url)
+            body = Crawler.fetcher.fetch(url)
+        return io.BytesIO(body)
+
+    @staticmethod
+    def __stream(url) -> Iterator[bytes]:
+        url = full_url(url)
+        body = Crawler.fetcher.cached(url)
+        if body is not None:
+            yield body
+            return
+        Crawler.limiter.acquire(url)
+        logger.info(url)
+        yield from Crawler.fetcher.stream(url)
 
     @staticmethod
     def fetch_years(url: str) -> List[str]:
         with Crawler.__fetch(url) as res:
-            p = MonthPageParser(BeautifulSoup(res, 'lxml'))
+            p = MonthPageParser.from_source(res, backend=Crawler.backend)
             years = p.get_available_years()
             return years
 
@@ -50,164 +67,185 @@ class Crawler:
                 'M': month
             })))
         with Crawler.__fetch(req) as res:
-            p = MonthPageParser(
-                page=BeautifulSoup(res, 'lxml'),
+            p = MonthPageParser.from_source(
+                res,
                 year=int(year),
-                month=int(month))
+                month=int(month),
+                backend=Crawler.backend)
             return p.get_meets()
 
     @staticmethod
     def fetch_races(baseurl: str, q_params: Dict[str, str]) -> List[Race]:
+        q_params = dict(q_params)
         req = urllib.request.Request('{}?{}'.format(
             baseurl + q_params.pop('action'),
             urllib.parse.urlencode(q_params)))
+        if Crawler.streaming:
+            return list(MeetPageParser.iter_stream(Crawler.__stream(req)))
         with Crawler.__fetch(req) as res:
-            p = MeetPageParser(BeautifulSoup(res, 'lxml'))
+            p = MeetPageParser.from_source(res, backend=Crawler.backend)
             return p.get_races()
 
     @staticmethod
     def fetch_records(baseurl: str, q_params: Dict[str, str]) -> List[Record]:
+        return list(Crawler.iter_records(baseurl, q_params))
+
+    @staticmethod
+    def iter_records(baseurl: str,
+                     q_params: Dict[str, str]) -> Iterator[Record]:
+        q_params = dict(q_params)
         url = baseurl + q_params.pop('action')
-        # print("url is/////",url)
-        # print("q_params",q_params)
-        # print("urllib.parse.urlencode(q_params)",urllib.parse.urlencode(q_params))
         req = urllib.request.Request('{}?{}'.format(
             url, urllib.parse.urlencode(q_params)))
         with Crawler.__fetch(req) as res:
-            p = RecordPageParser(BeautifulSoup(res, 'lxml'))
-            params = p.get_query_params()
-            classes = p.get_available_classes()
+            p = RecordPageParser.from_source(res, backend=Crawler.backend)
+        params = p.get_query_params()
+        classes = p.get_available_classes()
         if not params:
             params = q_params
         if not classes:
             classes = {'999': 'DUMMY'}  # Put the wildcard class
 
-        rs = []
-        for cls in classes.keys():
-            params['Cls'] = cls
+        # Only the classes the race page does not show already are fetched,
+        # a few at a time.
+        known = p.get_known_records(params, classes)
+
+        def fetch_class(cls):
+            cls_params = dict(params, Cls=cls)
             req = urllib.request.Request('{}?{}'.format(
-                url, urllib.parse.urlencode(params)))
-            with urllib.request.urlopen(req) as res:
-                p = RecordPageParser(
-                    BeautifulSoup(res, 'lxml'), params, classes[cls])
-                rs.extend(p.get_records())
-        return rs
+                url, urllib.parse.urlencode(cls_params)))
+            if Crawler.streaming:
+                return list(
+                    RecordPageParser.iter_stream(Crawler.__stream(req),
+                                                 cls_params, classes[cls]))
+            with Crawler.__fetch(req) as res:
+                return RecordPageParser.from_source(
+                    res, cls_params, classes[cls],
+                    backend=Crawler.backend).get_records() or []
+
+        with ThreadPoolExecutor(Crawler.FANOUT_WORKERS) as executor:
+            pending = {
+                cls: executor.submit(fetch_class, cls)
+                for cls in classes if cls not in known
+            }
+            for cls in classes:
+                yield from known[cls] if cls in known else pending[
+                    cls].result()
+
+
+def page_url(base_url: str, q_params: Dict[str, str]) -> str:
+    params = dict(q_params)
+    return normalize_url('{}?{}'.format(base_url + params.pop('action'),
+                                        urllib.parse.urlencode(params)))
+
+
+RecordsCallback = Callable[[Meet, Race, List[Record]], None]
+
+
+def crawl_step(base_url: str, item: FrontierItem,
+               on_records: RecordsCallback = None) -> List[Child]:
+    if item.kind == 'site':
+        return [('month', '{}:{}-{:02d}'.format(base_url, int(y), m), (y, m))
+                for y in Crawler.fetch_years(base_url) or []
+                for m in range(1, 13)]
+    if item.kind == 'month':
+        y, m = item.payload
+        return [('meet', page_url(base_url, meet.q_params), meet)
+                for meet in Crawler.fetch_meets(base_url, y, m) or []]
+    if item.kind == 'meet':
+        meet = item.payload
+        return [('race', page_url(base_url, r.q_params), (meet, r))
+                for r in Crawler.fetch_races(base_url, dict(meet.q_params))]
+    if item.kind == 'race':
+        meet, race = item.payload
+        rs = Crawler.fetch_records(base_url, dict(race.q_params))
+        if on_records:
+            on_records(meet, race, rs)
+        return []
+    raise ValueError('Unknown frontier item: {}'.format(item.kind))
+
+
+def crawl_all(base_url: str,
+              frontier: Union[str, Frontier] = 'frontier.sqlite3',
+              on_records: RecordsCallback = None) -> Dict[str, int]:
+    #https://www.tdsystem.co.jp/のとき、全ての年をパース
+    owned = not isinstance(frontier, Frontier)
+    if owned:
+        frontier = Frontier(frontier)
+    try:
+        frontier.add('site', base_url)
+        while True:
+            item = frontier.claim()
+            if not item:
+                wait = frontier.next_retry_in()
+                if wait is None:
+                    break
+                time.sleep(wait)
+                continue
+            try:
+                children = crawl_step(base_url, item, on_records)
+            except Exception as e:
+                logger.warning('%s failed (attempt %d): %r', item.key,
+                               item.attempts + 1, e)
+                frontier.fail(item, repr(e))
+                continue
+            frontier.complete(item, children)
+        return frontier.counts()
+    finally:
+        if owned:
+            frontier.close()
+
+
+def iter_crawl_all(base_url: str,
+                   frontier: Union[str, Frontier] = 'frontier.sqlite3'
+                   ) -> Iterator[Tuple[Meet, Race, Record]]:
+    # Yields records as soon as each row is parsed. A race is only marked
+    # done once all its records were consumed, so a race interrupted halfway
+    # is crawled (and yielded) again on the next run.
+    owned = not isinstance(frontier, Frontier)
+    if owned:
+        frontier = Frontier(frontier)
+    try:
+        frontier.add('site', base_url)
+        while True:
+            item = frontier.claim()
+            if not item:
+                wait = frontier.next_retry_in()
+                if wait is None:
+                    break
+                time.sleep(wait)
+                continue
+            try:
+                if item.kind == 'race':
+                    meet, race = item.payload
+                    for r in Crawler.iter_records(base_url, race.q_params):
+                        yield meet, race, r
+                    children = []
+                else:
+                    children = crawl_step(base_url, item)
+            except Exception as e:
+                logger.warning('%s failed (attempt %d): %r', item.key,
+                               item.attempts + 1, e)
+                frontier.fail(item, repr(e))
+                continue
+            frontier.complete(item, children)
+    finally:
+        if owned:
+            frontier.close()
 
 
-def crawl_all(base_url: str): #https://www.tdsystem.co.jp/のとき、全ての年をパース
-    years = Crawler.fetch_years(baseurl)
-    for y in years:
-        for m in range(1, 12):
-            meets = Crawler.fetch_meets(baseurl, y, m)
-            for meet in meets:
-                for r in Crawler.fetch_races(baseurl, meet.q_params):
-                    Crawler.fetch_records(baseurl, r.q_params)
-                    # TODO Store somewhere
+def crawl_records(base_url: str, record_page_params: Dict[str, str]) -> List[Record]:
+    return Crawler.fetch_records(base_url, record_page_params)
 
 
-def crawl_records(base_url: str, record_page_params: Dict[str, str]) -> List[Record]:
-    return Crawler.fetch_records(baseurl, record_page_params)
+def iter_crawl_records(base_url: str,
+                       record_page_params: Dict[str, str]) -> Iterator[Record]:
+    return Crawler.iter_records(base_url, record_page_params)
 
 
 if __name__ == '__main__':
-    string=input("tdsystemのRecord.phpのlinkを入力してください: ")
-    baseurl = 'https://www.tdsystem.co.jp/'
-    y_pattern = r"Y=(\d+)"
-    m_pattern = r"M=(\d+)"
-    g_pattern = r"&G=(\d+)"
-    gl_pattern = r"GL=(\d+)"
-    s_pattern = r"S=(\d+)"
-    lap_pattern = r"Lap=(\d+)"
-    cls_pattern = r"Cls=(\d+)"
-    l_pattern = r"&L=(\d+)"
-    p_pattern = r"P=(\d+)"
-    #p_pattern = r"Page=(\w+\.php)"
-
-    y_match = re.search(y_pattern, string)
-    m_match = re.search(m_pattern, string)
-    #g_match = re.search(g_pattern, string) #e.g.)  https://www.tdsystem.co.jp/ProList.php?Y=2023&M=2&G=0&GL=0&G=48 など、G=が2つあるので。
-    g_matches = re.findall(g_pattern, string)
-    gl_match = re.search(gl_pattern, string)
-    s_match = re.search(s_pattern, string)
-    lap_match = re.search(lap_pattern, string)
-    cls_match = re.search(cls_pattern, string)
-    l_match = re.search(l_pattern, string)
-    p_matches = re.findall(p_pattern, string)
-    #p_match = re.search(p_pattern, string)
-
-    if y_match:
-        y_value = y_match.group(1)
-        print("Y value:", y_value)
-
-    if m_match:
-        m_value = m_match.group(1)
-        print("M value:", m_value)
-
-    # if g_match:
-    #     g_value = g_match.group(1)
-    #     print("G value:", g_value)
-    if g_matches:
-        g_value = g_matches[-1]
-        print("G value:", g_value)
-
-    if gl_match:
-        gl_value = gl_match.group(1)
-        print("GL value:", gl_value)
-
-    if s_match:
-        s_value = s_match.group(1)
-        print("S value:", s_value)
-    else:
-        s_value="2"
-
-    if lap_match:
-        lap_value = lap_match.group(1)
-        print("Lap value:", lap_value)
-    else:
-        lap_value="1"
-
-    if cls_match:
-        cls_value = cls_match.group(1)
-        print("Cls value:", cls_value)
-    else:
-        cls_value="999"
-
-    if l_match:
-        l_value = l_match.group(1)
-        print("L value:", l_value)
-    else:
-        l_value="1"
-
-    if p_matches:
-        p_value = p_matches[-1]
-        print("P value:", p_value)
-    else:
-        p_value="1"
-
-    # if p_match:
-    #     p_value = p_match.group(1)
-    #     #print("P value:", p_value)
-    # else:
-    #     p_value="ProList.php"
-
-    rs = crawl_records(
-        baseurl, {
-            'action': 'Record.php',
-            'Y': y_value,
-            'M': m_value,
-            'GL': gl_value,
-            'G': g_value,
-            'S': s_value,
-            'Lap': lap_value,
-            'Cls': cls_value,
-            'L': l_value,
-            'P': p_value
-        })
-    #print(rs)
-    with open('records.pickle', 'wb') as f:
-        pickle.dump(rs, f, pickle.HIGHEST_PROTOCOL)
-
-    with open('records.pickle', 'rb') as f:
-        rs = pickle.load(f)
-        for r in rs:
-            print(r)
+    import sys
+
+    import cli
+
+    sys.exit(cli.main())
@@ -0,0 +1,104 @@
+import time
+import urllib.error
+import urllib.request
+from typing import Iterator, Optional, Union
+
+import metrics
+from http_cache import CachePolicy, ResponseCache
+from http_client import HttpClient
+from page_archive import PageArchive
+
+
+def full_url(url: Union[str, urllib.request.Request]) -> str:
+    if isinstance(url, urllib.request.Request):
+        return url.get_full_url()
+    return url
+
+
+class Fetcher:
+    def __init__(self,
+                 cache: ResponseCache = None,
+                 policy: CachePolicy = None,
+                 timeout: float = 60,
+                 client: HttpClient = None,
+                 archive: PageArchive = None):
+        self.cache = cache
+        self.policy = policy or CachePolicy()
+        self.timeout = timeout
+        self.client = client or HttpClient(timeout=timeout)
+        self.archive = archive
+
+    def close(self):
+        self.client.close()
+
+    def cached(self,
+               url: Union[str, urllib.request.Request]) -> Optional[bytes]:
+        # Returns the body when the cache may answer without any network
+        # round trip, None when the page has to be (re)validated.
+        if self.cache is None:
+            return None
+        entry = self.cache.get(full_url(url))
+        if entry and self.policy.is_fresh(entry):
+            metrics.CACHE_LOOKUPS.inc(result='hit')
+            self.__archive(entry)
+            return entry.body
+        metrics.CACHE_LOOKUPS.inc(result='miss')
+        return None
+
+    def __archive(self, entry):
+        # Pages the cache answers for are archived too, as fetched: the
+        # archive only appends them when it does not have them already.
+        if self.archive is not None:
+            self.archive.put(entry.url, entry.body, entry.status,
+                             entry.fetched_at)
+
+    def fetch(self, url: Union[str, urllib.request.Request]) -> bytes:
+        return b''.join(self.stream(url))
+
+    def stream(self,
+               url: Union[str, urllib.request.Request]) -> Iterator[bytes]:
+        # Like fetch(), but yields the body in chunks as they arrive. The
+        # cache and the archive get the page once it has been read to the
+        # end.
+        url = full_url(url)
+        entry = self.cache.get(url) if self.cache is not None else None
+        headers = {}
+        if entry and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        start = time.perf_counter()
+        try:
+            res = self.client.open(url, headers)
+        except urllib.error.HTTPError as e:
+            metrics.FETCH_SECONDS.observe(time.perf_counter() - start,
+                                          status=e.code)
+            if e.code == 304 and entry:
+                metrics.CACHE_LOOKUPS.inc(result='revalidated')
+                self.cache.touch(url)
+                self.__archive(entry)
+                yield entry.body
+                return
+            metrics.FETCH_ERRORS.inc(status=e.code)
+            raise
+        except Exception as e:
+            metrics.FETCH_ERRORS.inc(status=type(e).__name__)
+            raise
+        chunks = []
+        with res:
+            try:
+                for chunk in res:
+                    chunks.append(chunk)
+                    yield chunk
+            except Exception as e:
+                metrics.FETCH_ERRORS.inc(status=type(e).__name__)
+                raise
+        body = b''.join(chunks)
+        metrics.FETCH_SECONDS.observe(time.perf_counter() - start,
+                                      status=res.status)
+        metrics.FETCH_BYTES.observe(len(body))
+        if self.cache is not None:
+            self.cache.put(url, body, res.status, res.headers.get('ETag'),
+                           res.headers.get('Last-Modified'))
+        if self.archive is not None:
+            self.archive.put(url, body, res.status)
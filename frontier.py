@@ -0,0 +1,203 @@
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+import metrics
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+# Deeper items are claimed first so that finished races show up early and
+# the frontier does not balloon with meets nobody has looked at yet.
+KIND_PRIORITY = {'site': 0, 'month': 1, 'meet': 2, 'race': 3}
+
+FrontierItem = namedtuple('FrontierItem',
+                          ('key', 'kind', 'payload', 'attempts'))
+
+Child = Tuple[str, str, Any]  # (kind, key, payload)
+
+
+class Frontier:
+    def __init__(self,
+                 path: str,
+                 max_attempts: int = 5,
+                 backoff_sec: float = 30,
+                 max_backoff_sec: float = 3600,
+                 clock: Callable[[], float] = time.time,
+                 lease_sec: float = None,
+                 owner: str = None):
+        # With lease_sec the frontier is shared by several workers: a claim
+        # is only good for lease_sec unless heartbeat() renews it, and an
+        # item whose lease ran out is handed to the next worker that asks.
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_sec = backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.clock = clock
+        self.lease_sec = lease_sec
+        self.owner = owner
+        if lease_sec and not owner:
+            self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        if lease_sec:
+            self.conn.execute('PRAGMA journal_mode = WAL')
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS items (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                payload BLOB,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_at REAL NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL)''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS items_state '
+                              'ON items (state, priority, next_at)')
+            columns = {
+                row[1]
+                for row in self.conn.execute('PRAGMA table_info (items)')
+            }
+            for column in ('owner TEXT', 'lease_until REAL'):
+                if column.split()[0] not in columns:
+                    self.conn.execute(
+                        'ALTER TABLE items ADD COLUMN ' + column)
+            # Anything left in flight was interrupted by a crash. A shared
+            # frontier cannot tell a crash from another worker's claim and
+            # waits for the lease to run out instead.
+            if not lease_sec:
+                self.conn.execute(
+                    'UPDATE items SET state = ? WHERE state = ?',
+                    (PENDING, IN_FLIGHT))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __insert(self, kind: str, key: str, payload: Any):
+        self.conn.execute(
+            'INSERT OR IGNORE INTO items '
+            '(key, kind, priority, payload, state, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (key, kind, KIND_PRIORITY.get(kind, 0),
+             pickle.dumps(payload, pickle.HIGHEST_PROTOCOL), PENDING,
+             self.clock()))
+
+    def add(self, kind: str, key: str, payload: Any = None):
+        with self.lock, self.conn:
+            self.__insert(kind, key, payload)
+
+    def claim(self) -> Optional[FrontierItem]:
+        now = self.clock()
+        with self.lock, self.conn:
+            # Takes the write lock up front, so that two processes never
+            # pick the same row.
+            self.conn.execute('BEGIN IMMEDIATE')
+            # An expired lease counts as a failed attempt: a page that keeps
+            # killing its workers is eventually given up like any other.
+            self.conn.execute(
+                'UPDATE items SET state = ?, attempts = attempts + 1, '
+                'next_at = ?, error = ?, owner = NULL, lease_until = NULL, '
+                'updated_at = ? WHERE state = ? AND lease_until < ?',
+                (FAILED, now, 'lease expired', now, IN_FLIGHT, now))
+            row = self.conn.execute(
+                'SELECT key, kind, payload, attempts FROM items '
+                'WHERE (state = ? OR (state = ? AND attempts < ?)) '
+                'AND next_at <= ? ORDER BY priority DESC, next_at LIMIT 1',
+                (PENDING, FAILED, self.max_attempts, now)).fetchone()
+            if not row:
+                return None
+            self.conn.execute(
+                'UPDATE items SET state = ?, owner = ?, lease_until = ?, '
+                'updated_at = ? WHERE key = ?',
+                (IN_FLIGHT, self.owner,
+                 now + self.lease_sec if self.lease_sec else None, now,
+                 row[0]))
+        return FrontierItem(row[0], row[1], pickle.loads(row[2]), row[3])
+
+    def heartbeat(self, item: FrontierItem) -> bool:
+        # Renews the lease on `item`. False means the lease had already run
+        # out and the item may be in another worker's hands.
+        if not self.lease_sec:
+            return True
+        now = self.clock()
+        with self.lock, self.conn:
+            return self.conn.execute(
+                'UPDATE items SET lease_until = ?, updated_at = ? '
+                'WHERE key = ? AND state = ? AND owner = ?',
+                (now + self.lease_sec, now, item.key, IN_FLIGHT,
+                 self.owner)).rowcount == 1
+
+    def complete(self,
+                 item: FrontierItem,
+                 children: Iterable[Child] = ()) -> bool:
+        # Children and the state change are committed together, so a crash
+        # never leaves a finished item whose children were lost. Like fail(),
+        # leaves the item (and adds no children) if its lease was lost, and
+        # returns False then.
+        with self.lock, self.conn:
+            if not self.conn.execute(
+                    'UPDATE items SET state = ?, error = NULL, owner = NULL, '
+                    'lease_until = NULL, updated_at = ? WHERE key = ? '
+                    'AND state = ? AND owner IS ?',
+                    (DONE, self.clock(), item.key, IN_FLIGHT,
+                     self.owner)).rowcount:
+                return False
+            for kind, key, payload in children:
+                self.__insert(kind, key, payload)
+        return True
+
+    def fail(self, item: FrontierItem, error: str = None):
+        attempts = item.attempts + 1
+        delay = min(self.max_backoff_sec,
+                    self.backoff_sec * 2**(attempts - 1))
+        now = self.clock()
+        # Leaves the item alone if its lease was lost: whoever holds it now
+        # decides how it ends.
+        with self.lock, self.conn:
+            if not self.conn.execute(
+                    'UPDATE items SET state = ?, attempts = ?, next_at = ?, '
+                    'error = ?, owner = NULL, lease_until = NULL, '
+                    'updated_at = ? WHERE key = ? AND state = ? '
+                    'AND owner IS ?',
+                    (FAILED, attempts, now + delay, error, now, item.key,
+                     IN_FLIGHT, self.owner)).rowcount:
+                return
+        if attempts < self.max_attempts:
+            metrics.RETRIES.inc(kind=item.kind)
+
+    def next_retry_in(self) -> Optional[float]:
+        # Seconds until a backed-off item becomes claimable again, or None
+        # when there is nothing left to retry. On a shared frontier, items
+        # other workers hold count too: they may yet add children or have
+        # their lease run out.
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT MIN(CASE WHEN state = ? THEN lease_until '
+                'ELSE next_at END) FROM items WHERE state = ? '
+                'OR (state = ? AND attempts < ?) OR (state = ? AND ?)',
+                (IN_FLIGHT, PENDING, FAILED, self.max_attempts, IN_FLIGHT,
+                 bool(self.lease_sec))).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - self.clock())
+
+    def state(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute('SELECT state FROM items WHERE key = ?',
+                                    (key, )).fetchone()
+        return row[0] if row else None
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT state, COUNT(*) FROM items GROUP BY state').fetchall()
+        return dict(rows)
@@ -0,0 +1,136 @@
+import calendar
+import datetime
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+from collections import namedtuple
+from typing import Callable, Iterator, Optional
+
+CacheEntry = namedtuple(
+    'CacheEntry',
+    ('url', 'status', 'etag', 'last_modified', 'fetched_at', 'body'))
+
+
+def normalize_url(url: str) -> str:
+    # tdsystem runs on PHP, where the last occurrence of a duplicated key
+    # wins (e.g. `G=0&...&G=48`), so the key is built the same way.
+    parts = urllib.parse.urlsplit(url)
+    params = {}
+    for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True):
+        params.pop(k, None)
+        params[k] = v
+    return urllib.parse.urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path or '/',
+         urllib.parse.urlencode(sorted(params.items())), ''))
+
+
+def page_month(url: str) -> Optional[datetime.date]:
+    # Returns the first day of the month the page is about, if it has one.
+    params = dict(
+        urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+    try:
+        return datetime.date(int(params['Y']), int(params['M']), 1)
+    except (KeyError, ValueError):
+        return None
+
+
+class CachePolicy:
+    def __init__(self,
+                 max_age_sec: float = 0,
+                 frozen_after_days: Optional[float] = 60,
+                 clock: Callable[[], float] = time.time):
+        self.max_age_sec = max_age_sec
+        self.frozen_after_days = frozen_after_days
+        self.clock = clock
+
+    def is_frozen(self, url: str) -> bool:
+        if self.frozen_after_days is None:
+            return False
+        month = page_month(url)
+        if not month:
+            return False
+        last_day = calendar.monthrange(month.year, month.month)[1]
+        month_end = datetime.datetime(month.year, month.month, last_day,
+                                      23, 59, 59)
+        age = datetime.datetime.fromtimestamp(self.clock()) - month_end
+        return age > datetime.timedelta(days=self.frozen_after_days)
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        if self.clock() - entry.fetched_at <= self.max_age_sec:
+            return True
+        return self.is_frozen(entry.url)
+
+
+class ResponseCache:
+    def __init__(self, path: str, level: int = 6):
+        self.path = path
+        self.level = level
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                body BLOB NOT NULL)''')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT url, status, etag, last_modified, fetched_at, body '
+                'FROM responses WHERE key = ?',
+                (normalize_url(url), )).fetchone()
+        if not row:
+            return None
+        return CacheEntry(*row[:5], zlib.decompress(row[5]))
+
+    def put(self,
+            url: str,
+            body: bytes,
+            status: int = 200,
+            etag: str = None,
+            last_modified: str = None,
+            fetched_at: float = None):
+        blob = zlib.compress(body, self.level)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (normalize_url(url), url, status, etag, last_modified,
+                 fetched_at if fetched_at is not None else time.time(), blob))
+
+    def touch(self, url: str, fetched_at: float = None):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE responses SET fetched_at = ? WHERE key = ?',
+                (fetched_at if fetched_at is not None else time.time(),
+                 normalize_url(url)))
+
+    def entries(self, batch_size: int = 100) -> Iterator[CacheEntry]:
+        # A batch at a time: the cache can be far larger than memory.
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    'SELECT rowid, url, status, etag, last_modified, '
+                    'fetched_at, body FROM responses WHERE rowid > ? '
+                    'ORDER BY rowid LIMIT ?', (last, batch_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield CacheEntry(*row[1:6], zlib.decompress(row[6]))
+            last = rows[-1][0]
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
@@ -0,0 +1,236 @@
+import http.client
+import io
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import zlib
+from collections import namedtuple
+from typing import Dict, Iterator, List, Tuple
+
+import metrics
+
+Response = namedtuple('Response', ('url', 'status', 'headers', 'body'))
+
+HostKey = Tuple[str, str]  # (scheme, netloc)
+
+USER_AGENT = 'Python-urllib/{}.{}'.format(*sys.version_info[:2])
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+DEFLATE = object()  # Decoder before it knows which deflate it has
+
+# Errors a kept-alive connection gives when the server closed it while it
+# sat idle. The request never reached the server, so it is sent again.
+STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError,
+                BrokenPipeError)
+
+
+class Decoder:
+    # Undoes a Content-Encoding a chunk at a time.
+
+    def __init__(self, encoding: str):
+        encoding = (encoding or '').strip().lower()
+        self.obj = None
+        if encoding in ('gzip', 'x-gzip'):
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.obj = DEFLATE
+        self.head = b''
+
+    def decode(self, data: bytes) -> bytes:
+        if self.obj is DEFLATE:
+            # Servers disagree on whether deflate means zlib or raw
+            # deflate: a zlib stream starts with a header checksummed to a
+            # multiple of 31.
+            self.head += data
+            if len(self.head) < 2:
+                return b''
+            zlib_header = int.from_bytes(self.head[:2], 'big') % 31 == 0
+            self.obj = zlib.decompressobj(
+                zlib.MAX_WBITS if zlib_header else -zlib.MAX_WBITS)
+            data, self.head = self.head, b''
+        return self.obj.decompress(data) if self.obj else data
+
+    def flush(self) -> bytes:
+        if self.obj is DEFLATE:
+            self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.obj.decompress(self.head) + self.obj.flush()
+        return self.obj.flush() if self.obj else b''
+
+
+class HostPool:
+    # Idle connections to one host. The semaphore bounds how many are open
+    # at once, idle or not.
+
+    def __init__(self, size: int):
+        self.idle: List[http.client.HTTPConnection] = []
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+
+
+class HttpClient:
+    # GETs over persistent HTTP/1.1 connections, at most
+    # `max_connections_per_host` per host, asking for gzip. Behaves like
+    # urlopen: redirects are followed and any other status outside 2xx is
+    # raised as urllib.error.HTTPError. get() reads the whole body, open()
+    # hands it out as it arrives.
+
+    def __init__(self,
+                 max_connections_per_host: int = 4,
+                 timeout: float = 60,
+                 connect_timeout: float = 10,
+                 max_redirects: int = 5,
+                 headers: Dict[str, str] = None):
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_redirects = max_redirects
+        self.headers = {
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        self.headers.update(headers or {})
+        self.pools: Dict[HostKey, HostPool] = {}
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            with pool.lock:
+                idle, pool.idle = pool.idle, []
+            for conn in idle:
+                conn.close()
+
+    def __pool(self, key: HostKey) -> HostPool:
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = HostPool(self.max_connections_per_host)
+                self.pools[key] = pool
+            return pool
+
+    def __connect(self, key: HostKey) -> http.client.HTTPConnection:
+        scheme, netloc = key
+        cls = (http.client.HTTPSConnection
+               if scheme == 'https' else http.client.HTTPConnection)
+        conn = cls(netloc, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.timeout)
+        return conn
+
+    def __send(self, pool: HostPool, key: HostKey, target: str,
+               headers: Dict[str, str]) -> Tuple[http.client.HTTPConnection,
+                                                  http.client.HTTPResponse]:
+        # The response comes back with its body still unread.
+        with pool.lock:
+            conn = pool.idle.pop() if pool.idle else None
+        reused = conn is not None
+        if conn is None:
+            conn = self.__connect(key)
+        try:
+            conn.request('GET', target, headers=headers)
+            return conn, conn.getresponse()
+        except STALE_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+            return self.__send(pool, key, target, headers)
+        except BaseException:
+            conn.close()
+            raise
+
+    def open(self, url: str, headers: Dict[str, str] = None) -> 'Stream':
+        # The response to a GET of `url`, its body not read yet. Holds a
+        # connection (and a slot of the pool) until it is closed.
+        hdrs = dict(self.headers, **(headers or {}))
+        for _ in range(self.max_redirects + 1):
+            u = urllib.parse.urlsplit(url)
+            key = (u.scheme, u.netloc)
+            target = urllib.parse.urlunsplit(('', '', u.path or '/',
+                                              u.query, ''))
+            pool = self.__pool(key)
+            pool.slots.acquire()
+            try:
+                conn, res = self.__send(pool, key, target, hdrs)
+            except BaseException:
+                pool.slots.release()
+                raise
+            stream = Stream(url, pool, conn, res)
+            location = res.headers.get('Location')
+            if res.status in REDIRECTS and location:
+                stream.read()
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if not 200 <= res.status < 300:
+                raise urllib.error.HTTPError(url, res.status, res.reason,
+                                             res.headers,
+                                             io.BytesIO(stream.read()))
+            return stream
+        raise urllib.error.HTTPError(url, res.status, 'Too many redirects',
+                                     res.headers, io.BytesIO(b''))
+
+    def get(self, url: str, headers: Dict[str, str] = None) -> Response:
+        with self.open(url, headers) as stream:
+            return Response(stream.url, stream.status, stream.headers,
+                            stream.read())
+
+
+class Stream:
+    # A response body read as it arrives, decoded chunk by chunk. Reading it
+    # to the end gives the connection back to the pool; closing it earlier
+    # drops the connection, which still has the rest of the body on it.
+
+    CHUNK_SIZE = 16384
+
+    def __init__(self, url: str, pool: HostPool,
+                 conn: http.client.HTTPConnection,
+                 res: http.client.HTTPResponse):
+        self.url = url
+        self.status = res.status
+        self.headers = res.headers
+        self.pool = pool
+        self.conn = conn
+        self.res = res
+        self.decoder = Decoder(res.headers.get('Content-Encoding'))
+        self.wire_bytes = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            while self.conn is not None:
+                data = self.res.read1(self.CHUNK_SIZE)
+                if not data:
+                    chunk = self.decoder.flush()
+                    self.__release(self.res.will_close)
+                else:
+                    self.wire_bytes += len(data)
+                    chunk = self.decoder.decode(data)
+                if chunk:
+                    yield chunk
+        finally:
+            self.close()
+
+    def read(self) -> bytes:
+        return b''.join(self)
+
+    def close(self):
+        self.__release(True)
+
+    def __release(self, drop: bool):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        metrics.FETCH_WIRE_BYTES.observe(self.wire_bytes)
+        if drop:
+            conn.close()
+        else:
+            with self.pool.lock:
+                self.pool.idle.append(conn)
+        self.pool.slots.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,450 @@
+import argparse
+import calendar
+import datetime
+import json
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from crawler import Crawler
+from meet_page_parser import Race, Sex, Style
+from month_page_parser import Course, Meet
+from results_store import MeetKey, enum_name, meet_key
+
+logger = getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    checked_at REAL NOT NULL,
+    PRIMARY KEY (kind, key)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS years (
+    year INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS meets (
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    g TEXT NOT NULL,
+    name TEXT,
+    course TEXT,
+    venue TEXT,
+    dates TEXT,
+    q_params TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    PRIMARY KEY (year, month, g));
+CREATE TABLE IF NOT EXISTS races (
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    g TEXT NOT NULL,
+    p TEXT NOT NULL,
+    sex TEXT,
+    distance INTEGER,
+    style TEXT,
+    q_params TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    PRIMARY KEY (year, month, g, p));
+CREATE INDEX IF NOT EXISTS meets_first_seen ON meets (first_seen);
+CREATE INDEX IF NOT EXISTS races_first_seen ON races (first_seen);
+'''
+
+# What a refresh found that the catalog did not list before, how many
+# pages it asked for and the keys of those that failed (they stay due).
+Changes = namedtuple('Changes', ('meets', 'races', 'pages', 'failed'))
+
+
+def month_page_key(year: int, month: int) -> str:
+    return '{}-{:02d}'.format(year, month)
+
+
+def meet_page_key(key: MeetKey) -> str:
+    return '{}-{:02d}-{}'.format(*key)
+
+
+class FreshnessPolicy:
+    # How long a page of the calendar stays fresh depends on when what it
+    # lists takes place. A month or a meet is live from its first day until
+    # `settle_days` after its last (while meets are added and results come
+    # in) and is revalidated every `live_sec`; before that every
+    # `upcoming_sec`. Once settled it is never asked for again. The list of
+    # years is revalidated every `years_sec`.
+
+    def __init__(self,
+                 live_sec: float = 3600,
+                 upcoming_sec: float = 7 * 86400,
+                 years_sec: float = 86400,
+                 settle_days: float = 14,
+                 clock: Callable[[], float] = time.time):
+        self.live_sec = live_sec
+        self.upcoming_sec = upcoming_sec
+        self.years_sec = years_sec
+        self.settle_days = settle_days
+        self.clock = clock
+
+    def max_age(self, first: datetime.date,
+                last: datetime.date) -> Optional[float]:
+        today = datetime.date.fromtimestamp(self.clock())
+        if today > last + datetime.timedelta(days=self.settle_days):
+            return None
+        if today < first:
+            return self.upcoming_sec
+        return self.live_sec
+
+    def is_live(self, first: datetime.date, last: datetime.date) -> bool:
+        # Started and not settled yet: results may still come in.
+        today = datetime.date.fromtimestamp(self.clock())
+        return first <= today <= last + datetime.timedelta(
+            days=self.settle_days)
+
+    @staticmethod
+    def month_span(year: int,
+                   month: int) -> Tuple[datetime.date, datetime.date]:
+        last_day = calendar.monthrange(year, month)[1]
+        return (datetime.date(year, month, 1),
+                datetime.date(year, month, last_day))
+
+    @staticmethod
+    def meet_span(meet: Meet) -> Tuple[datetime.date, datetime.date]:
+        if meet.dates:
+            return min(meet.dates), max(meet.dates)
+        year, month, _ = meet_key(meet.q_params)
+        return FreshnessPolicy.month_span(year, month)
+
+    def month_max_age(self, year: int, month: int) -> Optional[float]:
+        return self.max_age(*self.month_span(year, month))
+
+    def meet_max_age(self, meet: Meet) -> Optional[float]:
+        return self.max_age(*self.meet_span(meet))
+
+    def meet_is_live(self, meet: Meet) -> bool:
+        return self.is_live(*self.meet_span(meet))
+
+    def is_due(self, checked_at: Optional[float],
+               max_age: Optional[float]) -> bool:
+        if checked_at is None:
+            return True
+        if max_age is None:
+            return False
+        return self.clock() - checked_at >= max_age
+
+
+class MeetCatalog:
+    # The calendar of the site as last seen: its years, the meets of each
+    # month and the races of each meet, with when each page was checked and
+    # when each meet and race was first seen.
+
+    def __init__(self, path: str, policy: FreshnessPolicy = None):
+        self.path = path
+        self.policy = policy or FreshnessPolicy()
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def checked_at(self, kind: str, key: str = '') -> Optional[float]:
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT checked_at FROM pages WHERE kind = ? AND key = ?',
+                (kind, key)).fetchone()
+        return row[0] if row else None
+
+    def __checked(self, kind: str, key: str = ''):
+        self.conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)',
+                          (kind, key, self.policy.clock()))
+
+    def __checked_all(self, kind: str) -> Dict[str, float]:
+        return dict(
+            self.conn.execute('SELECT key, checked_at FROM pages '
+                              'WHERE kind = ?', (kind, )))
+
+    def years(self) -> List[int]:
+        with self.lock:
+            return [
+                y for y, in self.conn.execute(
+                    'SELECT year FROM years ORDER BY year DESC')
+            ]
+
+    def update_years(self, years: Iterable[str]) -> List[int]:
+        with self.lock, self.conn:
+            known = set(self.years())
+            new = sorted({int(y) for y in years} - known, reverse=True)
+            self.conn.executemany('INSERT INTO years VALUES (?)',
+                                  ((y, ) for y in new))
+            self.__checked('site')
+        return new
+
+    def update_month(self, year: int, month: int,
+                     meets: Iterable[Meet]) -> List[Meet]:
+        # Returns the meets the month did not list before.
+        now = self.policy.clock()
+        new = []
+        with self.lock, self.conn:
+            known = {
+                g for g, in self.conn.execute(
+                    'SELECT g FROM meets WHERE year = ? AND month = ?',
+                    (year, month))
+            }
+            for meet in meets:
+                key = meet_key(meet.q_params or {})
+                if not key:
+                    continue
+                if key[2] not in known:
+                    known.add(key[2])
+                    new.append(meet)
+                dates = sorted(meet.dates) if meet.dates else None
+                self.conn.execute(
+                    'INSERT INTO meets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (year, month, g) DO UPDATE SET '
+                    'name = excluded.name, course = excluded.course, '
+                    'venue = excluded.venue, dates = excluded.dates, '
+                    'q_params = excluded.q_params',
+                    key + (meet.name, enum_name(meet.course), meet.venue,
+                           json.dumps([d.isoformat() for d in dates])
+                           if dates else None,
+                           json.dumps(dict(meet.q_params),
+                                      ensure_ascii=False), now))
+            self.__checked('month', month_page_key(year, month))
+        return new
+
+    def update_meet(self, meet: Meet, races: Iterable[Race]) -> List[Race]:
+        # Returns the races the meet did not list before. The header row of
+        # a meet page parses into a race without P, which is no race.
+        key = meet_key(meet.q_params)
+        now = self.policy.clock()
+        new = []
+        with self.lock, self.conn:
+            known = {
+                p for p, in self.conn.execute(
+                    'SELECT p FROM races WHERE year = ? AND month = ? '
+                    'AND g = ?', key)
+            }
+            for race in races:
+                p = race.q_params.get('P') if race.q_params else None
+                if not p:
+                    continue
+                if p not in known:
+                    known.add(p)
+                    new.append(race)
+                self.conn.execute(
+                    'INSERT INTO races VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (year, month, g, p) DO UPDATE SET '
+                    'sex = excluded.sex, distance = excluded.distance, '
+                    'style = excluded.style, q_params = excluded.q_params',
+                    key + (p, enum_name(race.sex), race.distance or None,
+                           enum_name(race.style),
+                           json.dumps(dict(race.q_params),
+                                      ensure_ascii=False), now))
+            self.__checked('meet', meet_page_key(key))
+        return new
+
+    def meets(self, year: int = None, month: int = None) -> List[Meet]:
+        sql = 'SELECT name, course, venue, dates, q_params FROM meets'
+        conds, args = [], []
+        for cond, value in (('year = ?', year), ('month = ?', month)):
+            if value is not None:
+                conds.append(cond)
+                args.append(value)
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        with self.lock:
+            rows = self.conn.execute(
+                sql + ' ORDER BY year DESC, month DESC, g', args).fetchall()
+        return [
+            Meet(dates=[datetime.date.fromisoformat(d)
+                        for d in json.loads(dates)] if dates else None,
+                 name=name,
+                 course=Course[course] if course else None,
+                 venue=venue,
+                 q_params=json.loads(q_params))
+            for name, course, venue, dates, q_params in rows
+        ]
+
+    def races(self, meet: Meet) -> List[Race]:
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT sex, distance, style, q_params FROM races '
+                'WHERE year = ? AND month = ? AND g = ? '
+                'ORDER BY CAST(p AS INTEGER), p',
+                meet_key(meet.q_params)).fetchall()
+        return [
+            Race(Sex[sex] if sex else None, distance or 0,
+                 Style[style] if style else None, json.loads(q_params))
+            for sex, distance, style, q_params in rows
+        ]
+
+    def due_months(self) -> List[Tuple[int, int]]:
+        with self.lock:
+            checked = self.__checked_all('month')
+        return [(y, m) for y in self.years() for m in range(1, 13)
+                if self.policy.is_due(checked.get(month_page_key(y, m)),
+                                      self.policy.month_max_age(y, m))]
+
+    def due_meets(self) -> List[Meet]:
+        with self.lock:
+            checked = self.__checked_all('meet')
+        return [
+            meet for meet in self.meets() if self.policy.is_due(
+                checked.get(meet_page_key(meet_key(meet.q_params))),
+                self.policy.meet_max_age(meet))
+        ]
+
+
+def refresh(base_url: str, catalog: MeetCatalog,
+            workers: int = 4) -> Changes:
+    # The "what's new" crawl: asks only for the pages of the calendar that
+    # are due and returns the meets and races they newly list. A page that
+    # fails is left due for the next refresh.
+    policy = catalog.policy
+    new_meets, new_races, failed = [], [], []
+    pages = 0
+    with ThreadPoolExecutor(workers) as executor:
+        years_due = policy.is_due(catalog.checked_at('site'),
+                                  policy.years_sec)
+        if years_due or not catalog.years():
+            pages += 1
+            try:
+                catalog.update_years(Crawler.fetch_years(base_url) or [])
+            except Exception as e:
+                logger.warning('%s failed: %r', base_url, e)
+                failed.append(('site', base_url))
+
+        months = catalog.due_months()
+        pages += len(months)
+        futures = [
+            executor.submit(Crawler.fetch_meets, base_url, str(y), str(m))
+            for y, m in months
+        ]
+        for (y, m), future in zip(months, futures):
+            try:
+                meets = future.result()
+            except Exception as e:
+                logger.warning('%s failed: %r', month_page_key(y, m), e)
+                failed.append(('month', month_page_key(y, m)))
+                continue
+            new_meets += catalog.update_month(y, m, meets or [])
+
+        meets = catalog.due_meets()
+        pages += len(meets)
+        futures = [
+            executor.submit(Crawler.fetch_races, base_url,
+                            dict(meet.q_params)) for meet in meets
+        ]
+        for meet, future in zip(meets, futures):
+            key = meet_page_key(meet_key(meet.q_params))
+            try:
+                races = future.result()
+            except Exception as e:
+                logger.warning('%s failed: %r', key, e)
+                failed.append(('meet', key))
+                continue
+            new_races += [(meet, r)
+                          for r in catalog.update_meet(meet, races or [])]
+    return Changes(new_meets, new_races, pages, failed)
+
+
+def update_store(base_url: str, catalog: MeetCatalog, changes: Changes,
+                 store) -> Tuple[int, List[str]]:
+    # Crawls the records of the races a refresh newly found, and again
+    # those of every race of a live meet: its results come in (and are
+    # corrected) after its races are listed, until it settles. Upcoming
+    # meets have no results to crawl yet. Returns the number of races
+    # crawled and the keys of those that failed.
+    races = OrderedDict()
+    for meet, race in changes.races:
+        races[meet_key(meet.q_params) + (race.q_params['P'], )] = meet, race
+    for meet in catalog.meets():
+        if catalog.policy.meet_is_live(meet):
+            for race in catalog.races(meet):
+                races.setdefault(
+                    meet_key(meet.q_params) + (race.q_params['P'], ),
+                    (meet, race))
+    failed = []
+    for key, (meet, race) in races.items():
+        try:
+            records = Crawler.fetch_records(base_url, dict(race.q_params))
+        except Exception as e:
+            logger.warning('%s P=%s failed: %r', meet_page_key(key[:3]),
+                           key[3], e)
+            failed.append('{}-{}'.format(meet_page_key(key[:3]), key[3]))
+            continue
+        store.add(meet, race, records)
+    return len(races), failed
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(
+        description='Refresh the meet catalog and print what is new.')
+    ap.add_argument('base_url', nargs='?',
+                    default='https://www.tdsystem.co.jp/')
+    ap.add_argument('--catalog', default='meets.sqlite3')
+    ap.add_argument('--cache', default='http_cache.sqlite3',
+                    help="response cache ('' for none)")
+    ap.add_argument('--archive',
+                    help='archive every page fetched here (import the cache '
+                    'into it first: page_archive.py ARCHIVE import CACHE)')
+    ap.add_argument('--store',
+                    help='crawl the records of new races and of live meets '
+                    'into this store')
+    ap.add_argument('--rate', type=float, default=0.2,
+                    help='requests/sec')
+    ap.add_argument('--workers', type=int, default=4)
+    ap.add_argument('--backend', choices=('bs4', 'lxml'), default='bs4')
+    args = ap.parse_args(argv)
+
+    from fetcher import Fetcher
+    from http_cache import ResponseCache
+    from page_archive import PageArchive
+    from rate_limiter import HostRateLimiter
+
+    with ExitStack() as stack:
+        cache = archive = None
+        if args.cache:
+            cache = ResponseCache(args.cache)
+            stack.callback(cache.close)
+        if args.archive:
+            archive = PageArchive(args.archive)
+            stack.callback(archive.close)
+        Crawler.fetcher = Fetcher(cache, archive=archive)
+        stack.callback(Crawler.fetcher.close)
+        Crawler.limiter = HostRateLimiter(rate=args.rate)
+        Crawler.backend = args.backend
+        catalog = MeetCatalog(args.catalog)
+        stack.callback(catalog.close)
+        changes = refresh(args.base_url, catalog, args.workers)
+        for meet in changes.meets:
+            print('meet\t{}'.format(meet))
+        for meet, race in changes.races:
+            print('race\t{}\t{}'.format(meet.name, race))
+        print('{} pages, {} new meets, {} new races, {} failed'.format(
+            changes.pages, len(changes.meets), len(changes.races),
+            len(changes.failed)),
+              file=sys.stderr)
+        failed = len(changes.failed)
+        if args.store:
+            from results_store import ResultsStore
+            from swimmer_index import SwimmerIndex
+
+            store = ResultsStore(args.store)
+            stack.callback(store.close)
+            crawled, races_failed = update_store(args.base_url, catalog,
+                                                 changes, store)
+            SwimmerIndex(store).update()
+            print('{} races crawled, {} failed'.format(
+                crawled, len(races_failed)),
+                  file=sys.stderr)
+            failed += len(races_failed)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,13 @@
 import re
 import urllib.request
 from enum import Enum
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List
 
 from bs4 import BeautifulSoup
 from bs4.element import Tag
 
-from parser_base import Parser
+import metrics
+from parser_base import LxmlTree, Parser, PullTree, QueryParams
 
 
 class Sex(Enum):
@@ -26,6 +27,8 @@ class Style(Enum):
 
 
 class Race:
+    __slots__ = ('sex', 'distance', 'style', '_q_params')
+
     def __init__(self,
                  sex: Sex = None,
                  distance: int = 0,
@@ -36,24 +39,50 @@ class Race:
         self.style = style
         self.q_params = q_params
 
+    def __getstate__(self):
+        return (self.sex, self.distance, self.style, self._q_params)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):  # Pickled before Race had slots
+            self.__init__(**state)
+            return
+        self.sex, self.distance, self.style, q_params = state
+        self.q_params = q_params
+
+    def __eq__(self, other):
+        if not isinstance(other, Race):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
     def __str__(self):
         return 'sex={}, distance={}, style={}, q_params={}'.format(
             self.sex, self.distance, self.style, self.q_params)
 
+    @property
+    def q_params(self) -> QueryParams:
+        return self._q_params
+
+    @q_params.setter
+    def q_params(self, q_params: Dict[str, str]):
+        self._q_params = QueryParams(
+            q_params) if q_params is not None else None
+
     def add_q_param(self, key: str, val: str):
-        if not self.q_params:
-            self.q_params = {}
-        self.q_params[key] = val
+        params = self.q_params.copy() if self.q_params else {}
+        params[key] = val
+        self.q_params = params
 
 
 class MeetPageParser(Parser):
+    page_kind = 'meet'
+
     def __init__(self, page: Tag):
         self.page = page
 
     def __get_race_query_params(self, form) -> Dict[str, str]:
         params = {}
         params['action'] = form.get('action')
-        for input in form.find_all('input', attrs={'type': 'hidden'}):
+        for input in self._find_all(form, 'input', attrs={'type': 'hidden'}):
             params[input.get('name')] = input.get('value')
         return params
 
@@ -63,33 +92,73 @@ class MeetPageParser(Parser):
     STYLE_PAT = re.compile(r'自由形|背泳ぎ|平泳ぎ|バタフライ|個人メドレー|フリーリレー|メドレーリレー')
 
     def get_races(self) -> List[Race]:
-        rs = []
-        form = self.page.find('form', attrs={'name': 'gamelist'})
+        form = self._find(self.page, 'form', attrs={'name': 'gamelist'})
+        return list(metrics.timed_rows(self.__iter_races(form), self))
+
+    def iter_races(self) -> Iterator[Race]:
+        form = self._find(self.page, 'form', attrs={'name': 'gamelist'})
+        if form is not None:
+            yield from metrics.timed_rows(self.__iter_races(form), self)
+
+    @classmethod
+    def iter_stream(cls, chunks: Iterable[bytes]) -> Iterator[Race]:
+        # Streaming mode, on lxml: each race is yielded as soon as its row
+        # closed, and dropped from the tree. The form's hidden inputs come
+        # before its rows, so the params are complete by the first race.
+        p = LxmlMeetPageParser(None)
+        tree = PullTree(p._timed_source(chunks), ('input', 'tr'))
+        return metrics.timed_rows(p.__stream_races(tree), p)
+
+    def __stream_races(self, tree: PullTree) -> Iterator[Race]:
+        params = None
+        for el in tree:
+            form = next(el.iterancestors('form'), None)
+            if form is None or form.get('name') != 'gamelist':
+                continue
+            if params is None:
+                params = {'action': form.get('action')}
+            if el.tag == 'input':
+                if el.get('type') == 'hidden':
+                    params[el.get('name')] = el.get('value')
+                continue
+            el.getparent().remove(el)
+            yield self.__read_race(el, params)
+
+    def __iter_races(self, form: Tag) -> Iterator[Race]:
         params = self.__get_race_query_params(form)
-        for tr in form.find_all('tr'):
-            r = Race(q_params=params.copy())
-            for td in tr.find_all('td'):
-                txt = self.normalize(td.get_text())
-                if not txt:
-                    continue
-                m = self.__class__.SEX_PAT.match(txt)
-                if m:
-                    r.sex = Sex(m.group(0))
-                    continue
-                m = self.__class__.INDV_DIST_PAT.match(txt)
-                if m:
-                    r.distance = int(m.group(1))
-                m = self.__class__.RELAY_DIST_PAT.match(txt)
-                if m:
-                    r.distance = int(m.group(1)) * 4
-                m = self.__class__.STYLE_PAT.match(txt)
-                if m:
-                    r.style = Style(m.group(0))
-            button = tr.find('button')
-            if button:
-                r.add_q_param(button.get('name'), button.get('value'))
-            rs.append(r)
-        return rs
+        for tr in self._find_all(form, 'tr'):
+            yield self.__read_race(tr, params)
+
+    def __read_race(self, tr: Tag, params: Dict[str, str]) -> Race:
+        r = Race(q_params=params.copy())
+        for td in self._find_all(tr, 'td'):
+            txt = self.normalize(self._text(td))
+            if not txt:
+                continue
+            m = self.__class__.SEX_PAT.match(txt)
+            if m:
+                r.sex = Sex(m.group(0))
+                continue
+            m = self.__class__.INDV_DIST_PAT.match(txt)
+            if m:
+                r.distance = int(m.group(1))
+            m = self.__class__.RELAY_DIST_PAT.match(txt)
+            if m:
+                r.distance = int(m.group(1)) * 4
+            m = self.__class__.STYLE_PAT.match(txt)
+            if m:
+                r.style = Style(m.group(0))
+        button = self._find(tr, 'button')
+        if button is not None:
+            r.add_q_param(button.get('name'), button.get('value'))
+        return r
+
+
+class LxmlMeetPageParser(LxmlTree, MeetPageParser):
+    pass
+
+
+MeetPageParser.backends = {'bs4': MeetPageParser, 'lxml': LxmlMeetPageParser}
 
 
 if __name__ == '__main__':
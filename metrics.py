@@ -0,0 +1,429 @@
+import bisect
+import cProfile
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from logging import getLogger
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+logger = getLogger(__name__)
+
+# Upper bounds of the histogram buckets
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+           5, 10, 30, 60)
+BYTES = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+ROWS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+def _key(names: Tuple[str, ...], labels: Dict) -> Tuple[str, ...]:
+    return tuple(str(labels.get(k, '')) for k in names)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...],
+            extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace(
+        '"', '\\"')) for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, registry: 'Registry', name: str, help: str,
+                 labels: Tuple[str, ...] = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        if not self.registry.enabled:
+            return
+        key = _key(self.labels, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(
+            _key(self.labels, labels), 0)
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return dict(self.values)
+
+    def merge(self, values: Dict):
+        with self.lock:
+            for key, v in values.items():
+                self.values[key] = self.values.get(key, 0) + v
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def prometheus(self) -> List[str]:
+        return [
+            '{}{} {}'.format(self.name, _labels(self.labels, key), v)
+            for key, v in sorted(self.snapshot().items())
+        ]
+
+    def summary(self) -> Dict:
+        return {','.join(k) or '': v for k, v in self.snapshot().items()}
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self,
+                 registry: 'Registry',
+                 name: str,
+                 help: str,
+                 buckets: Iterable[float],
+                 labels: Tuple[str, ...] = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self.values: Dict[Tuple[str, ...], list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        if not self.registry.enabled:
+            return
+        key = _key(self.labels, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(key)
+            if v is None:
+                v = [[0] * (len(self.buckets) + 1), 0.0]
+                self.values[key] = v
+            v[0][i] += 1
+            v[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        v = self.values.get(_key(self.labels, labels))
+        return sum(v[0]) if v else 0
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {k: [list(v[0]), v[1]] for k, v in self.values.items()}
+
+    def merge(self, values: Dict):
+        with self.lock:
+            for key, (counts, total) in values.items():
+                v = self.values.get(key)
+                if v is None:
+                    v = [[0] * (len(self.buckets) + 1), 0.0]
+                    self.values[key] = v
+                v[0] = [a + b for a, b in zip(v[0], counts)]
+                v[1] += total
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def prometheus(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in sorted(self.snapshot().items()):
+            cum = 0
+            for le, n in zip(self.buckets + ('+Inf', ), counts):
+                cum += n
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(self.labels, key, 'le="{}"'.format(le)),
+                    cum))
+            lines.append('{}_sum{} {}'.format(self.name,
+                                              _labels(self.labels, key),
+                                              total))
+            lines.append('{}_count{} {}'.format(self.name,
+                                                _labels(self.labels, key),
+                                                cum))
+        return lines
+
+    def quantile(self, q: float, counts: List[int]) -> float:
+        # Upper bound of the bucket holding the q-th observation
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cum = 0
+        for le, n in zip(self.buckets + (float('inf'), ), counts):
+            cum += n
+            if cum >= rank:
+                return le
+        return float('inf')
+
+    def summary(self) -> Dict:
+        ret = {}
+        for key, (counts, total) in self.snapshot().items():
+            n = sum(counts)
+            ret[','.join(key)] = {
+                'count': n,
+                'sum': total,
+                'mean': total / n if n else None,
+                'p50': self.quantile(0.5, counts),
+                'p95': self.quantile(0.95, counts),
+                'p99': self.quantile(0.99, counts),
+            }
+        return ret
+
+
+class Registry:
+    def __init__(self):
+        self.enabled = True
+        self.metrics: Dict[str, object] = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name: str, help: str,
+                labels: Tuple[str, ...] = ()) -> Counter:
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Counter(self, name, help, labels)
+            return self.metrics[name]
+
+    def histogram(self,
+                  name: str,
+                  help: str,
+                  buckets: Iterable[float] = SECONDS,
+                  labels: Tuple[str, ...] = ()) -> Histogram:
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Histogram(self, name, help, buckets,
+                                               labels)
+            return self.metrics[name]
+
+    def prometheus(self) -> str:
+        lines = []
+        for name, m in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, m.help))
+            lines.append('# TYPE {} {}'.format(name, m.kind))
+            lines += m.prometheus()
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> Dict:
+        return {
+            name: m.summary()
+            for name, m in sorted(self.metrics.items()) if m.values
+        }
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {name: m.snapshot() for name, m in self.metrics.items()}
+
+    def drain(self) -> Dict[str, Dict]:
+        # Takes and resets everything; used to ship a worker process's
+        # metrics back to the parent, which merges them.
+        ret = {}
+        for name, m in self.metrics.items():
+            with m.lock:
+                if m.values:
+                    ret[name] = m.values
+                    m.values = {}
+        return ret
+
+    def merge(self, snapshot: Dict[str, Dict]):
+        for name, values in snapshot.items():
+            m = self.metrics.get(name)
+            if m:
+                m.merge(values)
+
+    def reset(self):
+        for m in self.metrics.values():
+            m.reset()
+
+
+REGISTRY = Registry()
+
+FETCH_SECONDS = REGISTRY.histogram(
+    'tdsystem_fetch_seconds', 'Time spent on a network fetch.',
+    labels=('status', ))
+FETCH_BYTES = REGISTRY.histogram('tdsystem_fetch_bytes',
+                                 'Size of fetched page bodies.', BYTES)
+FETCH_WIRE_BYTES = REGISTRY.histogram(
+    'tdsystem_fetch_wire_bytes',
+    'Size of fetched page bodies as sent, before decompression.', BYTES)
+FETCH_ERRORS = REGISTRY.counter('tdsystem_fetch_errors_total',
+                                'Failed fetches.', ('status', ))
+CACHE_LOOKUPS = REGISTRY.counter(
+    'tdsystem_cache_lookups_total',
+    'Response cache lookups: hit, miss, or revalidated (304).',
+    ('result', ))
+THROTTLE_SECONDS = REGISTRY.histogram(
+    'tdsystem_throttle_seconds', 'Time spent waiting on the rate limiter.')
+RETRIES = REGISTRY.counter('tdsystem_crawl_retries_total',
+                           'Crawl items that failed and will be retried.',
+                           ('kind', ))
+PARSE_LOAD_SECONDS = REGISTRY.histogram(
+    'tdsystem_parse_load_seconds', 'Time spent building the document tree.',
+    labels=('parser', 'backend'))
+PARSE_EXTRACT_SECONDS = REGISTRY.histogram(
+    'tdsystem_parse_extract_seconds',
+    'Time spent extracting rows from a page, normalize included.',
+    labels=('parser', 'backend'))
+NORMALIZE_SECONDS = REGISTRY.counter(
+    'tdsystem_parse_normalize_seconds_total',
+    'Time spent in Parser.normalize.', ('parser', 'backend'))
+PARSE_ROWS = REGISTRY.histogram('tdsystem_parse_rows',
+                                'Rows extracted from a page.', ROWS,
+                                ('parser', 'backend'))
+EMPTY_PAGES = REGISTRY.counter('tdsystem_parse_empty_pages_total',
+                               'Pages that yielded no rows.',
+                               ('parser', 'backend'))
+PARSE_CACHE_LOOKUPS = REGISTRY.counter(
+    'tdsystem_parse_cache_lookups_total',
+    'Parse result cache lookups: hit or miss.', ('result', ))
+
+
+class ParseProfiler:
+    # Profiles a random sample of the parse stage with cProfile. Only one
+    # profile can be active at a time, so a page that comes up while another
+    # is being profiled is skipped.
+
+    def __init__(self, rate: float = 0.01):
+        self.rate = rate
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+        self.samples = 0
+
+    def sampled(self) -> bool:
+        return random.random() < self.rate
+
+    @contextmanager
+    def enabled(self):
+        if not self.lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            self.profile.enable()
+            try:
+                yield
+            finally:
+                self.profile.disable()
+                self.samples += 1
+        finally:
+            self.lock.release()
+
+    def stats(self) -> pstats.Stats:
+        with self.lock:
+            return pstats.Stats(self.profile)
+
+    def dump(self, path: str):
+        with self.lock:
+            self.profile.dump_stats(path)
+
+
+PROFILER: ParseProfiler = None
+
+
+def profile_parse(rate: float = 0.01) -> ParseProfiler:
+    global PROFILER
+    PROFILER = ParseProfiler(rate) if rate else None
+    return PROFILER
+
+
+def timed_load(parser: str, backend: str, load, source):
+    profiler = PROFILER
+    start = time.perf_counter()
+    if profiler and profiler.sampled():
+        with profiler.enabled():
+            tree = load(source)
+    else:
+        tree = load(source)
+    PARSE_LOAD_SECONDS.observe(time.perf_counter() - start,
+                               parser=parser,
+                               backend=backend)
+    return tree
+
+
+def timed_rows(it: Iterator, parser) -> Iterator:
+    # Wraps a parser's row generator. Only the time spent inside the
+    # generator is counted, not what the consumer does between rows.
+    profiler = PROFILER
+    sampled = profiler is not None and profiler.sampled()
+    elapsed = 0.0
+    rows = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                if sampled:
+                    with profiler.enabled():
+                        row = next(it)
+                else:
+                    row = next(it)
+            except StopIteration:
+                elapsed += time.perf_counter() - start
+                break
+            elapsed += time.perf_counter() - start
+            rows += 1
+            yield row
+    finally:
+        labels = {'parser': parser.page_kind, 'backend': parser.backend}
+        PARSE_EXTRACT_SECONDS.observe(elapsed - parser._source_sec, **labels)
+        parser._source_sec = 0.0
+        PARSE_ROWS.observe(rows, **labels)
+        if not rows:
+            EMPTY_PAGES.inc(**labels)
+        if parser._normalize_sec:
+            NORMALIZE_SECONDS.inc(parser._normalize_sec, **labels)
+            parser._normalize_sec = 0.0
+
+
+def empty_page(parser):
+    # A page without the form or table rows are extracted from
+    EMPTY_PAGES.inc(parser=parser.page_kind, backend=parser.backend)
+
+
+class SummaryReporter:
+    # Writes REGISTRY.summary() as JSON every `interval` seconds, to `path`
+    # (replaced atomically) or to the log.
+
+    def __init__(self,
+                 interval: float = 60,
+                 path: str = None,
+                 registry: Registry = REGISTRY):
+        self.interval = interval
+        self.path = path
+        self.registry = registry
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def report(self):
+        summary = json.dumps(
+            dict(self.registry.summary(), time=time.time()),
+            ensure_ascii=False)
+        if not self.path:
+            logger.info('metrics %s', summary)
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(summary + '\n')
+        os.replace(tmp, self.path)
+
+    def __run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def start(self) -> 'SummaryReporter':
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.report()
@@ -0,0 +1,523 @@
+import argparse
+import datetime
+import gzip
+import json
+import random
+import threading
+import time
+import urllib.parse
+from collections import Counter, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from http_cache import ResponseCache, normalize_url
+
+# A stand-in for www.tdsystem.co.jp: the month page at `/`, the race list at
+# `/ProList.php` and the results at `/Record.php`, generated from the query
+# params so every crawl of the same site sees the same pages.
+
+ENCODING = 'shift_jis'
+
+WEEKDAYS = '月火水木金土日'
+
+VENUES = ('東京辰巳国際水泳場', '横浜国際プール', '千葉県国際総合水泳場',
+          '市民プール')
+
+# (sex, distance, style, relay)
+EVENTS = (
+    ('女子', 200, '個人メドレー', False),
+    ('男子', 50, '自由形', False),
+    ('女子', 100, '平泳ぎ', False),
+    ('男子', 100, '背泳ぎ', False),
+    ('女子', 50, 'バタフライ', False),
+    ('男子', 400, '自由形', False),
+    ('混合', 200, 'メドレーリレー', True),
+    ('女子', 200, 'フリーリレー', True),
+)
+
+# Seconds per 50m of a fast masters swimmer
+PACE = {
+    '自由形': 29.0,
+    '背泳ぎ': 33.5,
+    '平泳ぎ': 37.0,
+    'バタフライ': 31.5,
+    '個人メドレー': 34.0,
+    'フリーリレー': 28.0,
+    'メドレーリレー': 31.0,
+}
+
+CLASSES = (18, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80)
+RELAY_CLASSES = (120, 160, 200, 240, 280)
+
+FAMILY_NAMES = ('山田', '田中', '鈴木', '佐藤', '伊藤', '渡辺', '中村', '小林',
+                '高橋', '加藤')
+GIVEN_NAMES = ('花子', '一郎', '和子', '健', '誠', '恵', '大輔', '翔', '由美',
+               '直樹')
+TEAMS = ('ＡＢＣスイミング', 'ＸＹＺマスターズ', '市民ＳＣ', '個人')
+
+Event = namedtuple('Event', ('sex', 'distance', 'style', 'relay'))
+
+
+def class_label(cls: int, relay: bool) -> str:
+    if relay:
+        return '{}〜{}歳'.format(cls, cls + 39)
+    if cls == 18:
+        return '18〜24歳'
+    return '{}〜{}歳'.format(cls, cls + 4)
+
+
+def format_time(cs: int) -> str:
+    mins, cs = divmod(cs, 6000)
+    if mins:
+        return '{}:{:02d}.{:02d}'.format(mins, cs // 100, cs % 100)
+    return '{}.{:02d}'.format(cs // 100, cs % 100)
+
+
+def page(title: str, body: List[str]) -> bytes:
+    return '\n'.join([
+        '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN">',
+        '<html>', '<head>',
+        '<meta http-equiv="Content-Type" content="text/html; '
+        'charset=Shift_JIS">', '<title>{}</title>'.format(title), '</head>',
+        '<body>'
+    ] + body + ['</body>', '</html>', '']).encode(ENCODING,
+                                                  'xmlcharrefreplace')
+
+
+def hidden(params: Dict[str, str], keys) -> List[str]:
+    return [
+        '<input type="hidden" name="{}" value="{}">'.format(k, params[k])
+        for k in keys if k in params
+    ]
+
+
+class SyntheticSite:
+    def __init__(self,
+                 years: Tuple[int, ...] = (2023, 2022),
+                 meets_per_month: int = 3,
+                 races_per_meet: int = 8,
+                 swimmers_per_class: int = 8,
+                 seed: int = 0,
+                 class_headings: bool = True):
+        self.years = years
+        self.meets_per_month = meets_per_month
+        self.races_per_meet = races_per_meet
+        self.swimmers_per_class = swimmers_per_class
+        self.seed = seed
+        # Whether the all-classes page (Cls=999) puts a row naming the class
+        # above the records of each class
+        self.class_headings = class_headings
+
+    def __rng(self, *key) -> random.Random:
+        return random.Random('{}:{}'.format(self.seed, key))
+
+    def __meet(self, y: int, m: int, g: int) -> Optional[Dict]:
+        i = g - m * 100
+        if y not in self.years or not 0 <= i < self.meets_per_month:
+            return None
+        rng = self.__rng(y, m, g)
+        day = 1 + rng.randrange(27)
+        days = [day] if rng.random() < 0.5 else [day, day + 1]
+        return {
+            'name': '第{}回 マスターズ水泳競技大会'.format(g),
+            'dates': [datetime.date(y, m, d) for d in days],
+            'venue': rng.choice(VENUES),
+            'course': rng.choice(('25m', '50m')),
+        }
+
+    def __event(self, p: int) -> Optional[Event]:
+        if not 1 <= p <= self.races_per_meet:
+            return None
+        return Event(*EVENTS[(p - 1) % len(EVENTS)])
+
+    def month_page(self, params: Dict[str, str]) -> Optional[bytes]:
+        today = datetime.date.today()
+        try:
+            y = int(params.get('Y', today.year))
+            m = int(params.get('M', today.month))
+        except ValueError:
+            return None
+        body = ['<form name="SelectYear" action="./" method="get">',
+                '<select name="Y">']
+        for year in self.years:
+            body.append(
+                '<option name="SelYearList" value="{0}"{1}>{0}年</option>'.
+                format(year, ' selected' if year == y else ''))
+        body += ['</select>', '<input type="submit" value="表示">', '</form>',
+                 '<form name="gamelist" action="ProList.php" method="get">']
+        body += hidden({'Y': y, 'M': m, 'GL': 0}, ('Y', 'M', 'GL'))
+        body += ['<table border="1" cellpadding="2">',
+                 '<tr><th>開催日</th><th>大会名</th><th>会場</th><th></th></tr>']
+        for i in range(self.meets_per_month if y in self.years else 0):
+            g = m * 100 + i
+            meet = self.__meet(y, m, g)
+            days = '～'.join('{}日({})'.format(d.day, WEEKDAYS[d.weekday()])
+                            for d in meet['dates'])
+            body += [
+                '<tr>', '<td>{}</td>'.format(days),
+                '<td>{}</td>'.format(meet['name']),
+                '<td>{}({})</td>'.format(meet['venue'], meet['course']),
+                '<td><button type="submit" name="G" value="{}">結果</button>'
+                '</td>'.format(g), '</tr>'
+            ]
+        body += ['</table>', '</form>']
+        return page('大会一覧', body)
+
+    def meet_page(self, params: Dict[str, str]) -> Optional[bytes]:
+        try:
+            y, m, g = int(params['Y']), int(params['M']), int(params['G'])
+        except (KeyError, ValueError):
+            return None
+        meet = self.__meet(y, m, g)
+        if not meet:
+            return None
+        q = dict(Y=y, M=m, G=g, GL=params.get('GL', 0), S=2, Lap=1, Cls=999,
+                 L=1, RG=1, Page='ProList.php')
+        body = ['<h2>{}</h2>'.format(meet['name']),
+                '<form name="gamelist" action="Record.php" method="get">']
+        body += hidden(q, q.keys())
+        body += ['<table border="1">',
+                 '<tr><th>性別</th><th>距離</th><th>種目</th><th></th></tr>']
+        for p in range(1, self.races_per_meet + 1):
+            e = self.__event(p)
+            if e.relay:
+                dist = '4×{}m'.format(e.distance // 4)
+            else:
+                dist = '{}m'.format(e.distance)
+            body.append(
+                '<tr><td>{}</td><td>{}</td><td>{}</td><td><button '
+                'type="submit" name="P" value="{}">決勝</button></td></tr>'.
+                format(e.sex, dist, e.style, p))
+        body += ['</table>', '</form>']
+        return page('種目一覧', body)
+
+    def __results(self, key, e: Event, cls: int) -> List[Tuple]:
+        rng = self.__rng(*key, cls)
+        legs = e.distance // 50
+        base = PACE[e.style] * (1 + (cls - (120 if e.relay else 25)) / 150)
+        rows = []
+        for i in range(max(0, self.swimmers_per_class + rng.randint(-2, 2))):
+            pace = base * rng.uniform(1.0, 1.35)
+            splits = []
+            t = 0.0
+            for leg in range(legs):
+                t += pace * rng.uniform(0.93, 1.08) - (2 if leg == 0 else 0)
+                splits.append(int(round(t * 100)))
+            if e.relay:
+                name = rng.choice(TEAMS)
+                team = '<br>'.join(
+                    rng.choice(FAMILY_NAMES) + '　' + rng.choice(GIVEN_NAMES)
+                    for _ in range(4))
+            else:
+                name = rng.choice(FAMILY_NAMES) + '　' + rng.choice(
+                    GIVEN_NAMES)
+                team = rng.choice(TEAMS)
+            dns = rng.random() < 0.05
+            rows.append((None if dns else splits[-1], name, team,
+                         cls + rng.randrange(5), splits))
+        rows.sort(key=lambda r: (r[0] is None, r[0] or 0))
+        return rows
+
+    def record_page(self, params: Dict[str, str]) -> Optional[bytes]:
+        try:
+            y, m, g = (int(params[k]) for k in ('Y', 'M', 'G'))
+        except (KeyError, ValueError):
+            return None
+        meet = self.__meet(y, m, g)
+        if not meet:
+            return None
+        p = params.get('P', '')
+        e = self.__event(int(p)) if p.isdigit() else None
+        if not e:
+            # The site answers a race it does not know with an empty page.
+            return page('競技結果', ['<p>該当する記録はありません。</p>'])
+        classes = RELAY_CLASSES if e.relay else CLASSES
+        cls = params.get('Cls', '999')
+        if cls != '999' and (not cls.isdigit() or int(cls) not in classes):
+            return None
+        lap = params.get('Lap', '1') == '1' and e.distance >= 100
+        q = dict(params)
+        q.setdefault('Lap', '1')
+        body = [
+            '<table width="100%"><tr><td>{}</td><td>{} {}m {} 決勝</td></tr>'
+            '</table>'.format(meet['name'], e.sex, e.distance, e.style),
+            '<form name="formclasslist" action="Record.php" method="get">'
+        ]
+        body += hidden(q, ('Y', 'M', 'G', 'GL', 'S', 'Lap', 'L', 'RG', 'Page',
+                           'P'))
+        body += ['<select name="Cls" onchange="submit();">',
+                 '<option value="999">全年齢</option>']
+        for c in classes:
+            body.append('<option value="{}"{}>{}</option>'.format(
+                c, ' selected' if str(c) == cls else '',
+                class_label(c, e.relay)))
+        body += ['</select>', '</form>', '<table border="1" cellspacing="0">']
+        if e.relay:
+            body.append('<tr><th>順位</th><th>チーム</th><th>泳者</th>'
+                        '<th>記録</th></tr>')
+        else:
+            body.append('<tr><th>順位</th><th>氏名</th><th>所属</th>'
+                        '<th>年齢</th><th>記録</th></tr>')
+        cols = 4 if e.relay else 5
+        for c in classes if cls == '999' else (int(cls), ):
+            if cls == '999' and self.class_headings:
+                body.append('<tr><td colspan="{}" class="cls">{}</td></tr>'
+                            .format(cols, class_label(c, e.relay)))
+            rank = 0
+            for time_cs, name, team, age, splits in self.__results(
+                (y, m, g, p), e, c):
+                rank += 1
+                cells = [
+                    '<td align="center">{}</td>'.format(
+                        rank if time_cs is not None else ''),
+                    '<td valign="top">{}</td>'.format(name)
+                ]
+                if e.relay:
+                    cells.append('<td>{}</td>'.format(team))
+                else:
+                    cells += ['<td valign="top" nowrap>{}</td>'.format(team),
+                              '<td>{}</td>'.format(age)]
+                cells.append('<td align="right">{}</td>'.format(
+                    format_time(time_cs) if time_cs is not None else '棄権'))
+                body += ['<tr>'] + cells + ['</tr>']
+                if lap and time_cs is not None:
+                    prev = 0
+                    body += [
+                        '<tr>', '<td colspan="{}"><table class="lap">'.format(
+                            cols), '<tr>' + ''.join(
+                                '<td>{}m</td>'.format(50 * (i + 1))
+                                for i in range(len(splits))) + '</tr>',
+                        '<tr>' + ''.join('<td>{}</td>'.format(format_time(s))
+                                         for s in splits) + '</tr>'
+                    ]
+                    laps = []
+                    for s in splits:
+                        laps.append('<td>({})</td>'.format(
+                            format_time(s - prev)))
+                        prev = s
+                    body += ['<tr>' + ''.join(laps) + '</tr>',
+                             '</table></td>', '</tr>']
+        body.append('</table>')
+        return page('競技結果', body)
+
+
+class Faults:
+    # Each request first waits `latency` plus an exponentially distributed
+    # share of `jitter` seconds, then fails with the given probabilities.
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 error_rate: float = 0.0,
+                 throttle_rate: float = 0.0,
+                 unavailable_rate: float = 0.0,
+                 retry_after: int = 1,
+                 seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.unavailable_rate = unavailable_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self.lock:
+            extra = self.rng.expovariate(1.0) if self.jitter else 0.0
+        return self.latency + self.jitter * extra
+
+    def status(self) -> int:
+        with self.lock:
+            x = self.rng.random()
+        for status, rate in ((429, self.throttle_rate),
+                             (503, self.unavailable_rate),
+                             (500, self.error_rate)):
+            if x < rate:
+                return status
+            x -= rate
+        return 200
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes: with Nagle on, a kept-alive
+    # connection waits out the client's delayed ACK between the two.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connected()
+
+    def do_GET(self):
+        start = time.monotonic()
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/_stats':
+            self.__send(200, json.dumps(self.server.stats()).encode(),
+                        'application/json')
+            return
+        faults = self.server.faults
+        time.sleep(faults.delay())
+        status = faults.status()
+        body = b''
+        headers = None
+        if status in (429, 503):
+            headers = {'Retry-After': str(faults.retry_after)}
+        elif status == 200:
+            body = self.server.page(url)
+            if body is None:
+                status = 404
+                body = b''
+        # Recorded before answering so a client that got its response sees
+        # it counted.
+        self.server.record(status, time.monotonic() - start)
+        self.__send(status, body, headers=headers)
+
+    def __send(self, status: int, body: bytes,
+               content_type: str = 'text/html; charset=Shift_JIS',
+               headers: Dict[str, str] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if self.server.gzip and body and 'gzip' in self.headers.get(
+                'Accept-Encoding', ''):
+            body = gzip.compress(body, 6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.server.sent(len(body))
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self,
+                 address: Tuple[str, int] = ('127.0.0.1', 0),
+                 site: SyntheticSite = None,
+                 faults: Faults = None,
+                 cache: ResponseCache = None,
+                 origin: str = 'https://www.tdsystem.co.jp',
+                 gzip: bool = True):
+        super().__init__(address, Handler)
+        self.site = site or SyntheticSite()
+        self.faults = faults or Faults()
+        # Pages recorded by the crawler's response cache are served as they
+        # are; anything not in it is generated.
+        self.cache = cache
+        self.origin = origin
+        # Whether bodies are gzipped for clients that accept it
+        self.gzip = gzip
+        self.lock = threading.Lock()
+        self.statuses = Counter()
+        self.latencies: List[float] = []
+        self.connections = 0
+        self.bytes_sent = 0
+
+    @property
+    def base_url(self) -> str:
+        return 'http://{}:{}/'.format(*self.server_address[:2])
+
+    def page(self, url: urllib.parse.SplitResult) -> Optional[bytes]:
+        if self.cache is not None:
+            entry = self.cache.get(
+                normalize_url(self.origin + url.path +
+                              ('?' + url.query if url.query else '')))
+            if entry:
+                return entry.body
+        # The last value wins for repeated keys, as in PHP.
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path in ('/', '/index.php'):
+            return self.site.month_page(params)
+        if url.path == '/ProList.php':
+            return self.site.meet_page(params)
+        if url.path == '/Record.php':
+            return self.site.record_page(params)
+        return None
+
+    def record(self, status: int, latency: float):
+        with self.lock:
+            self.statuses[status] += 1
+            self.latencies.append(latency)
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+
+    def sent(self, n: int):
+        with self.lock:
+            self.bytes_sent += n
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lat = sorted(self.latencies)
+            statuses = dict(self.statuses)
+            connections, bytes_sent = self.connections, self.bytes_sent
+
+        def pct(q):
+            return lat[min(len(lat) - 1, int(q * len(lat)))] if lat else None
+
+        return {
+            'requests': len(lat),
+            'connections': connections,
+            'bytes': bytes_sent,
+            'statuses': statuses,
+            'latency': {'p50': pct(0.5), 'p95': pct(0.95), 'p99': pct(0.99),
+                        'max': lat[-1] if lat else None},
+        }
+
+    def start(self) -> threading.Thread:
+        t = threading.Thread(target=self.serve_forever, daemon=True)
+        t.start()
+        return t
+
+
+def main(argv: List[str] = None):
+    ap = argparse.ArgumentParser(description='Serve a mock tdsystem site.')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8080)
+    ap.add_argument('--years', type=int, nargs='+', default=[2023, 2022])
+    ap.add_argument('--meets', type=int, default=3, help='per month')
+    ap.add_argument('--races', type=int, default=8, help='per meet')
+    ap.add_argument('--swimmers', type=int, default=8, help='per class')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--no-class-headings', action='store_true',
+                    help='list all classes (Cls=999) without headings')
+    ap.add_argument('--latency', type=float, default=0.0, help='seconds')
+    ap.add_argument('--jitter', type=float, default=0.0, help='seconds')
+    ap.add_argument('--error-rate', type=float, default=0.0)
+    ap.add_argument('--throttle-rate', type=float, default=0.0,
+                    help='share of requests answered with 429')
+    ap.add_argument('--unavailable-rate', type=float, default=0.0,
+                    help='share of requests answered with 503')
+    ap.add_argument('--retry-after', type=int, default=1)
+    ap.add_argument('--cache', help='serve pages recorded in this cache')
+    ap.add_argument('--no-gzip', action='store_true',
+                    help='never compress responses')
+    args = ap.parse_args(argv)
+
+    server = MockServer(
+        (args.host, args.port),
+        SyntheticSite(tuple(args.years), args.meets, args.races,
+                      args.swimmers, args.seed, not args.no_class_headings),
+        Faults(args.latency, args.jitter, args.error_rate,
+               args.throttle_rate, args.unavailable_rate, args.retry_after,
+               args.seed),
+        ResponseCache(args.cache) if args.cache else None,
+        gzip=not args.no_gzip)
+    print('Serving on {}'.format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats()))
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
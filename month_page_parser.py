@@ -3,12 +3,13 @@ import re
 import urllib.request
 from collections import namedtuple
 from enum import Enum
-from typing import Dict, List
+from typing import Dict, Iterator, List
 
 from bs4 import BeautifulSoup
 from bs4.element import Tag
 
-from parser_base import Parser
+import metrics
+from parser_base import LxmlTree, Parser, QueryParams
 
 
 class Course(Enum):
@@ -17,6 +18,8 @@ class Course(Enum):
 
 
 class Meet:
+    __slots__ = ('dates', 'name', 'course', 'venue', '_q_params')
+
     def __init__(self,
                  dates: List[datetime.date] = None,
                  name: str = None,
@@ -34,10 +37,35 @@ class Meet:
             self.dates = []
         self.dates.append(date)
 
+    @property
+    def q_params(self) -> QueryParams:
+        return self._q_params
+
+    @q_params.setter
+    def q_params(self, q_params: Dict[str, str]):
+        self._q_params = QueryParams(
+            q_params) if q_params is not None else None
+
     def add_q_param(self, key: str, val: str):
-        if not self.q_params:
-            self.q_params = {}
-        self.q_params[key] = val
+        params = self.q_params.copy() if self.q_params else {}
+        params[key] = val
+        self.q_params = params
+
+    def __getstate__(self):
+        return (self.dates, self.name, self.course, self.venue,
+                self._q_params)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):  # Pickled before Meet had slots
+            self.__init__(**state)
+            return
+        self.dates, self.name, self.course, self.venue, q_params = state
+        self.q_params = q_params
+
+    def __eq__(self, other):
+        if not isinstance(other, Meet):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
 
     def __str__(self):
         return 'name={}, dates={}, course={}, venue={}, q_params={}'.format(
@@ -45,6 +73,8 @@ class Meet:
 
 
 class MonthPageParser(Parser):
+    page_kind = 'month'
+
     def __init__(self, page: Tag, year: int = 0, month: int = 0):
         self.year = year
         self.month = month
@@ -53,16 +83,17 @@ class MonthPageParser(Parser):
     def __get_meet_query_params(self, form: Tag) -> Dict[str, str]:
         params = {}
         params['action'] = form.get('action')
-        for input in form.find_all('input', attrs={'type': 'hidden'}):
+        for input in self._find_all(form, 'input', attrs={'type': 'hidden'}):
             params[input.get('name')] = input.get('value')
         return params
 
     def get_available_years(self) -> List[str]:
-        form = self.page.find('form', attrs={'name': 'SelectYear'})
-        if not form:
+        form = self._find(self.page, 'form', attrs={'name': 'SelectYear'})
+        if form is None:
             return None
         ys = []
-        for yo in form.find_all('option', attrs={'name': 'SelYearList'}):
+        for yo in self._find_all(
+                form, 'option', attrs={'name': 'SelYearList'}):
             ys.append(yo.get('value'))
         return ys
 
@@ -70,21 +101,31 @@ class MonthPageParser(Parser):
     LONG_COURSE_PAT = re.compile(r'\((50m)\)')
 
     def get_meets(self) -> List[Meet]:
-        form = self.page.find('form', attrs={'name': 'gamelist'})
-        if not form:
+        form = self._find(self.page, 'form', attrs={'name': 'gamelist'})
+        if form is None:
+            metrics.empty_page(self)
             return None
+        return list(metrics.timed_rows(self.__iter_meets(form), self))
+
+    def iter_meets(self) -> Iterator[Meet]:
+        form = self._find(self.page, 'form', attrs={'name': 'gamelist'})
+        if form is None:
+            metrics.empty_page(self)
+            return
+        yield from metrics.timed_rows(self.__iter_meets(form), self)
+
+    def __iter_meets(self, form: Tag) -> Iterator[Meet]:
         params = self.__get_meet_query_params(form)
-        ms = []
-        for tr in form.find_all('tr'):
+        for tr in self._find_all(form, 'tr'):
             meet = Meet(q_params=params.copy())
-            tds = tr.find_all('td')
+            tds = list(self._find_all(tr, 'td'))
             if len(tds) < 4:
                 continue
-            meet.dates = self.get_days(self.normalize(tds[0].get_text()))
-            meet.name = self.normalize(tds[1].get_text())
+            meet.dates = self.get_days(self.normalize(self._text(tds[0])))
+            meet.name = self.normalize(self._text(tds[1]))
 
             # Process venue
-            venue_text = self.normalize(tds[2].get_text())
+            venue_text = self.normalize(self._text(tds[2]))
             m = self.__class__.SHORT_COURSE_PAT.search(venue_text)
             if m:
                 meet.course = Course(m.group(1))
@@ -94,12 +135,11 @@ class MonthPageParser(Parser):
                 meet.course = Course(m.group(1))
                 meet.venue = venue_text[0:m.span()[0]]
 
-            b = tds[3].find('button')
-            if b:
+            b = self._find(tds[3], 'button')
+            if b is not None:
                 meet.add_q_param(b.get('name'), b.get('value'))
 
-            ms.append(meet)
-        return ms
+            yield meet
 
     DATE_PAT = re.compile(r'([0-9]+)日\([日月火水木金土・祝]+\)')
 
@@ -127,6 +167,16 @@ class MonthPageParser(Parser):
         return self.__class__.VenueInfo(name=venue_text)
 
 
+class LxmlMonthPageParser(LxmlTree, MonthPageParser):
+    pass
+
+
+MonthPageParser.backends = {
+    'bs4': MonthPageParser,
+    'lxml': LxmlMonthPageParser
+}
+
+
 if __name__ == '__main__':
     req = urllib.request.Request('{}?{}'.format(
         'http://www.tdsystem.co.jp/',
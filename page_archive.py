@@ -0,0 +1,366 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+from collections import namedtuple
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from http_cache import normalize_url
+
+ArchivedPage = namedtuple('ArchivedPage',
+                          ('url', 'params', 'fetched_at', 'status', 'body'))
+
+# Every page is one self-describing entry: the header, then the JSON meta
+# (url, params, fetched_at, status) and the zlib-compressed body. The CRC
+# covers both, so a torn write at the end of a segment is told apart from
+# an entry.
+MAGIC = b'TDPA'
+HEADER = struct.Struct('<4sIII')  # magic, meta length, data length, crc32
+
+SEGMENT_PAT = 'segment-{:06d}.dat'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    status INTEGER NOT NULL,
+    sha256 BLOB NOT NULL,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS pages_key ON pages (key, id);
+CREATE UNIQUE INDEX IF NOT EXISTS pages_location ON pages (segment, offset);
+'''
+
+
+def page_params(url: str) -> Dict[str, str]:
+    # As PHP reads them: the last of repeated keys wins.
+    return dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+
+
+class PageArchive:
+    # Every page fetched, kept forever: an append-only directory of
+    # compressed segments, rotated at `segment_bytes`, and an SQLite index
+    # from the normalized URL to where each version of the page lies. Only
+    # the last segment is ever written to; the index can be rebuilt from the
+    # segments alone. One process writes an archive at a time.
+
+    def __init__(self, path: str, segment_bytes: int = 64 << 20,
+                 level: int = 6):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.level = level
+        self.lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(path, 'index.sqlite3'),
+                                    check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        self.__recover()
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 1
+        self.out = open(self.segment_path(self.segment), 'ab')
+
+    def close(self):
+        with self.lock:
+            self.out.close()
+            self.conn.close()
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, SEGMENT_PAT.format(segment))
+
+    def segments(self) -> List[int]:
+        return sorted(
+            int(os.path.basename(p)[8:-4])
+            for p in glob.glob(os.path.join(self.path, 'segment-*.dat')))
+
+    def __recover(self):
+        # Indexes whatever the segments hold past the end of the index (the
+        # index is written after the segment, so a crash in between leaves
+        # entries unindexed) and cuts off a torn entry at the very end.
+        with self.lock, self.conn:
+            for segment in self.segments():
+                end = self.conn.execute(
+                    'SELECT MAX(offset + length) FROM pages '
+                    'WHERE segment = ?', (segment, )).fetchone()[0] or 0
+                path = self.segment_path(segment)
+                if end >= os.path.getsize(path):
+                    continue
+                for offset, length, meta, data in self.__scan(path, end):
+                    body = zlib.decompress(data)
+                    self.__index(segment, offset, length, meta, body)
+                    end = offset + length
+                if end < os.path.getsize(path):
+                    with open(path, 'r+b') as f:
+                        f.truncate(end)
+
+    def __scan(self, path: str,
+               offset: int = 0) -> Iterator[Tuple[int, int, Dict, bytes]]:
+        # Yields (offset, length, meta, compressed body) of every whole
+        # entry from `offset` on, stopping at the first that is not.
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                head = f.read(HEADER.size)
+                if len(head) < HEADER.size:
+                    return
+                magic, meta_len, data_len, crc = HEADER.unpack(head)
+                payload = f.read(meta_len + data_len)
+                if (magic != MAGIC or len(payload) < meta_len + data_len
+                        or zlib.crc32(payload) != crc):
+                    return
+                length = HEADER.size + meta_len + data_len
+                yield (offset, length,
+                       json.loads(payload[:meta_len].decode('utf-8')),
+                       payload[meta_len:])
+                offset += length
+
+    def __index(self, segment: int, offset: int, length: int, meta: Dict,
+                body: bytes):
+        self.conn.execute(
+            'INSERT INTO pages (key, url, fetched_at, status, sha256, '
+            'segment, offset, length) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (normalize_url(meta['url']), meta['url'], meta['fetched_at'],
+             meta['status'], hashlib.sha256(body).digest(), segment, offset,
+             length))
+
+    def put(self,
+            url: str,
+            body: bytes,
+            status: int = 200,
+            fetched_at: float = None) -> bool:
+        # Appends a version of the page, unless it is the same as the last
+        # one archived. Returns whether it did.
+        digest = hashlib.sha256(body).digest()
+        # Checked before compressing too: most puts of a page already
+        # archived come from cache hits.
+        if self.__is_last(url, digest, status):
+            return False
+        meta = {
+            'url': url,
+            'params': page_params(url),
+            'fetched_at': fetched_at if fetched_at is not None else
+            time.time(),
+            'status': status,
+        }
+        meta_bytes = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+        data = zlib.compress(body, self.level)
+        with self.lock:
+            if self.__is_last(url, digest, status):
+                return False
+            if self.out.tell() >= self.segment_bytes:
+                self.out.close()
+                self.segment += 1
+                self.out = open(self.segment_path(self.segment), 'ab')
+            offset = self.out.tell()
+            self.out.write(
+                HEADER.pack(MAGIC, len(meta_bytes), len(data),
+                            zlib.crc32(meta_bytes + data)))
+            self.out.write(meta_bytes)
+            self.out.write(data)
+            self.out.flush()
+            with self.conn:
+                self.__index(self.segment, offset,
+                             HEADER.size + len(meta_bytes) + len(data), meta,
+                             body)
+        return True
+
+    def __is_last(self, url: str, digest: bytes, status: int) -> bool:
+        with self.lock:
+            last = self.conn.execute(
+                'SELECT sha256, status FROM pages WHERE key = ? '
+                'ORDER BY id DESC LIMIT 1', (normalize_url(url), )).fetchone()
+        return bool(last) and last[0] == digest and last[1] == status
+
+    def __read(self, segment: int, offset: int,
+               length: int) -> ArchivedPage:
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            entry = f.read(length)
+        _, meta_len, _, _ = HEADER.unpack_from(entry)
+        meta = json.loads(entry[HEADER.size:HEADER.size + meta_len])
+        return ArchivedPage(meta['url'], meta['params'], meta['fetched_at'],
+                            meta['status'],
+                            zlib.decompress(entry[HEADER.size + meta_len:]))
+
+    def get(self, url: str) -> Optional[ArchivedPage]:
+        # The last version archived of the page.
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT segment, offset, length FROM pages WHERE key = ? '
+                'ORDER BY id DESC LIMIT 1', (normalize_url(url), )).fetchone()
+        return self.__read(*row) if row else None
+
+    def versions(self, url: str) -> List[ArchivedPage]:
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT segment, offset, length FROM pages WHERE key = ? '
+                'ORDER BY id',
+                (normalize_url(url), )).fetchall()
+        return [self.__read(*row) for row in rows]
+
+    def __iter__(self) -> Iterator[ArchivedPage]:
+        # Every version of every page, in the order they were archived,
+        # read straight through the segments.
+        for segment in self.segments():
+            for _, _, meta, data in self.__scan(self.segment_path(segment)):
+                yield ArchivedPage(meta['url'], meta['params'],
+                                   meta['fetched_at'], meta['status'],
+                                   zlib.decompress(data))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def stats(self) -> Dict:
+        with self.lock:
+            pages, urls = self.conn.execute(
+                'SELECT COUNT(*), COUNT(DISTINCT key) FROM pages').fetchone()
+        return {
+            'pages': pages,
+            'urls': urls,
+            'segments': len(self.segments()),
+            'bytes': sum(
+                os.path.getsize(self.segment_path(s))
+                for s in self.segments()),
+        }
+
+
+class ArchiveFetcher:
+    # Stands in for a Fetcher and answers from the archive only: a page that
+    # was never archived is an error, never a request.
+
+    def __init__(self, archive: PageArchive):
+        self.archive = archive
+
+    def close(self):
+        pass
+
+    def cached(self, url: str) -> Optional[bytes]:
+        page = self.archive.get(url)
+        if page is None or not 200 <= page.status < 300:
+            return None
+        return page.body
+
+    def fetch(self, url: str) -> bytes:
+        body = self.cached(url)
+        if body is None:
+            raise LookupError('Not archived: {}'.format(url))
+        return body
+
+
+def import_cache(archive: PageArchive, cache_path: str) -> int:
+    # Archives the pages of a response cache, as last fetched.
+    from http_cache import ResponseCache
+
+    cache = ResponseCache(cache_path)
+    try:
+        return sum(
+            archive.put(e.url, e.body, e.status, e.fetched_at)
+            for e in cache.entries())
+    finally:
+        cache.close()
+
+
+def reparse(archive: PageArchive,
+            store_path: str,
+            base_url: str = 'https://www.tdsystem.co.jp/',
+            parse_workers: int = None,
+            backend: str = 'lxml',
+            force: bool = False) -> Dict[str, int]:
+    # Rebuilds the results store from the archive alone: the pipeline walks
+    # the site from its top page as a crawl would, with the archive as its
+    # fetcher and the parsers on every core. The store is built aside and
+    # only replaces the old one once complete. If any page was missing from
+    # the archive or failed, the races behind it would be lost: the old
+    # store is kept and the rebuilt one left in `<store>.rebuild`, unless
+    # `force`. stats['replaced'] says which.
+    from pipeline import Pipeline, Task
+    from results_store import ResultsStore
+    from swimmer_index import SwimmerIndex
+
+    if archive.get(base_url) is None:
+        raise LookupError('Not archived: {}'.format(base_url))
+    tmp = store_path + '.rebuild'
+    remove_db(tmp)
+    store = ResultsStore(tmp)
+    try:
+        pipeline = Pipeline(base_url,
+                            fetch_workers=2,
+                            parse_workers=parse_workers,
+                            rate=1e9,
+                            burst=1 << 30,
+                            fetcher=ArchiveFetcher(archive),
+                            backend=backend)
+        stats = pipeline.run([Task('site', base_url, None)], store.add)
+        SwimmerIndex(store).update()
+    finally:
+        store.close()
+    stats['replaced'] = not stats['failed'] or force
+    if stats['replaced']:
+        remove_db(store_path)
+        os.replace(tmp, store_path)
+    return stats
+
+
+def remove_db(path: str):
+    for p in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description='Raw page archive.')
+    ap.add_argument('archive', help='archive directory')
+    sub = ap.add_subparsers(dest='command', required=True)
+    sub.add_parser('stats', help='print what the archive holds')
+    p = sub.add_parser('import', help='archive a response cache')
+    p.add_argument('cache', help='e.g. http_cache.sqlite3')
+    p = sub.add_parser('reparse',
+                       help='rebuild a results store from the archive')
+    p.add_argument('store', help='e.g. results.sqlite3')
+    p.add_argument('--base-url', default='https://www.tdsystem.co.jp/')
+    p.add_argument('--workers', type=int, help='parse processes')
+    p.add_argument('--backend', choices=('bs4', 'lxml'), default='lxml')
+    p.add_argument('--force', action='store_true',
+                   help='replace the store even if pages were missing')
+    args = ap.parse_args(argv)
+
+    archive = PageArchive(args.archive)
+    failed = 0
+    try:
+        if args.command == 'import':
+            print('{} pages archived'.format(
+                import_cache(archive, args.cache)))
+        elif args.command == 'reparse':
+            start = time.perf_counter()
+            stats = reparse(archive, args.store, args.base_url, args.workers,
+                            args.backend, args.force)
+            print('{} pages, {} records, {} not archived or failed in '
+                  '{:.1f}s'.format(stats['pages'], stats['records'],
+                                   stats['failed'],
+                                   time.perf_counter() - start))
+            if not stats['replaced']:
+                print('{} kept; rebuilt store left in {}.rebuild (--force '
+                      'to replace it anyway)'.format(args.store, args.store),
+                      file=sys.stderr)
+            failed = stats['failed']
+        print(json.dumps(archive.stats()))
+    finally:
+        archive.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+import hashlib
+import importlib.util
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Iterable
+
+import metrics
+
+# The pipeline is among them: what it caches is its own parse result, with
+# the child tasks and fanned out records it builds. By name, since the
+# pipeline imports this module.
+PARSER_MODULES = ('parser_base', 'month_page_parser', 'meet_page_parser',
+                  'record_page_parser', 'pipeline')
+
+
+def parser_version(modules: Iterable[str] = PARSER_MODULES) -> str:
+    # Changes whenever the source of any parser module does, which
+    # invalidates everything cached by the previous code.
+    h = hashlib.sha256()
+    for name in modules:
+        with open(importlib.util.find_spec(name).origin, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+class ParseCache:
+    # Results of parsing a page, keyed by the page body and whatever else
+    # the parse depends on. Values are kept pickled, so every hit hands out
+    # fresh objects. The most recently used entries stay in memory; with a
+    # `path` they are also kept in SQLite across runs, bounded the same way:
+    # by count and by the bytes of the values.
+
+    def __init__(self,
+                 max_entries: int = 4096,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 path: str = None,
+                 version: str = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = version or parser_version()
+        self.entries: 'OrderedDict[str, bytes]' = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.conn = None
+        self.stored = 0
+        self.stored_bytes = 0
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            with self.conn:
+                self.conn.execute('''CREATE TABLE IF NOT EXISTS parses (
+                    key TEXT PRIMARY KEY,
+                    version TEXT NOT NULL,
+                    used_at REAL NOT NULL,
+                    value BLOB NOT NULL)''')
+                self.conn.execute(
+                    'CREATE INDEX IF NOT EXISTS parses_used_at '
+                    'ON parses(used_at)')
+                self.conn.execute('DELETE FROM parses WHERE version != ?',
+                                  (self.version, ))
+                self.stored, self.stored_bytes = self.conn.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) '
+                    'FROM parses').fetchone()
+                self.__trim()
+
+    def close(self):
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+    def key(self, body: bytes, *args) -> str:
+        # `args` must pickle the same way every time: strings, numbers and
+        # the parsers' own result types do.
+        h = hashlib.sha256(self.version.encode('ascii'))
+        h.update(hashlib.sha256(body).digest())
+        h.update(pickle.dumps(args, protocol=4))
+        return h.hexdigest()
+
+    def get(self, key: str) -> Any:
+        value = self.__get(key)
+        metrics.PARSE_CACHE_LOOKUPS.inc(
+            result='miss' if value is None else 'hit')
+        return pickle.loads(value) if value is not None else None
+
+    def __get(self, key: str) -> bytes:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                return value
+            if not self.conn:
+                return None
+            row = self.conn.execute('SELECT value FROM parses WHERE key = ?',
+                                    (key, )).fetchone()
+            if not row:
+                return None
+            with self.conn:
+                self.conn.execute(
+                    'UPDATE parses SET used_at = ? WHERE key = ?',
+                    (time.time(), key))
+            self.__remember(key, row[0])
+            return row[0]
+
+    def put(self, key: str, result: Any):
+        value = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.__remember(key, value)
+            if not self.conn:
+                return
+            with self.conn:
+                old = self.conn.execute(
+                    'SELECT LENGTH(value) FROM parses WHERE key = ?',
+                    (key, )).fetchone()
+                if old:
+                    self.stored -= 1
+                    self.stored_bytes -= old[0]
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO parses VALUES (?, ?, ?, ?)',
+                    (key, self.version, time.time(), value))
+                self.stored += 1
+                self.stored_bytes += len(value)
+                self.__trim()
+
+    def __trim(self):
+        # Drops the least recently used rows until the table is within
+        # both bounds again, keeping running totals rather than summing the
+        # table on every put.
+        if (self.stored <= self.max_entries
+                and self.stored_bytes <= self.max_bytes):
+            return
+        dropped = []
+        for key, size in self.conn.execute(
+                'SELECT key, LENGTH(value) FROM parses ORDER BY used_at'):
+            if (self.stored <= self.max_entries
+                    and self.stored_bytes <= self.max_bytes):
+                break
+            dropped.append((key, ))
+            self.stored -= 1
+            self.stored_bytes -= size
+        self.conn.executemany('DELETE FROM parses WHERE key = ?', dropped)
+
+    def __remember(self, key: str, value: bytes):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = value
+        self.size += len(value)
+        while self.entries and (len(self.entries) > self.max_entries
+                                or self.size > self.max_bytes):
+            self.size -= len(self.entries.popitem(last=False)[1])
+
+    def parse(self, body: bytes, parse: Callable[[], Any], *args) -> Any:
+        # Returns the cached result of parse() for this body and args, and
+        # runs it only on a miss.
+        key = self.key(body, *args)
+        result = self.get(key)
+        if result is None:
+            result = parse()
+            self.put(key, result)
+        return result
+
+    def __len__(self):
+        with self.lock:
+            if self.conn:
+                return self.conn.execute(
+                    'SELECT COUNT(*) FROM parses').fetchone()[0]
+            return len(self.entries)
@@ -1,8 +1,260 @@
+import re
+import time
 import unicodedata
+import weakref
+from collections.abc import Mapping
+from typing import Dict, Iterable, Iterator, Tuple
+
+import lxml.html
+from bs4 import BeautifulSoup, NavigableString
+from lxml import etree
+
+import metrics
+
+BACKENDS = ('bs4', 'lxml')
+
+CHARSET_PAT = re.compile(rb'<meta[^>]+charset=["\']?([-\w]+)', re.I)
+
+
+def sniff_encoding(body: bytes, default: str = 'utf-8') -> str:
+    m = CHARSET_PAT.search(body[:4096])
+    return m.group(1).decode('ascii') if m else default
+
+
+def read_source(source):
+    if hasattr(source, 'read'):
+        return source.read()
+    return source
+
+
+class QueryParams(Mapping):
+    # Immutable, interned query params. Every record of a race and age class
+    # shares one instance instead of carrying its own dict.
+
+    __slots__ = ('__items', '__dict', '__hash', '__weakref__')
+
+    __interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, params: Mapping = None):
+        if isinstance(params, QueryParams):
+            return params
+        items = tuple(dict(params or {}).items())
+        inst = cls.__interned.get(items)
+        if inst is None:
+            inst = super().__new__(cls)
+            inst.__items = items
+            inst.__dict = dict(items)
+            inst.__hash = hash(frozenset(items))
+            cls.__interned[items] = inst
+        return inst
+
+    def __getitem__(self, key):
+        return self.__dict[key]
+
+    def __iter__(self):
+        return iter(self.__dict)
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __hash__(self):
+        return self.__hash
+
+    def __reduce__(self):
+        return (QueryParams, (self.__dict, ))
+
+    def __repr__(self):
+        return repr(self.__dict)
+
+    def copy(self) -> Dict[str, str]:
+        return dict(self.__items)
 
 
 class Parser:
+    # Maps a backend name to the parser class implementing it. Every parser
+    # family fills this in at the bottom of its module.
+    backends = None
+    # Labels for the metrics of the page family and the backend
+    page_kind = None
+    backend = 'bs4'
+    _normalize_sec = 0.0
+    # Time a streaming parser spent waiting for its source, which is not
+    # parsing and is left out of the extract time
+    _source_sec = 0.0
+
+    @classmethod
+    def from_source(cls, source, *args, backend: str = 'bs4', **kwargs):
+        impl = cls.backends[backend]
+        return impl(
+            metrics.timed_load(impl.page_kind, backend, impl.load, source),
+            *args, **kwargs)
+
+    @staticmethod
+    def load(source):
+        return BeautifulSoup(source, 'lxml')
+
+    def _timed_source(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        it = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            chunk = next(it, None)
+            self._source_sec += time.perf_counter() - start
+            if chunk is None:
+                return
+            yield chunk
+
     def normalize(self, text: str) -> str:
         if not text:
             return text
-        return unicodedata.normalize('NFKC', text).replace('\n', '').strip()
+        # Most cells are ASCII, which NFKC leaves as it is.
+        if text.isascii():
+            return text.replace('\n', '').strip()
+        start = time.perf_counter()
+        text = unicodedata.normalize('NFKC', text).replace('\n', '').strip()
+        self._normalize_sec += time.perf_counter() - start
+        return text
+
+    # Tree access used by the extraction code. The default implementation
+    # walks a BeautifulSoup tree; LxmlTree overrides it for lxml.html.
+
+    # Lookups by tag alone walk the tree directly: setting up a bs4 filter
+    # costs more than the search itself on a table row.
+
+    def _find(self, el, tag: str, attrs: Dict[str, str] = None):
+        if not attrs:
+            return next(self._find_all(el, tag), None)
+        return el.find(tag, attrs=attrs)
+
+    def _find_all(self,
+                  el,
+                  tag: str,
+                  attrs: Dict[str, str] = None,
+                  recursive: bool = True) -> Iterable:
+        if attrs:
+            return el.find_all(tag, attrs=attrs, recursive=recursive)
+        return (e for e in (el.descendants if recursive else el.children)
+                if e.name == tag)
+
+    def _text(self, el) -> str:
+        c = el.contents
+        if len(c) == 1 and type(c[0]) is NavigableString:
+            return str(c[0])
+        return el.get_text()
+
+    def _has_only_attr(self, el, key: str, value: str) -> bool:
+        # True when `el`, or an element of the same tag inside it, has `key`
+        # as its only attribute.
+        attrs = {key: value}
+        if el.attrs == attrs:
+            return True
+        return any(e.attrs == attrs for e in el.find_all(el.name))
+
+
+class LxmlTree:
+    # Mixin that runs the extraction on an lxml.html tree with precompiled
+    # XPath instead of a BeautifulSoup tree.
+
+    backend = 'lxml'
+    xpaths = {}
+    parsers = {}
+
+    @staticmethod
+    def load(source):
+        body = read_source(source)
+        if isinstance(body, str):
+            return lxml.html.document_fromstring(body)
+        encoding = sniff_encoding(body)
+        parser = LxmlTree.parsers.get(encoding)
+        if not parser:
+            parser = lxml.html.HTMLParser(encoding=encoding)
+            LxmlTree.parsers[encoding] = parser
+        return lxml.html.document_fromstring(body, parser=parser)
+
+    @staticmethod
+    def _xpath(tag: str, keys: Iterable[str]) -> etree.XPath:
+        k = (tag, tuple(keys))
+        xp = LxmlTree.xpaths.get(k)
+        if not xp:
+            conds = ''.join(
+                '[@{}=$v{}]'.format(key, i) for i, key in enumerate(k[1]))
+            xp = etree.XPath('descendant::{}{}'.format(tag, conds))
+            LxmlTree.xpaths[k] = xp
+        return xp
+
+    def _find(self, el, tag: str, attrs: Dict[str, str] = None):
+        if not attrs:
+            return next(el.iterdescendants(tag), None)
+        found = self._find_all(el, tag, attrs)
+        return found[0] if found else None
+
+    def _find_all(self,
+                  el,
+                  tag: str,
+                  attrs: Dict[str, str] = None,
+                  recursive: bool = True) -> Iterable:
+        if not recursive:
+            return [c for c in el.iterchildren(tag)
+                    if not attrs or all(
+                        c.get(k) == v for k, v in attrs.items())]
+        if not attrs:
+            return el.iterdescendants(tag)
+        values = {'v{}'.format(i): v for i, v in enumerate(attrs.values())}
+        return self._xpath(tag, attrs.keys())(el, **values)
+
+    def _text(self, el) -> str:
+        if not len(el):
+            return el.text or ''
+        return el.text_content()
+
+    def _has_only_attr(self, el, key: str, value: str) -> bool:
+        for e in el.iter(el.tag):
+            if len(e.attrib) == 1 and e.get(key) == value:
+                return True
+        return False
+
+
+class PullTree:
+    # Feeds an HTML page to lxml's pull parser chunk by chunk and yields the
+    # elements named `tags` as each one closes. Elements may be taken out of
+    # the tree once they closed, which is what keeps memory bounded on long
+    # pages. The encoding is sniffed from the first bytes as in
+    # LxmlTree.load, which holds parsing back until a charset shows up or
+    # the first SNIFF_BYTES are in (as far as browsers look for one).
+
+    SNIFF_BYTES = 1024
+
+    def __init__(self, chunks: Iterable[bytes], tags: Tuple[str, ...]):
+        self.chunks = chunks
+        self.tags = tags
+
+    def __parser(self, head: bytes) -> etree.HTMLPullParser:
+        parser = etree.HTMLPullParser(events=('end', ),
+                                      tag=self.tags,
+                                      encoding=sniff_encoding(head))
+        # Elements get the lxml.html API (text_content() and the like).
+        parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+        return parser
+
+    def __iter__(self) -> Iterator:
+        parser = None
+        head = b''
+        for chunk in self.chunks:
+            if parser is None:
+                head += chunk
+                m = CHARSET_PAT.search(head)
+                # A match running to the end may be a name cut in two.
+                if len(head) < self.SNIFF_BYTES and not (
+                        m and m.end() < len(head)):
+                    continue
+                parser, chunk, head = self.__parser(head), head, b''
+            parser.feed(chunk)
+            for _, el in parser.read_events():
+                yield el
+        if parser is None:
+            if not head:
+                return
+            parser = self.__parser(head)
+            parser.feed(head)
+        parser.close()
+        for _, el in parser.read_events():
+            yield el
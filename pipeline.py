@@ -0,0 +1,257 @@
+import multiprocessing
+import os
+import queue
+import threading
+import urllib.parse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import metrics
+from fetcher import Fetcher
+from meet_page_parser import MeetPageParser, Race
+from month_page_parser import Meet, MonthPageParser
+from parse_cache import ParseCache
+from rate_limiter import HostRateLimiter
+from record_page_parser import Record, RecordPageParser
+
+logger = getLogger(__name__)
+
+# kind is one of 'site', 'month', 'meet', 'race' and 'class'. context holds
+# whatever the parse stage needs besides the page itself, and must pickle.
+Task = namedtuple('Task', ('kind', 'url', 'context'))
+
+# metrics carries what a worker process recorded while parsing, for the
+# parent to merge into its own registry.
+ParseResult = namedtuple('ParseResult', ('children', 'records', 'metrics'),
+                         defaults=(None, ))
+
+RecordsCallback = Callable[[Meet, Race, List[Record]], None]
+
+
+def page_url(base_url: str, q_params: Dict[str, str]) -> str:
+    params = dict(q_params)
+    return '{}?{}'.format(base_url + params.pop('action'),
+                          urllib.parse.urlencode(params))
+
+
+def parse_page(task: Task, body: bytes, base_url: str,
+               backend: str) -> ParseResult:
+    result = _parse_page(task, body, base_url, backend)
+    if multiprocessing.parent_process() is not None:
+        result = result._replace(metrics=metrics.REGISTRY.drain())
+    return result
+
+
+def _parse_page(task: Task, body: bytes, base_url: str,
+                backend: str) -> ParseResult:
+    # Runs in a worker process: everything in and out has to pickle.
+    if task.kind == 'site':
+        years = MonthPageParser.from_source(
+            body, backend=backend).get_available_years()
+        return ParseResult([
+            Task('month', '{}?{}'.format(
+                base_url, urllib.parse.urlencode({
+                    'Y': y,
+                    'M': m
+                })), (int(y), m)) for y in years or [] for m in range(1, 13)
+        ], [])
+    if task.kind == 'month':
+        year, month = task.context
+        meets = MonthPageParser.from_source(
+            body, year=year, month=month, backend=backend).get_meets()
+        return ParseResult([
+            Task('meet', page_url(base_url, m.q_params), m)
+            for m in meets or []
+        ], [])
+    if task.kind == 'meet':
+        races = MeetPageParser.from_source(body, backend=backend).get_races()
+        return ParseResult([
+            Task('race', page_url(base_url, r.q_params), (task.context, r))
+            for r in races
+        ], [])
+    if task.kind == 'race':
+        meet, race = task.context
+        p = RecordPageParser.from_source(body, backend=backend)
+        params = p.get_query_params()
+        classes = p.get_available_classes()
+        if not params:
+            params = dict(race.q_params)
+            params.pop('action', None)
+        if not classes:
+            classes = {'999': 'DUMMY'}  # Put the wildcard class
+        known = p.get_known_records(params, classes)
+        url = urllib.parse.urlsplit(task.url)
+        children = []
+        for cls, age_cls in classes.items():
+            if cls in known:
+                continue
+            cls_params = dict(params, Cls=cls)
+            children.append(
+                Task('class', urllib.parse.urlunsplit(
+                    url._replace(query=urllib.parse.urlencode(cls_params))),
+                     (meet, race, cls_params, age_cls)))
+        return ParseResult(children,
+                           [r for rs in known.values() for r in rs])
+    if task.kind == 'class':
+        meet, race, params, age_cls = task.context
+        p = RecordPageParser.from_source(
+            body, params, age_cls, backend=backend)
+        return ParseResult([], p.get_records() or [])
+    raise ValueError('Unknown task: {}'.format(task.kind))
+
+
+class Pipeline:
+    def __init__(self,
+                 base_url: str,
+                 fetch_workers: int = 4,
+                 parse_workers: int = None,
+                 queue_size: int = 32,
+                 rate: float = 1.0,
+                 burst: int = 1,
+                 fetcher: Fetcher = None,
+                 backend: str = 'lxml',
+                 parse_cache: ParseCache = None):
+        self.base_url = base_url
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.limiter = HostRateLimiter(rate=rate, burst=burst)
+        self.fetcher = fetcher or Fetcher()
+        self.backend = backend
+        self.parse_cache = parse_cache
+        self.failed: List[Tuple[Task, BaseException]] = []
+
+    def __fetch_loop(self, tasks: queue.Queue, pages: queue.Queue,
+                     results: queue.Queue, stop: threading.Event):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            if stop.is_set():
+                continue
+            try:
+                body = self.fetcher.cached(task.url)
+                if body is None:
+                    self.limiter.acquire(task.url)
+                    logger.info(task.url)
+                    body = self.fetcher.fetch(task.url)
+            except Exception as e:
+                results.put((task, None, e))
+                continue
+            # Blocks while the parse stage is behind: this is what keeps the
+            # fetchers from racing ahead and buffering the whole site.
+            pages.put((task, body))
+
+    def __dispatch_loop(self, pool: ProcessPoolExecutor, pages: queue.Queue,
+                        results: queue.Queue):
+        in_flight = threading.BoundedSemaphore(self.parse_workers * 2)
+        while True:
+            item = pages.get()
+            if item is None:
+                return
+            task, body = item
+            # A page parsed before, by the same parser code, is answered
+            # without going to the pool at all.
+            key = None
+            if self.parse_cache is not None:
+                key = self.parse_cache.key(body, task, self.base_url)
+                result = self.parse_cache.get(key)
+                if result is not None:
+                    results.put((task, result, None))
+                    continue
+            in_flight.acquire()
+            future = pool.submit(parse_page, task, body, self.base_url,
+                                 self.backend)
+
+            def done(f, task=task, key=key):
+                in_flight.release()
+                try:
+                    result = f.result()
+                except Exception as e:
+                    results.put((task, None, e))
+                    return
+                if key is not None:
+                    self.parse_cache.put(key, result._replace(metrics=None))
+                results.put((task, result, None))
+
+            future.add_done_callback(done)
+
+    def run(self,
+            seeds: Iterable[Task],
+            on_records: RecordsCallback = None) -> Dict[str, int]:
+        tasks = queue.Queue()
+        pages = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue()
+        stop = threading.Event()
+        stats = {'pages': 0, 'records': 0, 'failed': 0}
+        pending = 0
+        for t in seeds:
+            tasks.put(t)
+            pending += 1
+
+        # Workers are spawned rather than forked: the pool starts them from
+        # the dispatcher thread, and forking a threaded process is unsafe.
+        with ProcessPoolExecutor(
+                max_workers=self.parse_workers,
+                mp_context=multiprocessing.get_context('spawn')) as pool:
+            fetchers = [
+                threading.Thread(
+                    target=self.__fetch_loop,
+                    args=(tasks, pages, results, stop),
+                    daemon=True) for _ in range(self.fetch_workers)
+            ]
+            dispatcher = threading.Thread(
+                target=self.__dispatch_loop,
+                args=(pool, pages, results),
+                daemon=True)
+            for t in fetchers + [dispatcher]:
+                t.start()
+            try:
+                while pending:
+                    task, result, error = results.get()
+                    pending -= 1
+                    if error:
+                        logger.warning('%s failed: %r', task.url, error)
+                        self.failed.append((task, error))
+                        stats['failed'] += 1
+                        continue
+                    stats['pages'] += 1
+                    if result.metrics:
+                        metrics.REGISTRY.merge(result.metrics)
+                    for child in result.children:
+                        tasks.put(child)
+                        pending += 1
+                    if result.records:
+                        stats['records'] += len(result.records)
+                        if on_records:
+                            meet, race = task.context[:2]
+                            on_records(meet, race, result.records)
+            finally:
+                stop.set()
+                for _ in fetchers:
+                    tasks.put(None)
+                for t in fetchers:
+                    t.join()
+                pages.put(None)
+                dispatcher.join()
+        return stats
+
+
+def crawl_all(base_url: str,
+              on_records: RecordsCallback = None,
+              **kwargs) -> Dict[str, int]:
+    p = Pipeline(base_url, **kwargs)
+    return p.run([Task('site', base_url, None)], on_records)
+
+
+def crawl_records(base_url: str, record_page_params: Dict[str, str],
+                  **kwargs) -> List[Record]:
+    rs = []
+    p = Pipeline(base_url, **kwargs)
+    race = Race(q_params=dict(record_page_params))
+    p.run([
+        Task('race', page_url(base_url, record_page_params), (None, race))
+    ], lambda meet, race, records: rs.extend(records))
+    return rs
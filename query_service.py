@@ -0,0 +1,477 @@
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+
+import analytics
+from meet_page_parser import Sex, Style
+from month_page_parser import Course
+from results_store import Result, ResultsStore
+from swimmer_index import SwimmerIndex, display_name
+
+logger = getLogger(__name__)
+
+Reply = Tuple[int, bytes]
+
+
+class QueryError(ValueError):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class LruCache:
+    # Response bodies by request, the least recently used dropped first once
+    # there are more than `max_entries` of them or `max_bytes` in all.
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: 'OrderedDict[Tuple, bytes]' = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: Tuple) -> Optional[bytes]:
+        body = self.entries.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def put(self, key: Tuple, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = body
+        self.size += len(body)
+        while (len(self.entries) > self.max_entries
+               or self.size > self.max_bytes):
+            _, dropped = self.entries.popitem(last=False)
+            self.size -= len(dropped)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+def enum_param(params: Dict[str, str], key: str, enum):
+    value = params.get(key)
+    if not value:
+        return None
+    try:
+        return enum[value.upper()]
+    except KeyError:
+        raise QueryError(
+            HTTPStatus.BAD_REQUEST, '{} must be one of {}'.format(
+                key, ', '.join(e.name for e in enum)))
+
+
+def int_param(params: Dict[str, str],
+              key: str,
+              default: int = None,
+              lo: int = None,
+              hi: int = None) -> Optional[int]:
+    value = params.get(key)
+    if not value:
+        return default
+    try:
+        n = int(value)
+    except ValueError:
+        raise QueryError(HTTPStatus.BAD_REQUEST,
+                         '{} must be an integer'.format(key))
+    if (lo is not None and n < lo) or (hi is not None and n > hi):
+        raise QueryError(HTTPStatus.BAD_REQUEST,
+                         '{} must be in [{}, {}]'.format(key, lo, hi))
+    return n
+
+
+def date_param(params: Dict[str, str], key: str) -> Optional[datetime.date]:
+    value = params.get(key)
+    if not value:
+        return None
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise QueryError(HTTPStatus.BAD_REQUEST,
+                         '{} must be YYYY-MM-DD'.format(key))
+
+
+def filters(params: Dict[str, str]) -> Dict:
+    # The ResultsStore.query arguments a request may give.
+    return {
+        'sex': enum_param(params, 'sex', Sex),
+        'distance': int_param(params, 'distance', lo=1),
+        'style': enum_param(params, 'style', Style),
+        'course': enum_param(params, 'course', Course),
+        'year': int_param(params, 'year'),
+        'cls': params.get('cls') or None,
+        'age_cls': params.get('age_cls') or None,
+        'date_from': date_param(params, 'date_from'),
+        'date_to': date_param(params, 'date_to'),
+    }
+
+
+def result_json(r: Result) -> Dict:
+    return {
+        'id': r.record_id,
+        'meet': r.meet_name,
+        'date': r.date.isoformat() if r.date else None,
+        'venue': r.venue,
+        'course': r.course.name if r.course else None,
+        'sex': r.sex.name if r.sex else None,
+        'distance': r.distance,
+        'style': r.style.name if r.style else None,
+        'age_cls': r.record.age_cls,
+        'rank': r.record.rank,
+        'name': r.record.name,
+        'time_cs': r.record.record_cs,
+        'laps_cs': list(r.record.lap_cs) if r.record.lap_cs else [],
+    }
+
+
+def finite(values) -> List:
+    # NaN (a leg no one in the group has a split for) is not JSON.
+    return [
+        finite(v) if isinstance(v, list) else
+        (round(v, 3) if math.isfinite(v) else None) for v in values
+    ]
+
+
+class QueryService:
+    # Read-only JSON over HTTP/1.1 (keep-alive) on a results store:
+    #
+    #   /events?sex=F&distance=200&style=IM&...   results of an event, fastest
+    #                                             first
+    #   /swimmers/<name>                          a swimmer's results, oldest
+    #                                             first
+    #   /splits?sex=F&distance=200&style=IM&legs=4&by=age_cls
+    #                                             leg split and fade ratio
+    #                                             percentiles per group
+    #   /health                                   generation and row counts
+    #
+    # Lists page with `limit` and `offset`. Queries run on a pool of threads,
+    # each with a connection of its own; replies are kept in an LRU cache
+    # until the store's generation moves, which is polled every `poll_sec`.
+    # A move also brings the store's swimmer index (if it has one) up to
+    # date; swimmers are looked up by name as written while it is not.
+    # Requests for a reply being computed wait for it instead of computing
+    # it again.
+
+    def __init__(self,
+                 store_path: str,
+                 workers: int = 8,
+                 cache_entries: int = 1024,
+                 cache_bytes: int = 64 << 20,
+                 poll_sec: float = 1.0,
+                 page_size: int = 100,
+                 max_page_size: int = 1000):
+        self.store_path = store_path
+        self.executor = ThreadPoolExecutor(workers)
+        self.cache = LruCache(cache_entries, cache_bytes)
+        self.poll_sec = poll_sec
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.local = threading.local()
+        self.stores: List[ResultsStore] = []
+        self.lock = threading.Lock()
+        self.generation = None
+        self.pending: Dict[Tuple, asyncio.Future] = {}
+        self.poller = None
+        self.server = None
+
+    def __store(self) -> ResultsStore:
+        store = getattr(self.local, 'store', None)
+        if store is None:
+            store = self.local.store = ResultsStore(self.store_path)
+            self.local.index = SwimmerIndex(store, create=False)
+            with self.lock:
+                self.stores.append(store)
+        return store
+
+    async def __run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, fn, *args)
+
+    async def check_generation(self) -> bool:
+        # Drops the cached replies if the store changed. Returns whether it
+        # did.
+        generation = await self.__run(
+            lambda: self.__store().generation())
+        if generation == self.generation:
+            return False
+        try:
+            await self.__run(self.__update_index)
+        except Exception as e:
+            logger.warning('Updating the swimmer index failed: %r', e)
+        self.generation = generation
+        self.cache.clear()
+        return True
+
+    def __update_index(self):
+        self.__store()
+        index = self.local.index
+        if index.lag():
+            index.update()
+
+    async def __poll(self):
+        while True:
+            await asyncio.sleep(self.poll_sec)
+            try:
+                await self.check_generation()
+            except Exception as e:
+                logger.warning('Polling the store failed: %r', e)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8000):
+        await self.check_generation()
+        self.poller = asyncio.ensure_future(self.__poll())
+        self.server = await asyncio.start_server(self.__serve, host, port)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.poller is not None:
+            self.poller.cancel()
+        self.executor.shutdown()
+        with self.lock:
+            for store in self.stores:
+                store.close()
+            self.stores = []
+
+    async def reply(self, target: str) -> Reply:
+        # The status and JSON body for a GET of `target`.
+        u = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(u.query))
+        key = (u.path, tuple(sorted(params.items())))
+        body = self.cache.get(key)
+        if body is not None:
+            return HTTPStatus.OK, body
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.__compute(key, u.path,
+                                                          params))
+            self.pending[key] = future
+            future.add_done_callback(lambda f: self.pending.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def __compute(self, key: Tuple, path: str,
+                        params: Dict[str, str]) -> Reply:
+        generation = self.generation
+        try:
+            data = await self.__run(self.__route, path, params)
+        except QueryError as e:
+            return e.status, self.__json({'error': str(e)})
+        except Exception as e:
+            logger.warning('%s failed: %r', path, e)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, self.__json(
+                {'error': repr(e)})
+        body = self.__json(data)
+        # A reply computed while the store changed may be stale already.
+        if generation == self.generation:
+            self.cache.put(key, body)
+        return HTTPStatus.OK, body
+
+    @staticmethod
+    def __json(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
+
+    def __route(self, path: str, params: Dict[str, str]):
+        # Runs on the executor.
+        parts = [urllib.parse.unquote(p) for p in path.split('/') if p]
+        if parts == ['events']:
+            return self.events(params)
+        if len(parts) == 2 and parts[0] == 'swimmers':
+            return self.swimmer(parts[1], params)
+        if parts == ['splits']:
+            return self.splits(params)
+        if parts in ([], ['health']):
+            store = self.__store()
+            return {
+                'generation': store.generation(),
+                'counts': store.counts()
+            }
+        raise QueryError(HTTPStatus.NOT_FOUND, 'No such path: ' + path)
+
+    def __page(self, params: Dict[str, str]) -> Tuple[int, int]:
+        return (int_param(params, 'limit', self.page_size, 1,
+                          self.max_page_size),
+                int_param(params, 'offset', 0, 0))
+
+    @staticmethod
+    def __paged(results: List[Result], limit: int, offset: int) -> Dict:
+        # `results` holds one more row than the page when there is a next.
+        return {
+            'results': [result_json(r) for r in results[:limit]],
+            'offset': offset,
+            'limit': limit,
+            'next': offset + limit if len(results) > limit else None,
+        }
+
+    def events(self, params: Dict[str, str]) -> Dict:
+        f = filters(params)
+        if not (f['distance'] and f['style']):
+            raise QueryError(HTTPStatus.BAD_REQUEST,
+                             'distance and style are required')
+        limit, offset = self.__page(params)
+        results = self.__store().query(limit=limit + 1, offset=offset, **f)
+        return self.__paged(results, limit, offset)
+
+    def swimmer(self, name: str, params: Dict[str, str]) -> Dict:
+        limit, offset = self.__page(params)
+        store = self.__store()
+        ids = None
+        if self.local.index.lag() == 0:
+            ids = [p.record_id for p in self.local.index.lookup(name)
+                   ][offset:offset + limit + 1]
+        if ids:
+            found = {r.record_id: r for r in store.query(record_ids=ids)}
+            results = [found[i] for i in ids if i in found]
+        else:
+            # The swimmer index is not built (or not up to date): the name
+            # as written, oldest first.
+            results = sorted(
+                store.query(name=display_name(name)),
+                key=lambda r: (r.date is None, r.date or datetime.date.min,
+                               r.record_id))[offset:offset + limit + 1]
+        return dict(self.__paged(results, limit, offset),
+                    name=display_name(name))
+
+    def splits(self, params: Dict[str, str]) -> Dict:
+        f = filters(params)
+        if not (f['distance'] and f['style']):
+            raise QueryError(HTTPStatus.BAD_REQUEST,
+                             'distance and style are required')
+        legs = int_param(params, 'legs', 4, 1, 64)
+        by = tuple(b for b in (params.get('by') or 'age_cls').split(',')
+                   if b)
+        if not set(by) <= {'age_cls', 'sex'}:
+            raise QueryError(HTTPStatus.BAD_REQUEST,
+                             'by must be age_cls, sex or both')
+        q = (10, 25, 50, 75, 90)
+        results = self.__store().query(**f)
+        m = analytics.from_results(results)
+        legs_pct = analytics.percentiles(analytics.leg_splits(m, legs), m, q,
+                                         by)
+        fade_pct = analytics.percentiles(analytics.fade_ratio(m), m, q, by)
+        keys, inverse = analytics.groups(m, by)
+        return {
+            'count': len(results),
+            'legs': legs,
+            'percentiles': list(q),
+            'groups': [{
+                'key': dict(zip(by, key)),
+                'count': int((inverse == i).sum()),
+                'legs_cs': finite(legs_pct[key].T.tolist()),
+                'fade_ratio': finite(fade_pct[key].tolist()),
+            } for i, key in enumerate(keys)],
+        }
+
+    async def __serve(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    await self.__send(writer, HTTPStatus.BAD_REQUEST,
+                                      self.__json({'error': 'Bad request'}),
+                                      False)
+                    break
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b'\r\n', b'\n', b''):
+                        break
+                    k, _, v = h.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip().lower()
+                if headers.get('content-length'):
+                    await reader.readexactly(int(headers['content-length']))
+                keep_alive = (headers.get('connection') != 'close'
+                              if version == 'HTTP/1.1' else
+                              headers.get('connection') == 'keep-alive')
+                if method not in ('GET', 'HEAD'):
+                    status, body = HTTPStatus.METHOD_NOT_ALLOWED, self.__json(
+                        {'error': 'Only GET'})
+                else:
+                    status, body = await self.reply(target)
+                await self.__send(writer, status, body, keep_alive,
+                                  method == 'HEAD')
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def __send(writer: asyncio.StreamWriter,
+                     status: int,
+                     body: bytes,
+                     keep_alive: bool,
+                     head_only: bool = False):
+        writer.write(('HTTP/1.1 {} {}\r\n'
+                      'Content-Type: application/json; charset=utf-8\r\n'
+                      'Content-Length: {}\r\n'
+                      'Connection: {}\r\n\r\n').format(
+                          int(status),
+                          HTTPStatus(status).phrase, len(body),
+                          'keep-alive' if keep_alive else 'close').encode(
+                              'latin-1'))
+        if not head_only:
+            writer.write(body)
+        await writer.drain()
+
+
+async def serve(args: argparse.Namespace):
+    service = QueryService(args.store, args.workers, args.cache_entries,
+                           poll_sec=args.poll)
+    server = await service.start(args.host, args.port)
+    print('Serving {} on http://{}:{}/'.format(args.store, args.host,
+                                               args.port))
+    try:
+        await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main(argv: List[str] = None):
+    ap = argparse.ArgumentParser(
+        description='Serve a results store as JSON over HTTP.')
+    ap.add_argument('store', nargs='?', default='results.sqlite3')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8000)
+    ap.add_argument('--workers', type=int, default=8,
+                    help='threads running queries')
+    ap.add_argument('--cache-entries', type=int, default=1024)
+    ap.add_argument('--poll', type=float, default=1.0,
+                    help='seconds between checks for new crawl batches')
+    args = ap.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
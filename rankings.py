@@ -0,0 +1,195 @@
+import datetime
+import threading
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from meet_page_parser import Race, Sex, Style
+from month_page_parser import Course, Meet
+from record_page_parser import Record
+from results_store import ResultsStore, meet_key
+
+RankingKey = namedtuple(
+    'RankingKey', ('sex', 'distance', 'style', 'course', 'age_cls', 'season'))
+
+Entry = namedtuple('Entry', ('time_cs', 'name'))
+
+# Identifies a record across crawls the way ResultsStore does: the meet
+# (Y, M, G), the race (P) and the record (Cls, rank, name).
+RecordKey = Tuple[int, int, str, str, str, int, str]
+
+
+def season(date: datetime.date) -> int:
+    # Japanese swimming seasons run from April to March and are named after
+    # the year they start in.
+    return date.year if date.month >= 4 else date.year - 1
+
+
+class Ranking:
+    # Times of one event, age class and season, kept sorted so that every
+    # question is a binary search. `names` is parallel to `times`. New
+    # entries wait in a buffer and are merged in one pass over the arrays,
+    # before the next question or once MERGE_AT of them have piled up.
+
+    MERGE_AT = 4096
+
+    def __init__(self):
+        self.times = np.empty(0, dtype=np.int32)
+        self.names = np.empty(0, dtype=object)
+        self.pending_times: List[int] = []
+        self.pending_names: List[str] = []
+
+    def __len__(self):
+        return len(self.times) + len(self.pending_times)
+
+    def add(self, times: List[int], names: List[str]):
+        self.pending_times += times
+        self.pending_names += names
+        if len(self.pending_times) >= self.MERGE_AT:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_times:
+            return
+        order = np.argsort(self.pending_times, kind='stable')
+        times = np.asarray(self.pending_times, dtype=np.int32)[order]
+        names = np.array(self.pending_names, dtype=object)[order]
+        self.pending_times, self.pending_names = [], []
+        pos = np.searchsorted(self.times, times, 'right')
+        self.times = np.insert(self.times, pos, times)
+        self.names = np.insert(self.names, pos, names)
+
+    def remove(self, time_cs: int, name: str) -> bool:
+        self.flush()
+        lo = self.times.searchsorted(np.int32(time_cs), 'left')
+        hi = self.times.searchsorted(np.int32(time_cs), 'right')
+        for i in range(lo, hi):
+            if self.names[i] == name:
+                self.times = np.delete(self.times, i)
+                self.names = np.delete(self.names, i)
+                return True
+        return False
+
+    def __faster(self, time_cs: int) -> int:
+        self.flush()
+        # Searching with a Python int would cast the whole array first.
+        return int(self.times.searchsorted(np.int32(time_cs), 'left'))
+
+    def rank(self, time_cs: int) -> int:
+        # The place `time_cs` would have taken: ties share the place.
+        return self.__faster(time_cs) + 1
+
+    def percentile(self, time_cs: int) -> Optional[float]:
+        # Share of the times `time_cs` is as fast as or faster than
+        if not len(self):
+            return None
+        faster = self.__faster(time_cs)
+        return 100.0 * (len(self.times) - faster) / len(self.times)
+
+    def top(self, k: int = 10) -> List[Entry]:
+        self.flush()
+        return [
+            Entry(int(t), n) for t, n in zip(self.times[:k], self.names[:k])
+        ]
+
+
+class Rankings:
+    # Rankings of every event, age class and season seen so far. add() has
+    # the signature of the crawlers' on_records callback; a record crawled
+    # again replaces its earlier time instead of counting twice.
+
+    def __init__(self):
+        self.rankings: Dict[RankingKey, Ranking] = {}
+        self.entries: Dict[RecordKey, Tuple[RankingKey, int]] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_store(cls, store: ResultsStore) -> 'Rankings':
+        rankings = cls()
+        with store.lock:
+            rows = store.conn.execute(
+                'SELECT m.year, m.month, m.g, ra.p, r.cls, r.rank, r.name, '
+                'r.record_cs, r.age_cls, ra.sex, ra.distance, ra.style, '
+                'm.course, m.start_date FROM records r '
+                'JOIN races ra ON ra.id = r.race_id '
+                'JOIN meets m ON m.id = ra.meet_id '
+                'WHERE r.record_cs IS NOT NULL').fetchall()
+        rankings.__merge(
+            (tuple(row[:7]), RankingKey(
+                Sex[row[9]] if row[9] else None, row[10],
+                Style[row[11]] if row[11] else None,
+                Course[row[12]] if row[12] else None, row[8],
+                season(datetime.date.fromisoformat(row[13]) if row[13] else
+                       datetime.date(row[0], row[1], 1))), row[7])
+            for row in rows)
+        return rankings
+
+    def add(self,
+            meet: Meet = None,
+            race: Race = None,
+            records: Iterable[Record] = ()) -> int:
+        # Records without a time (DNS, DQ) or whose race is unknown are
+        # left out. Returns the number of records ranked.
+        if race is None:
+            return 0
+        return self.__merge(self.__entries(meet, race, records))
+
+    def __entries(self, meet: Optional[Meet], race: Race,
+                  records: Iterable[Record]):
+        course = meet.course if meet else None
+        date = min(meet.dates) if meet and meet.dates else None
+        for r in records:
+            key = meet_key(r.q_params or {})
+            if r.record_cs is None or not key:
+                continue
+            q = r.q_params
+            yield (key + (q.get('P'), q.get('Cls') or '', r.rank or 0,
+                          r.name or ''),
+                   RankingKey(race.sex, race.distance or None, race.style,
+                              course, r.age_cls,
+                              season(date or datetime.date(key[0], key[1],
+                                                           1))),
+                   r.record_cs)
+
+    def __merge(self, entries) -> int:
+        # Removals happen in place; additions are collected per ranking and
+        # merged in one go.
+        latest = {rkey: (key, time_cs) for rkey, key, time_cs in entries}
+        n = 0
+        batches: Dict[RankingKey, Tuple[List[int], List[str]]] = {}
+        with self.lock:
+            for rkey, (key, time_cs) in latest.items():
+                old = self.entries.get(rkey)
+                if old == (key, time_cs):
+                    continue
+                if old:
+                    self.rankings[old[0]].remove(old[1], rkey[-1])
+                self.entries[rkey] = (key, time_cs)
+                times, names = batches.setdefault(key, ([], []))
+                times.append(time_cs)
+                names.append(rkey[-1])
+                n += 1
+            for key, (times, names) in batches.items():
+                self.rankings.setdefault(key, Ranking()).add(times, names)
+        return n
+
+    def get(self, key: RankingKey) -> Ranking:
+        with self.lock:
+            ranking = self.rankings.get(key)
+            if ranking is None:
+                return Ranking()
+            ranking.flush()
+            return ranking
+
+    def keys(self) -> List[RankingKey]:
+        return list(self.rankings)
+
+    def rank(self, key: RankingKey, time_cs: int) -> int:
+        return self.get(key).rank(time_cs)
+
+    def percentile(self, key: RankingKey, time_cs: int) -> Optional[float]:
+        return self.get(key).percentile(time_cs)
+
+    def top(self, key: RankingKey, k: int = 10) -> List[Entry]:
+        return self.get(key).top(k)
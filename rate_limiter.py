@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+import urllib.parse
+import urllib.request
+from typing import Callable, Dict, Union
+
+import metrics
+
+
+class TokenBucket:
+    def __init__(self,
+                 rate: float,
+                 burst: int = 1,
+                 clock: Callable[[], float] = time.monotonic):
+        if rate <= 0:
+            raise ValueError('rate must be positive: {}'.format(rate))
+        if burst < 1:
+            raise ValueError('burst must be at least 1: {}'.format(burst))
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # Take a token now and return how long the caller has to wait before
+        # it may be spent. Tokens can go negative so that waiters are served
+        # in the order they reserved.
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+def host_of(url: Union[str, urllib.request.Request]) -> str:
+    if isinstance(url, urllib.request.Request):
+        url = url.get_full_url()
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+class HostRateLimiter:
+    def __init__(self,
+                 rate: float,
+                 burst: int = 1,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, url: Union[str, urllib.request.Request]) -> TokenBucket:
+        host = host_of(url)
+        with self.lock:
+            b = self.buckets.get(host)
+            if not b:
+                b = TokenBucket(self.rate, self.burst, self.clock)
+                self.buckets[host] = b
+            return b
+
+    def acquire(self, url: Union[str, urllib.request.Request]) -> float:
+        wait = self.bucket(url).acquire()
+        metrics.THROTTLE_SECONDS.observe(wait)
+        return wait
+
+    async def acquire_async(self,
+                            url: Union[str, urllib.request.Request]) -> float:
+        wait = await self.bucket(url).acquire_async()
+        metrics.THROTTLE_SECONDS.observe(wait)
+        return wait
@@ -1,16 +1,34 @@
+import itertools
 import re
+import sys
 import urllib.request
+from array import array
 from datetime import timedelta
 from enum import Enum
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, Optional
 
 from bs4 import BeautifulSoup
 from bs4.element import Tag
 
-from parser_base import Parser
+import metrics
+from parser_base import LxmlTree, Parser, PullTree, QueryParams
+
+
+def to_centiseconds(td: timedelta) -> int:
+    return (td.days * 86400 + td.seconds) * 100 + td.microseconds // 10000
+
+
+def to_timedelta(cs: int) -> timedelta:
+    return timedelta(milliseconds=cs * 10)
 
 
 class Record:
+    # Times and laps are kept as integer centiseconds; `record` and `lap`
+    # build timedelta views on access.
+
+    __slots__ = ('_age_cls', 'rank', 'name', 'record_cs', 'lap_cs',
+                 '_q_params')
+
     def __init__(self,
                  age_cls: str = None,
                  rank: int = 0,
@@ -25,6 +43,87 @@ class Record:
         self.name = name
         self.q_params = q_params
 
+    @property
+    def age_cls(self) -> str:
+        return self._age_cls
+
+    @age_cls.setter
+    def age_cls(self, age_cls: str):
+        self._age_cls = sys.intern(age_cls) if age_cls else age_cls
+
+    @property
+    def q_params(self) -> QueryParams:
+        return self._q_params
+
+    @q_params.setter
+    def q_params(self, q_params: Dict[str, str]):
+        self._q_params = QueryParams(
+            q_params) if q_params is not None else None
+
+    @property
+    def record(self) -> timedelta:
+        if self.record_cs is None:
+            return None
+        return to_timedelta(self.record_cs)
+
+    @record.setter
+    def record(self, record: timedelta):
+        self.record_cs = to_centiseconds(
+            record) if record is not None else None
+
+    @property
+    def lap(self) -> List[timedelta]:
+        if self.lap_cs is None:
+            return None
+        return [to_timedelta(cs) for cs in self.lap_cs]
+
+    @lap.setter
+    def lap(self, lap: List[timedelta]):
+        if lap is None:
+            self.lap_cs = None
+        else:
+            self.lap_cs = array('i', (to_centiseconds(l) for l in lap))
+
+    def __getstate__(self):
+        return (self._age_cls, self.rank, self.name, self.record_cs,
+                self.lap_cs.tobytes() if self.lap_cs is not None else None,
+                self._q_params)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):  # Pickled before Record had slots
+            self.__init__(**state)
+            return
+        age_cls, self.rank, self.name, self.record_cs, laps, q_params = state
+        self.age_cls = age_cls
+        self.lap_cs = array('i', laps) if laps is not None else None
+        self.q_params = q_params
+
+    def to_dict(self) -> Dict:
+        return {
+            'age_cls': self.age_cls,
+            'rank': self.rank,
+            'name': self.name,
+            'record_cs': self.record_cs,
+            'lap_cs': list(self.lap_cs) if self.lap_cs is not None else None,
+            'q_params': dict(self.q_params) if self.q_params else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> 'Record':
+        r = cls(age_cls=d.get('age_cls'),
+                rank=d.get('rank', 0),
+                name=d.get('name'),
+                q_params=d.get('q_params'))
+        r.record_cs = d.get('record_cs')
+        if d.get('lap_cs') is not None:
+            r.lap_cs = array('i', d['lap_cs'])
+        return r
+
+    def __eq__(self, other):
+        if not isinstance(other, Record):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
     def __str__(self):
         ret = 'age_cls={}, rank={}, name={}, record={}, lap=['.format(
             self.age_cls, self.rank, self.name, str(self.record))
@@ -42,20 +141,19 @@ class Record:
 
     def set_record(self, mins: int = 0, secs: int = 0,
                    one_tenth_secs: int = 0):
-        self.record = timedelta(
-            minutes=mins, seconds=secs, milliseconds=one_tenth_secs * 10)
+        self.record_cs = (mins * 60 + secs) * 100 + one_tenth_secs
 
     def add_lap(self, mins: int = 0, secs: int = 0, one_tenth_secs: int = 0):
-        if not self.lap:
-            self.lap = []
-        self.lap.append(
-            timedelta(
-                minutes=mins, seconds=secs, milliseconds=one_tenth_secs * 10))
+        if not self.lap_cs:
+            self.lap_cs = array('i')
+        self.lap_cs.append((mins * 60 + secs) * 100 + one_tenth_secs)
     
     def set_name(self, name: str=""):
         self.name= name
 
 class RecordPageParser(Parser):
+    page_kind = 'record'
+
     def __init__(self,
                  page: Tag,
                  q_params: Dict[str, str] = None,
@@ -63,143 +161,251 @@ class RecordPageParser(Parser):
         self.page = page
         self.q_params = q_params
         self.age_cls = age_cls
+        # Shared by every record built from this page
+        self.__q_params = QueryParams(
+            q_params) if q_params is not None else None
+        self.__age_cls = sys.intern(age_cls) if age_cls else age_cls
+        self.__class_rows = 0
 
     def get_query_params(self) -> Dict[str, str]:
-        form = self.page.find('form', attrs={'name': 'formclasslist'})
-        if not form:
+        form = self._find(self.page, 'form', attrs={'name': 'formclasslist'})
+        if form is None:
             return None
         params = {}
-        for input in form.find_all('input', attrs={'type': 'hidden'}):
+        for input in self._find_all(form, 'input', attrs={'type': 'hidden'}):
             params[input.get('name')] = input.get('value')
         return params
 
     def get_available_classes(self) -> Dict[str, str]:
-        form = self.page.find('form', attrs={'name': 'formclasslist'})
-        if not form:
+        form = self._find(self.page, 'form', attrs={'name': 'formclasslist'})
+        if form is None:
             return None
-        select = form.find('select')
-        if not select:
+        select = self._find(form, 'select')
+        if select is None:
             return None
         classes = {}
-        for c in select.find_all('option'):
+        for c in self._find_all(select, 'option'):
             value = c.get('value')
             if value == '999':  # Wildcard
                 continue
-            classes[value] = self.normalize(c.get_text())
+            classes[value] = self.normalize(self._text(c))
         return classes
 
+    def get_selected_class(self) -> Optional[str]:
+        # The class the page shows, as the browser would submit it
+        form = self._find(self.page, 'form', attrs={'name': 'formclasslist'})
+        select = self._find(form, 'select') if form is not None else None
+        if select is None:
+            return None
+        options = list(self._find_all(select, 'option'))
+        for c in options:
+            if c.get('selected') is not None:
+                return c.get('value')
+        return options[0].get('value') if options else None
+
     def get_records(self) -> List[Record]:
-        for t in self.page.find_all('table'):
+        for t in self._find_all(self.page, 'table'):
             if not self.has_records(t):
                 continue
-            return self.__get_records(t)
+            return list(metrics.timed_rows(self.__iter_records(self.__rows(t)),
+                                           self))
+        metrics.empty_page(self)
         return None
 
+    def iter_records(self) -> Iterator[Record]:
+        for t in self._find_all(self.page, 'table'):
+            if not self.has_records(t):
+                continue
+            yield from metrics.timed_rows(self.__iter_records(self.__rows(t)),
+                                          self)
+            return
+        metrics.empty_page(self)
+
+    @classmethod
+    def iter_stream(cls,
+                    chunks: Iterable[bytes],
+                    q_params: Dict[str, str] = None,
+                    age_cls: str = None) -> Iterator[Record]:
+        # Streaming mode, on lxml: the page is parsed as its chunks arrive,
+        # each record is yielded as soon as its row (lap table included)
+        # closed, and rows are dropped from the tree once read.
+        p = LxmlRecordPageParser(None, q_params, age_cls)
+        rows = p.__stream_rows(PullTree(p._timed_source(chunks), ('th', 'tr')))
+        return metrics.timed_rows(p.__iter_records(rows), p)
+
+    def __stream_rows(self, tree: PullTree) -> Iterator:
+        # The rows of the first table has_records() would accept, taken out
+        # of the tree as they close. Nested lap tables close inside theirs.
+        table = None
+        for el in tree:
+            if el.tag == 'th':
+                t = next(el.iterancestors('table'), None)
+                if (table is None and t is not None
+                        and self._find(t, 'th') is el
+                        and self._text(el) == '順位'):
+                    table = t
+            elif table is not None and el.getparent() is table:
+                table.remove(el)
+                yield el
+
+    def __rows(self, table: Tag) -> Iterable:
+        return self._find_all(table, 'tr', recursive=False)
+
+    def get_records_by_class(
+            self,
+            classes: Dict[str, str]) -> Optional[Dict[str, List[Record]]]:
+        # For the wildcard page (Cls=999) listing every class in one table,
+        # each under a row holding just the class name: the records of each
+        # of `classes` (as get_available_classes returns them), as if read
+        # from that class's own page. None when the page has no such rows.
+        labels = {self.normalize(v): k for k, v in classes.items()}
+        for t in self._find_all(self.page, 'table'):
+            if not self.has_records(t):
+                continue
+            ret = {cls: [] for cls in classes}
+            self.__class_rows = 0
+            for r in metrics.timed_rows(
+                    self.__iter_records(self.__rows(t), labels), self):
+                if not self.__class_rows:
+                    # A record above every class row is in no known class
+                    return None
+                ret[r.q_params['Cls']].append(r)
+            return ret if self.__class_rows else None
+        metrics.empty_page(self)
+        return None
+
+    def get_known_records(self, params: Dict[str, str],
+                          classes: Dict[str, str]) -> Dict[str, List[Record]]:
+        # The records a race page fetched with `params` already shows, by
+        # class: its own class, or every class when it is the wildcard page
+        # and lists them under class rows. Other classes need their own page.
+        cls = params.get('Cls') or self.get_selected_class()
+        params = dict(params, Cls=cls)
+        if cls in classes:
+            p = type(self)(self.page, params, classes[cls])
+            return {cls: p.get_records() or []}
+        if cls == '999':
+            return type(self)(self.page,
+                              params).get_records_by_class(classes) or {}
+        return {}
+
     def has_records(self, table: Tag) -> bool:
-        th = table.find('th')
-        if th and th.get_text() == '順位':
+        th = self._find(table, 'th')
+        if th is not None and self._text(th) == '順位':
             return True
         return False
 
     RECORD_PAT = re.compile(r'([0-9]{0,2}):{0,1}([0-9]{2}).([0-9]{2})')
+    DIGITS_PAT = re.compile(r'^\d+$')
+
+    RowType = Enum('RowType', ('RECORD', 'LAP', 'CLASS'))
 
-    RowType = Enum('RowType', ('RECORD', 'LAP'))
+    # Rows buffered before the first record is emitted: a table has laps
+    # when one of its first rows is a lap row.
+    LOOKAHEAD = 3
 
-    def __init_record(self):
-        return Record(q_params=self.q_params.copy(), age_cls=self.age_cls)
+    def __iter_records(self, trs: Iterable,
+                       labels: Dict[str, str] = None) -> Iterator[Record]:
+        # One pass over the rows. The record being filled is the state: a
+        # record row sets its rank, name and time, a lap row adds the splits
+        # of its nested table, and the record is emitted once it is complete
+        # (it has laps in a lap table, a time otherwise). With `labels`, a
+        # row naming a class starts the records of that class.
+        RowType = self.__class__.RowType
+        rows = self.__iter_rows(trs, labels)
+        head = self.__lookahead(rows)
+        has_laps = any(rt is RowType.LAP for _, rt, _ in head)
 
-    def __get_records(self, table: Tag) -> List[Record]:
-        rs = []
-        r = self.__init_record()
-        isLap = False
-        for idx,tr in enumerate(table.find_all('tr', recursive=False)): ##//written by taoka on 2023/02/20 
-            if idx==3: #lapありなしを判定
-                break
-            rt = self.__get_row_type(tr)
-            if not rt:
+        q_params, age_cls = self.__q_params, self.__age_cls
+        r = Record(q_params=q_params, age_cls=age_cls)
+        for tr, rt, txt in itertools.chain(head, rows):
+            if rt is None:
                 continue
-            #print("idx",idx,"rt is ,,,,",rt,tr)
-            if rt == self.__class__.RowType.LAP:
-                isLap = True
-
-        for tr in table.find_all('tr', recursive=False):
-            #print(tr)
-            rt = self.__get_row_type(tr)
-            if not rt:
+            if rt is RowType.CLASS:
+                q_params = QueryParams(dict(self.q_params or {},
+                                            Cls=labels[txt]))
+                age_cls = sys.intern(txt)
+                r = Record(q_params=q_params, age_cls=age_cls)
+                self.__class_rows += 1
                 continue
-            #print("rt is ,,,,",rt,tr)
-            if rt == self.__class__.RowType.RECORD:
-                #print(tr)
-                name=""
-                for i, td in enumerate(tr.find_all('td')):
-                    txt = self.normalize(td.get_text())
-                    if not txt:
-                        continue
-                    #print("txt is ...",txt)
-                    #print("td is ...",td)
-                    if '<td valign="top">' in str(td) and not name:
-                        name=td.text
-                        #print("name",name)
-                    r.set_name(name)
-                    if i == 0:
-                        r.rank = int(txt)
-                    m = self.__class__.RECORD_PAT.match(txt)
-                    #print("m is ...",m)
-                    if not m:
-                        continue
-                    #print("m is ...",m)
-                    # if len(m.group(1)) > 0:
-                    #     print("m.group(1)",m.group(1))
-                    # print("m.group(2)",m.group(2))
-                    # print("m.group(3)",m.group(3))
-                    r.set_record(
-                        mins=int(m.group(1)) if len(m.group(1)) > 0 else 0,
-                        secs=int(m.group(2)),
-                        one_tenth_secs=int(m.group(3))) #r.recordを作る
-                    #if td.get('valign'):
-                    #print("r.record is ...\n",r.record)
-            elif rt == self.__class__.RowType.LAP:
-                rt = tr.find('table')
-                if not rt:
+            if rt is RowType.RECORD:
+                self.__read_record_row(tr, r)
+            else:
+                laps = self._find(tr, 'table')
+                if laps is None:
                     continue
-                for td in rt.find_all('td'):
-                    txt = self.normalize(td.get_text())
-                    if not txt:
-                        continue
-                    m = self.__class__.RECORD_PAT.match(txt)
-                    if not m:
-                        continue
-                    r.add_lap(
-                        mins=int(m.group(1)) if len(m.group(1)) > 0 else 0,
-                        secs=int(m.group(2)),
-                        one_tenth_secs=int(m.group(3)))
-                    #print("r.lap is ...\n",r.lap)
-            # Store the previous record before processing this new record
-            if isLap:
-                if r.lap:
-                    rs.append(r)
-                    r = self.__init_record()
-                #print(r.record)
+                self.__read_laps(laps, r)
+            if r.lap_cs if has_laps else r.record_cs:
+                yield r
+                r = Record(q_params=q_params, age_cls=age_cls)
+
+    def __lookahead(self, rows: Iterator) -> List:
+        # The first LOOKAHEAD rows, class rows aside
+        head = []
+        n = 0
+        for row in rows:
+            head.append(row)
+            if row[1] is not self.__class__.RowType.CLASS:
+                n += 1
+                if n == self.LOOKAHEAD:
+                    break
+        return head
+
+    def __iter_rows(self, trs: Iterable, labels: Dict[str, str] = None):
+        # (tr, row type, normalized text of its first cell)
+        for tr in trs:
+            td = self._find(tr, 'td')  # Get 1st td
+            if td is None:
+                yield tr, None, None
+                continue
+            txt = self.normalize(self._text(td))
+            if txt and self.DIGITS_PAT.match(txt):
+                yield tr, self.__class__.RowType.RECORD, txt
+            elif labels and txt in labels:
+                yield tr, self.__class__.RowType.CLASS, txt
             else:
-                if r.record:
-                    rs.append(r)
-                    r = self.__init_record()
-        #print("rs is ...",rs)
-        return rs
-
-    def __get_row_type(self, tr: Tag) -> RowType:
-        td = tr.find('td')  # Get 1st td
-        #print(" Get 1st td",td)
-        if not td:
-            return None
-        txt = self.normalize(td.get_text())
-        #print(" Get 1st td_txt",txt)
-        pattern = r'^\d+$'  # 数字以外の文字を含まない文字列にマッチする正規表現パターン
-        #if txt and re.match('[0-9]+', txt):
-        if txt and re.match(pattern, txt):
-            return self.__class__.RowType.RECORD
-        else:
-            return self.__class__.RowType.LAP
+                yield tr, self.__class__.RowType.LAP, txt
+
+    @staticmethod
+    def __centiseconds(m) -> int:
+        return (int(m.group(1) or 0) * 60 + int(m.group(2))) * 100 + int(
+            m.group(3))
+
+    def __read_record_row(self, tr: Tag, r: Record):
+        # The rank is the first cell, the name the first one with nothing
+        # but valign="top", and the time the last cell that reads as one.
+        name = ''
+        for i, td in enumerate(self._find_all(tr, 'td')):
+            text = self._text(td)
+            txt = self.normalize(text)
+            if not txt:
+                continue
+            if not name and self._has_only_attr(td, 'valign', 'top'):
+                name = text
+            r.name = name
+            if i == 0:
+                r.rank = int(txt)
+            m = self.RECORD_PAT.match(txt)
+            if m:
+                r.record_cs = self.__centiseconds(m)
+
+    def __read_laps(self, table: Tag, r: Record):
+        for td in self._find_all(table, 'td'):
+            m = self.RECORD_PAT.match(self.normalize(self._text(td)) or '')
+            if m:
+                if not r.lap_cs:
+                    r.lap_cs = array('i')
+                r.lap_cs.append(self.__centiseconds(m))
+
+
+class LxmlRecordPageParser(LxmlTree, RecordPageParser):
+    pass
+
+
+RecordPageParser.backends = {
+    'bs4': RecordPageParser,
+    'lxml': LxmlRecordPageParser
+}
 
 
 if __name__ == '__main__':
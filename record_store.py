@@ -0,0 +1,174 @@
+import json
+import os
+import pickle
+from collections import namedtuple
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+from record_page_parser import Record
+
+VERSION = 1
+
+# Query params that identify a race; the age class is a column of its own.
+RACE_KEY_PARAMS = ('Y', 'M', 'G', 'P')
+
+# name -> (dtype, per-row width or None for a plain column)
+COLUMNS = {
+    'time_cs': ('<i4', None),
+    'rank': ('<i4', None),
+    'name': ('<i4', None),
+    'age_cls': ('<i4', None),
+    'race': ('<i4', None),
+    'lap_count': ('<u1', None),
+    'laps': ('<i4', 'max_laps'),
+}
+
+MISSING = -1
+
+Columns = namedtuple('Columns', COLUMNS.keys())
+
+
+def race_key(q_params: Dict[str, str]) -> str:
+    if not q_params:
+        return ''
+    return '&'.join('{}={}'.format(k, q_params.get(k, ''))
+                    for k in RACE_KEY_PARAMS)
+
+
+class RecordStore:
+    def __init__(self, path: str, max_laps: int = 32):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta = os.path.join(path, 'meta.json')
+        if os.path.exists(meta):
+            with open(meta, encoding='utf-8') as f:
+                self.meta = json.load(f)
+            if self.meta['version'] != VERSION:
+                raise ValueError('Unsupported record store version: {}'.format(
+                    self.meta['version']))
+        else:
+            self.meta = {
+                'version': VERSION,
+                'rows': 0,
+                'max_laps': max_laps,
+                'name': [],
+                'age_cls': [],
+                'race': [],
+            }
+            self.__write_meta()
+        self.__ids = {
+            k: {v: i
+                for i, v in enumerate(self.meta[k])}
+            for k in ('name', 'age_cls', 'race')
+        }
+
+    @property
+    def max_laps(self) -> int:
+        return self.meta['max_laps']
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __file(self, column: str) -> str:
+        return os.path.join(self.path, column + '.bin')
+
+    def __width(self, column: str) -> int:
+        width = COLUMNS[column][1]
+        return self.meta[width] if width else 1
+
+    def __write_meta(self):
+        # Readers only trust rows counted in meta.json, so replacing it
+        # atomically is what commits an append.
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+    def __intern(self, column: str, value: str) -> int:
+        ids = self.__ids[column]
+        i = ids.get(value)
+        if i is None:
+            i = len(self.meta[column])
+            self.meta[column].append(value)
+            ids[value] = i
+        return i
+
+    def append(self, records: Iterable[Record]) -> int:
+        records = list(records)
+        if not records:
+            return 0
+        n = len(records)
+        cols = {
+            c: np.full((n, self.__width(c)) if COLUMNS[c][1] else n,
+                       MISSING if c != 'lap_count' else 0,
+                       dtype=COLUMNS[c][0])
+            for c in COLUMNS
+        }
+        for i, r in enumerate(records):
+            laps = r.lap_cs or ()
+            if len(laps) > self.max_laps:
+                raise ValueError('{} laps do not fit max_laps={}: {}'.format(
+                    len(laps), self.max_laps, r))
+            if r.record_cs is not None:
+                cols['time_cs'][i] = r.record_cs
+            cols['rank'][i] = r.rank or 0
+            cols['name'][i] = self.__intern('name', r.name or '')
+            cols['age_cls'][i] = self.__intern('age_cls', r.age_cls or '')
+            cols['race'][i] = self.__intern('race', race_key(r.q_params))
+            cols['lap_count'][i] = len(laps)
+            cols['laps'][i, :len(laps)] = laps
+
+        rows = self.meta['rows']
+        for c, a in cols.items():
+            with open(self.__file(c), 'ab') as f:
+                # Drop whatever an interrupted append left past the last
+                # committed row before adding to the column.
+                f.truncate(rows * self.__width(c) * a.dtype.itemsize)
+                f.write(a.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        self.meta['rows'] = rows + n
+        self.__write_meta()
+        return n
+
+    def columns(self) -> Columns:
+        # Memory-mapped, read-only views over the committed rows.
+        rows = self.meta['rows']
+        arrays = {}
+        for c, (dtype, width) in COLUMNS.items():
+            shape = (rows, self.meta[width]) if width else (rows, )
+            if rows == 0:
+                arrays[c] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[c] = np.memmap(
+                    self.__file(c), dtype=dtype, mode='r', shape=shape)
+        return Columns(**arrays)
+
+    def dictionary(self, column: str) -> List[str]:
+        return self.meta[column]
+
+    def decode(self, column: str, ids: Iterable[int]) -> List[str]:
+        values = self.meta[column]
+        return [values[i] for i in ids]
+
+    def lookup(self, column: str, value: str) -> int:
+        return self.__ids[column].get(value, MISSING)
+
+
+def from_pickle(pickle_path: str, store_path: str,
+                max_laps: int = 32) -> RecordStore:
+    with open(pickle_path, 'rb') as f:
+        rs = pickle.load(f)
+    store = RecordStore(store_path, max_laps)
+    store.append(rs)
+    return store
+
+
+if __name__ == '__main__':
+    import sys
+    s = from_pickle(sys.argv[1] if len(sys.argv) > 1 else 'records.pickle',
+                    sys.argv[2] if len(sys.argv) > 2 else 'records.store')
+    print('{} rows in {}'.format(len(s), s.path))
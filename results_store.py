@@ -0,0 +1,362 @@
+import datetime
+import json
+import sqlite3
+import threading
+from array import array
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from meet_page_parser import Race, Sex, Style
+from month_page_parser import Course, Meet
+from record_page_parser import Record
+from sinks import Sink
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meets (
+    id INTEGER PRIMARY KEY,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    g TEXT NOT NULL,
+    name TEXT,
+    course TEXT,
+    venue TEXT,
+    start_date TEXT,
+    end_date TEXT,
+    UNIQUE (year, month, g));
+CREATE TABLE IF NOT EXISTS races (
+    id INTEGER PRIMARY KEY,
+    meet_id INTEGER NOT NULL REFERENCES meets (id),
+    p TEXT NOT NULL,
+    sex TEXT,
+    distance INTEGER,
+    style TEXT,
+    UNIQUE (meet_id, p));
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    race_id INTEGER NOT NULL REFERENCES races (id),
+    cls TEXT NOT NULL,
+    age_cls TEXT,
+    rank INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    record_cs INTEGER,
+    q_params TEXT,
+    UNIQUE (race_id, cls, rank, name));
+CREATE TABLE IF NOT EXISTS laps (
+    record_id INTEGER NOT NULL REFERENCES records (id),
+    idx INTEGER NOT NULL,
+    lap_cs INTEGER NOT NULL,
+    PRIMARY KEY (record_id, idx)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS meets_date ON meets (start_date);
+CREATE INDEX IF NOT EXISTS races_event ON races (sex, distance, style);
+CREATE INDEX IF NOT EXISTS records_name ON records (name);
+CREATE INDEX IF NOT EXISTS records_cls ON records (race_id, cls, record_cs);
+CREATE INDEX IF NOT EXISTS records_age_cls ON records (age_cls);
+CREATE TABLE IF NOT EXISTS store_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    generation INTEGER NOT NULL);
+INSERT OR IGNORE INTO store_state VALUES (0, 0);
+'''
+
+Result = namedtuple('Result', ('record_id', 'meet_name', 'date', 'venue',
+                               'course', 'sex', 'distance', 'style',
+                               'record'))
+
+MeetKey = Tuple[int, int, str]
+
+
+def meet_key(q_params: Dict[str, str]) -> Optional[MeetKey]:
+    try:
+        return int(q_params['Y']), int(q_params['M']), q_params['G']
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def enum_name(e) -> Optional[str]:
+    return e.name if e is not None else None
+
+
+class ResultsStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __bump(self):
+        self.conn.execute(
+            'UPDATE store_state SET generation = generation + 1')
+
+    def generation(self) -> int:
+        # Goes up with every add() and merge(), whichever connection or
+        # process made it: what was read from the store at one generation
+        # holds until the next.
+        with self.lock:
+            return self.conn.execute(
+                'SELECT generation FROM store_state').fetchone()[0]
+
+    def __meet_id(self, key: MeetKey, meet: Meet = None) -> int:
+        dates = sorted(meet.dates) if meet and meet.dates else []
+        self.conn.execute(
+            'INSERT INTO meets (year, month, g, name, course, venue, '
+            'start_date, end_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (year, month, g) DO UPDATE SET '
+            'name = COALESCE(excluded.name, name), '
+            'course = COALESCE(excluded.course, course), '
+            'venue = COALESCE(excluded.venue, venue), '
+            'start_date = COALESCE(excluded.start_date, start_date), '
+            'end_date = COALESCE(excluded.end_date, end_date)',
+            key + (meet.name if meet else None,
+                   enum_name(meet.course) if meet else None,
+                   meet.venue if meet else None,
+                   dates[0].isoformat() if dates else None,
+                   dates[-1].isoformat() if dates else None))
+        return self.conn.execute(
+            'SELECT id FROM meets WHERE year = ? AND month = ? AND g = ?',
+            key).fetchone()[0]
+
+    def __race_id(self, meet_id: int, p: str, race: Race = None) -> int:
+        self.conn.execute(
+            'INSERT INTO races (meet_id, p, sex, distance, style) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (meet_id, p) DO UPDATE SET '
+            'sex = COALESCE(excluded.sex, sex), '
+            'distance = COALESCE(excluded.distance, distance), '
+            'style = COALESCE(excluded.style, style)',
+            (meet_id, p, enum_name(race.sex) if race else None,
+             race.distance or None if race else None,
+             enum_name(race.style) if race else None))
+        return self.conn.execute(
+            'SELECT id FROM races WHERE meet_id = ? AND p = ?',
+            (meet_id, p)).fetchone()[0]
+
+    def __add_record(self, race_id: int, r: Record):
+        q = r.q_params or {}
+        cls = q.get('Cls') or ''
+        self.conn.execute(
+            'INSERT INTO records (race_id, cls, age_cls, rank, name, '
+            'record_cs, q_params) VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (race_id, cls, rank, name) DO UPDATE SET '
+            'age_cls = excluded.age_cls, record_cs = excluded.record_cs, '
+            'q_params = excluded.q_params',
+            (race_id, cls, r.age_cls, r.rank or 0, r.name or '',
+             r.record_cs, json.dumps(dict(q), ensure_ascii=False)))
+        record_id = self.conn.execute(
+            'SELECT id FROM records WHERE race_id = ? AND cls = ? '
+            'AND rank = ? AND name = ?',
+            (race_id, cls, r.rank or 0, r.name or '')).fetchone()[0]
+        self.conn.execute('DELETE FROM laps WHERE record_id = ?',
+                          (record_id, ))
+        if r.lap_cs:
+            self.conn.executemany(
+                'INSERT INTO laps VALUES (?, ?, ?)',
+                ((record_id, i, cs) for i, cs in enumerate(r.lap_cs)))
+
+    def add(self,
+            meet: Meet = None,
+            race: Race = None,
+            records: Iterable[Record] = ()) -> int:
+        # One transaction per call. Upserts are keyed on the meet (Y, M, G),
+        # the race (P) and the record (Cls, rank, name), so storing a page
+        # that was crawled again does not duplicate anything.
+        n = 0
+        with self.lock, self.conn:
+            self.__bump()
+            race_ids = {}
+            if meet and meet.q_params and meet_key(meet.q_params):
+                self.__meet_id(meet_key(meet.q_params), meet)
+            # Races are keyed on P; the header row of a meet page parses
+            # into a race without one, with no records either.
+            if race and race.q_params and meet_key(
+                    race.q_params) and race.q_params.get('P'):
+                key = meet_key(race.q_params)
+                race_ids[key + (race.q_params.get('P'), )] = self.__race_id(
+                    self.__meet_id(key, meet), race.q_params.get('P'), race)
+            for r in records:
+                key = meet_key(r.q_params or {})
+                if not key:
+                    raise ValueError(
+                        'Record has no Y/M/G query params: {}'.format(r))
+                rkey = key + (r.q_params.get('P'), )
+                race_id = race_ids.get(rkey)
+                if race_id is None:
+                    race_id = self.__race_id(
+                        self.__meet_id(key), r.q_params.get('P'))
+                    race_ids[rkey] = race_id
+                self.__add_record(race_id, r)
+                n += 1
+        return n
+
+    def query(self,
+              sex: Sex = None,
+              distance: int = None,
+              style: Style = None,
+              year: int = None,
+              cls: str = None,
+              age_cls: str = None,
+              name: str = None,
+              course: Course = None,
+              date_from: datetime.date = None,
+              date_to: datetime.date = None,
+              record_ids: Sequence[int] = None,
+              limit: int = None,
+              offset: int = 0) -> List[Result]:
+        conds = []
+        args = []
+        if record_ids is not None:
+            # Bound as one JSON array: there may be more ids than SQLite
+            # takes parameters.
+            conds.append('r.id IN (SELECT value FROM json_each(?))')
+            args.append(json.dumps(list(record_ids)))
+        for cond, value in (('ra.sex = ?', enum_name(sex)),
+                            ('ra.distance = ?', distance),
+                            ('ra.style = ?', enum_name(style)),
+                            ('m.year = ?', year), ('r.cls = ?', cls),
+                            ('r.age_cls = ?', age_cls), ('r.name = ?', name),
+                            ('m.course = ?', enum_name(course)),
+                            ('m.start_date >= ?', date_from and
+                             date_from.isoformat()),
+                            ('m.start_date <= ?', date_to and
+                             date_to.isoformat())):
+            if value is not None:
+                conds.append(cond)
+                args.append(value)
+        sql = ('SELECT r.id, r.age_cls, r.rank, r.name, r.record_cs, '
+               'r.q_params, m.name, m.start_date, m.venue, m.course, ra.sex, '
+               'ra.distance, ra.style FROM records r '
+               'JOIN races ra ON ra.id = r.race_id '
+               'JOIN meets m ON m.id = ra.meet_id')
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        sql += ' ORDER BY r.record_cs IS NULL, r.record_cs, r.id'
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            args += [limit, offset]
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+            laps = self.__laps([row[0] for row in rows])
+        results = []
+        for (rid, age_cls, rank, rname, record_cs, q_params, meet_name,
+             start_date, venue, mcourse, rsex, rdistance, rstyle) in rows:
+            r = Record(age_cls=age_cls, rank=rank, name=rname,
+                       q_params=json.loads(q_params) if q_params else None)
+            r.record_cs = record_cs
+            r.lap_cs = laps.get(rid)
+            results.append(
+                Result(rid, meet_name,
+                       datetime.date.fromisoformat(start_date)
+                       if start_date else None, venue,
+                       Course[mcourse] if mcourse else None,
+                       Sex[rsex] if rsex else None, rdistance,
+                       Style[rstyle] if rstyle else None, r))
+        return results
+
+    def __laps(self, record_ids: List[int]) -> Dict[int, array]:
+        laps = {}
+        # Stay well below SQLite's limit on bound parameters.
+        for i in range(0, len(record_ids), 500):
+            chunk = record_ids[i:i + 500]
+            for rid, cs in self.conn.execute(
+                    'SELECT record_id, lap_cs FROM laps WHERE record_id IN '
+                    '({}) ORDER BY record_id, idx'.format(','.join(
+                        '?' * len(chunk))), chunk):
+                laps.setdefault(rid, array('i')).append(cs)
+        return laps
+
+    def merge(self, path: str) -> int:
+        # Upserts everything in the store at `path` into this one, matching
+        # rows on the same keys add() does, so merging the shards of a crawl
+        # (or the same shard twice) leaves no duplicates. Returns the number
+        # of records merged.
+        with self.lock:
+            self.conn.execute('ATTACH DATABASE ? AS src', (path, ))
+            try:
+                with self.conn:
+                    self.__bump()
+                    return self.__merge_src()
+            finally:
+                self.conn.execute('DETACH DATABASE src')
+
+    def __merge_src(self) -> int:
+        # `WHERE true` keeps SQLite from reading ON CONFLICT as a join.
+        self.conn.execute(
+            'INSERT INTO meets (year, month, g, name, course, venue, '
+            'start_date, end_date) SELECT year, month, g, name, course, '
+            'venue, start_date, end_date FROM src.meets WHERE true '
+            'ON CONFLICT (year, month, g) DO UPDATE SET '
+            'name = COALESCE(excluded.name, name), '
+            'course = COALESCE(excluded.course, course), '
+            'venue = COALESCE(excluded.venue, venue), '
+            'start_date = COALESCE(excluded.start_date, start_date), '
+            'end_date = COALESCE(excluded.end_date, end_date)')
+        self.conn.execute(
+            'CREATE TEMP TABLE race_map AS SELECT sra.id AS src_id, '
+            'm.id AS meet_id, sra.p, sra.sex, sra.distance, sra.style '
+            'FROM src.races sra JOIN src.meets sm ON sm.id = sra.meet_id '
+            'JOIN main.meets m ON m.year = sm.year AND m.month = sm.month '
+            'AND m.g = sm.g')
+        try:
+            self.conn.execute(
+                'INSERT INTO races (meet_id, p, sex, distance, style) '
+                'SELECT meet_id, p, sex, distance, style FROM race_map '
+                'WHERE true ON CONFLICT (meet_id, p) DO UPDATE SET '
+                'sex = COALESCE(excluded.sex, sex), '
+                'distance = COALESCE(excluded.distance, distance), '
+                'style = COALESCE(excluded.style, style)')
+            n = self.conn.execute(
+                'INSERT INTO records (race_id, cls, age_cls, rank, name, '
+                'record_cs, q_params) SELECT ra.id, sr.cls, sr.age_cls, '
+                'sr.rank, sr.name, sr.record_cs, sr.q_params '
+                'FROM src.records sr JOIN race_map rm ON rm.src_id = '
+                'sr.race_id JOIN main.races ra ON ra.meet_id = rm.meet_id '
+                'AND ra.p = rm.p WHERE true '
+                'ON CONFLICT (race_id, cls, rank, name) DO UPDATE SET '
+                'age_cls = excluded.age_cls, '
+                'record_cs = excluded.record_cs, '
+                'q_params = excluded.q_params').rowcount
+            self.conn.execute(
+                'CREATE TEMP TABLE record_map AS SELECT sr.id AS src_id, '
+                'r.id AS dst_id FROM src.records sr JOIN race_map rm '
+                'ON rm.src_id = sr.race_id JOIN main.races ra '
+                'ON ra.meet_id = rm.meet_id AND ra.p = rm.p '
+                'JOIN main.records r ON r.race_id = ra.id AND r.cls = sr.cls '
+                'AND r.rank = sr.rank AND r.name = sr.name')
+            try:
+                self.conn.execute(
+                    'DELETE FROM main.laps WHERE record_id IN '
+                    '(SELECT dst_id FROM record_map)')
+                self.conn.execute(
+                    'INSERT INTO main.laps SELECT rm.dst_id, l.idx, '
+                    'l.lap_cs FROM src.laps l JOIN record_map rm '
+                    'ON rm.src_id = l.record_id')
+            finally:
+                self.conn.execute('DROP TABLE temp.record_map')
+        finally:
+            self.conn.execute('DROP TABLE temp.race_map')
+        return n
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                t: self.conn.execute(
+                    'SELECT COUNT(*) FROM {}'.format(t)).fetchone()[0]
+                for t in ('meets', 'races', 'records', 'laps')
+            }
+
+
+class StoreSink(Sink):
+    # Lets the streaming crawl write into a ResultsStore, one transaction
+    # per batch.
+
+    def __init__(self, store: ResultsStore, batch_size: int = 500):
+        super().__init__(batch_size)
+        self.store = store
+
+    def _write_batch(self, batch: List[Record]):
+        self.store.add(records=batch)
@@ -0,0 +1,198 @@
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+from logging import getLogger
+from typing import Dict, List
+
+import crawler
+from frontier import Frontier, FrontierItem
+from rate_limiter import HostRateLimiter
+from results_store import ResultsStore
+from swimmer_index import SwimmerIndex
+
+logger = getLogger(__name__)
+
+LEASE_SEC = 60
+
+# How long an idle worker waits at most before asking the frontier again:
+# another worker may add children any time.
+POLL_SEC = 0.1
+
+
+class Heartbeat:
+    # Renews the lease on `item` every third of the lease while the worker
+    # is busy with it, so that only a worker that died loses its items.
+
+    def __init__(self, frontier: Frontier, item: FrontierItem):
+        self.frontier = frontier
+        self.item = item
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __run(self):
+        while not self.stopped.wait(self.frontier.lease_sec / 3):
+            if not self.frontier.heartbeat(self.item):
+                logger.warning('%s: lease lost', self.item.key)
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_worker(base_url: str,
+               frontier_path: str,
+               store_path: str,
+               rate: float = 1.0,
+               burst: int = 1,
+               lease_sec: float = LEASE_SEC,
+               backend: str = 'bs4') -> Dict[str, int]:
+    # One worker of a sharded crawl: claims items off the shared frontier
+    # until none are left anywhere and writes the records it finds into its
+    # own store at `store_path`. `rate` is this worker's share of the
+    # budget, not the whole of it.
+    crawler.Crawler.limiter = HostRateLimiter(rate=rate, burst=burst)
+    crawler.Crawler.backend = backend
+    frontier = Frontier(frontier_path, lease_sec=lease_sec)
+    store = ResultsStore(store_path)
+    stats = {'items': 0, 'records': 0, 'failed': 0}
+
+    def on_records(meet, race, records):
+        stats['records'] += store.add(meet, race, records)
+
+    try:
+        while True:
+            item = frontier.claim()
+            if not item:
+                wait = frontier.next_retry_in()
+                if wait is None:
+                    break
+                time.sleep(min(wait, POLL_SEC))
+                continue
+            try:
+                with Heartbeat(frontier, item):
+                    children = crawler.crawl_step(base_url, item, on_records)
+            except Exception as e:
+                logger.warning('%s failed (attempt %d): %r', item.key,
+                               item.attempts + 1, e)
+                frontier.fail(item, repr(e))
+                stats['failed'] += 1
+                continue
+            frontier.complete(item, children)
+            stats['items'] += 1
+    finally:
+        store.close()
+        frontier.close()
+    return stats
+
+
+def shard_path(store_path: str, i: int) -> str:
+    return '{}.shard{}'.format(store_path, i)
+
+
+def crawl_sharded(base_url: str,
+                  frontier_path: str = 'frontier.sqlite3',
+                  store_path: str = 'results.sqlite3',
+                  workers: int = 4,
+                  rate: float = 1.0,
+                  burst: int = 1,
+                  lease_sec: float = LEASE_SEC,
+                  backend: str = 'bs4') -> Dict[str, int]:
+    # Runs `workers` processes over one frontier, each with an equal share
+    # of the `rate` budget, then merges their stores into `store_path`.
+    # Restarting after a crash resumes the frontier and merges whatever the
+    # shards already hold.
+    frontier = Frontier(frontier_path, lease_sec=lease_sec)
+    try:
+        frontier.add('site', base_url)
+    finally:
+        frontier.close()
+    ctx = multiprocessing.get_context('spawn')
+    procs = [
+        ctx.Process(target=run_worker,
+                    args=(base_url, frontier_path, shard_path(store_path, i),
+                          rate / workers, burst, lease_sec, backend))
+        for i in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    merge_shards(store_path,
+                 [shard_path(store_path, i) for i in range(workers)])
+    frontier = Frontier(frontier_path, lease_sec=lease_sec)
+    try:
+        return frontier.counts()
+    finally:
+        frontier.close()
+
+
+def merge_shards(store_path: str, shard_paths: List[str]) -> int:
+    # Shards are removed once merged.
+    n = 0
+    store = ResultsStore(store_path)
+    try:
+        for path in shard_paths:
+            if not os.path.exists(path):
+                continue
+            n += store.merge(path)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        SwimmerIndex(store).update()
+    finally:
+        store.close()
+    return n
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        description='Crawl with several processes, or machines, sharing '
+        'one frontier.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('run', help='run all workers on this machine')
+    worker = sub.add_parser(
+        'worker', help='run one worker, e.g. one per machine')
+    for p in (run, worker):
+        p.add_argument('base_url')
+        p.add_argument('--frontier', default='frontier.sqlite3')
+        p.add_argument('--rate', type=float, default=1.0,
+                       help='requests/sec for the whole crawl')
+        p.add_argument('--burst', type=int, default=1)
+        p.add_argument('--lease', type=float, default=LEASE_SEC)
+        p.add_argument('--backend', default='bs4')
+        p.add_argument('--workers', type=int, default=4,
+                       help='workers sharing the rate budget')
+    run.add_argument('--store', default='results.sqlite3')
+    worker.add_argument('--store', required=True,
+                        help="this worker's own store, merged afterwards")
+    merge = sub.add_parser(
+        'merge', help='merge worker stores into one and remove them')
+    merge.add_argument('store')
+    merge.add_argument('shards', nargs='+')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        print(crawl_sharded(args.base_url, args.frontier, args.store,
+                            args.workers, args.rate, args.burst, args.lease,
+                            args.backend))
+    elif args.command == 'worker':
+        frontier = Frontier(args.frontier, lease_sec=args.lease)
+        try:
+            frontier.add('site', args.base_url)
+        finally:
+            frontier.close()
+        print(run_worker(args.base_url, args.frontier, args.store,
+                         args.rate / args.workers, args.burst, args.lease,
+                         args.backend))
+    else:
+        print(merge_shards(args.store, args.shards))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import csv
+import json
+import os
+import pickle
+import sqlite3
+from typing import Iterable, Iterator, List
+
+from record_page_parser import Record
+
+CSV_FIELDS = ('age_cls', 'rank', 'name', 'record_cs', 'lap_cs', 'Y', 'M', 'G',
+              'P', 'Cls')
+
+
+class Sink:
+    # Buffers records and hands them to _write_batch in batches, so output
+    # grows with the crawl while memory stays at one batch.
+
+    def __init__(self, batch_size: int = 500):
+        self.batch_size = batch_size
+        self.buffer: List[Record] = []
+        self.written = 0
+
+    def write(self, record: Record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def write_all(self, records: Iterable[Record]) -> int:
+        n = 0
+        for r in records:
+            self.write(r)
+            n += 1
+        return n
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self._write_batch(self.buffer)
+        self.written += len(self.buffer)
+        self.buffer = []
+
+    def _write_batch(self, batch: List[Record]):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JsonlSink(Sink):
+    def __init__(self, path: str, batch_size: int = 500):
+        super().__init__(batch_size)
+        self.f = open(path, 'a', encoding='utf-8')
+
+    def _write_batch(self, batch: List[Record]):
+        self.f.writelines(
+            json.dumps(r.to_dict(), ensure_ascii=False) + '\n' for r in batch)
+        self.f.flush()
+
+    def close(self):
+        super().close()
+        self.f.close()
+
+
+class CsvSink(Sink):
+    def __init__(self, path: str, batch_size: int = 500):
+        super().__init__(batch_size)
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.f = open(path, 'a', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.f)
+        if new:
+            self.writer.writerow(CSV_FIELDS)
+
+    def _write_batch(self, batch: List[Record]):
+        for r in batch:
+            q = r.q_params or {}
+            self.writer.writerow(
+                (r.age_cls, r.rank, r.name, r.record_cs,
+                 ' '.join(str(l) for l in r.lap_cs or ()), q.get('Y'),
+                 q.get('M'), q.get('G'), q.get('P'), q.get('Cls')))
+        self.f.flush()
+
+    def close(self):
+        super().close()
+        self.f.close()
+
+
+class SqliteSink(Sink):
+    def __init__(self, path: str, batch_size: int = 500):
+        super().__init__(batch_size)
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS records (
+                age_cls TEXT,
+                rank INTEGER,
+                name TEXT,
+                record_cs INTEGER,
+                lap_cs TEXT,
+                q_params TEXT)''')
+
+    def _write_batch(self, batch: List[Record]):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO records VALUES (?, ?, ?, ?, ?, ?)',
+                ((r.age_cls, r.rank, r.name, r.record_cs,
+                  json.dumps(list(r.lap_cs)) if r.lap_cs is not None else None,
+                  json.dumps(dict(r.q_params), ensure_ascii=False)
+                  if r.q_params else None) for r in batch))
+
+    def close(self):
+        super().close()
+        self.conn.close()
+
+
+class PickleSink(Sink):
+    # Each batch is pickled as a list of its own, so a file written in one
+    # go by older versions (a single list) reads back the same way.
+
+    def __init__(self, path: str, batch_size: int = 500):
+        super().__init__(batch_size)
+        self.f = open(path, 'ab')
+
+    def _write_batch(self, batch: List[Record]):
+        pickle.dump(batch, self.f, pickle.HIGHEST_PROTOCOL)
+        self.f.flush()
+
+    def close(self):
+        super().close()
+        self.f.close()
+
+
+SINKS = {
+    '.jsonl': JsonlSink,
+    '.csv': CsvSink,
+    '.sqlite3': SqliteSink,
+    '.db': SqliteSink,
+    '.pickle': PickleSink,
+}
+
+
+def open_sink(path: str, batch_size: int = 500) -> Sink:
+    ext = os.path.splitext(path)[1]
+    if ext not in SINKS:
+        raise ValueError('Unknown sink type: {}'.format(path))
+    return SINKS[ext](path, batch_size)
+
+
+def load_records(path: str) -> Iterator[Record]:
+    ext = os.path.splitext(path)[1]
+    if ext == '.jsonl':
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                yield Record.from_dict(json.loads(line))
+    elif ext == '.pickle':
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    return
+                yield from batch
+    else:
+        raise ValueError('Cannot read records back from: {}'.format(path))
@@ -0,0 +1,180 @@
+import datetime
+import unicodedata
+from collections import namedtuple
+from typing import List, Optional, Set
+
+from results_store import Result, ResultsStore
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS swimmers (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    grams INTEGER NOT NULL,
+    records INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS swimmer_grams (
+    gram TEXT NOT NULL,
+    swimmer_id INTEGER NOT NULL REFERENCES swimmers (id),
+    PRIMARY KEY (gram, swimmer_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS swimmer_records (
+    swimmer_id INTEGER NOT NULL REFERENCES swimmers (id),
+    record_id INTEGER NOT NULL REFERENCES records (id),
+    PRIMARY KEY (swimmer_id, record_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS swimmer_index_state (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    last_record_id INTEGER NOT NULL);
+'''
+
+# Japanese names are mostly 2 to 5 characters, too short for trigrams to
+# match anything but the exact name.
+N = 2
+
+Posting = namedtuple('Posting', ('record_id', 'date', 'name'))
+
+Match = namedtuple('Match', ('key', 'name', 'score', 'records'))
+
+
+def display_name(name: str) -> str:
+    # NFKC with runs of whitespace (full-width spaces included) made one
+    # space: '山田　 太郎' and '山田 太郎' read the same.
+    return ' '.join(unicodedata.normalize('NFKC', name or '').split())
+
+
+def name_key(name: str) -> str:
+    # What names are matched on: no whitespace at all, and case folded.
+    return ''.join(display_name(name).split()).casefold()
+
+
+def ngrams(key: str, n: int = N) -> Set[str]:
+    if len(key) <= n:
+        return {key} if key else set()
+    return {key[i:i + n] for i in range(len(key) - n + 1)}
+
+
+class SwimmerIndex:
+    # Swimmers of a ResultsStore by normalized name, kept in the store's own
+    # database. update() indexes the records added since the last call.
+    # With `create` False nothing is written: a reader uses the index only
+    # if it is there, and only while lag() says it is current.
+
+    def __init__(self, store: ResultsStore, create: bool = True):
+        self.store = store
+        self.conn = store.conn
+        if create:
+            with store.lock, self.conn:
+                self.conn.executescript(SCHEMA)
+                self.conn.execute('INSERT OR IGNORE INTO swimmer_index_state '
+                                  'VALUES (0, 0)')
+
+    def lag(self) -> Optional[int]:
+        # How many record ids the store has past the last one indexed; None
+        # when the store has no index.
+        with self.store.lock:
+            if not self.conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                    "name = 'swimmer_index_state'").fetchone():
+                return None
+            row = self.conn.execute(
+                'SELECT (SELECT COALESCE(MAX(id), 0) FROM records) - '
+                'last_record_id FROM swimmer_index_state').fetchone()
+        return max(row[0], 0) if row else None
+
+    def update(self) -> int:
+        # Returns the number of records indexed.
+        with self.store.lock, self.conn:
+            last, = self.conn.execute(
+                'SELECT last_record_id FROM swimmer_index_state').fetchone()
+            rows = self.conn.execute(
+                'SELECT id, name FROM records WHERE id > ? ORDER BY id',
+                (last, )).fetchall()
+            ids = {}
+            for record_id, name in rows:
+                key = name_key(name)
+                if not key:
+                    continue
+                swimmer_id = ids.get(key) or self.__swimmer_id(key, name)
+                ids[key] = swimmer_id
+                if self.conn.execute(
+                        'INSERT OR IGNORE INTO swimmer_records VALUES (?, ?)',
+                        (swimmer_id, record_id)).rowcount:
+                    self.conn.execute(
+                        'UPDATE swimmers SET records = records + 1 '
+                        'WHERE id = ?', (swimmer_id, ))
+            if rows:
+                self.conn.execute(
+                    'UPDATE swimmer_index_state SET last_record_id = ?',
+                    (rows[-1][0], ))
+        return len(rows)
+
+    def __swimmer_id(self, key: str, name: str) -> int:
+        row = self.conn.execute('SELECT id FROM swimmers WHERE key = ?',
+                                (key, )).fetchone()
+        if row:
+            return row[0]
+        grams = ngrams(key)
+        swimmer_id = self.conn.execute(
+            'INSERT INTO swimmers (key, name, grams) VALUES (?, ?, ?)',
+            (key, display_name(name), len(grams))).lastrowid
+        self.conn.executemany('INSERT INTO swimmer_grams VALUES (?, ?)',
+                              ((g, swimmer_id) for g in grams))
+        return swimmer_id
+
+    def lookup(self, name: str) -> List[Posting]:
+        # Records of the swimmer named `name`, oldest first
+        with self.store.lock:
+            return [
+                Posting(record_id, datetime.date.fromisoformat(date)
+                        if date else None, rname)
+                for record_id, date, rname in self.conn.execute(
+                    'SELECT r.id, m.start_date, r.name FROM swimmers s '
+                    'JOIN swimmer_records sr ON sr.swimmer_id = s.id '
+                    'JOIN records r ON r.id = sr.record_id '
+                    'JOIN races ra ON ra.id = r.race_id '
+                    'JOIN meets m ON m.id = ra.meet_id WHERE s.key = ? '
+                    'ORDER BY m.start_date IS NULL, m.start_date, r.id',
+                    (name_key(name), ))
+            ]
+
+    def results(self, name: str) -> List[Result]:
+        # Like lookup(), with the records themselves
+        ids = [p.record_id for p in self.lookup(name)]
+        results = {r.record_id: r for r in self.store.query(record_ids=ids)}
+        return [results[i] for i in ids if i in results]
+
+    def prefix(self, text: str, limit: int = 20) -> List[Match]:
+        # Swimmers whose name starts with `text`, in name order
+        key = name_key(text)
+        with self.store.lock:
+            rows = self.conn.execute(
+                'SELECT key, name, records FROM swimmers '
+                'WHERE key >= ? AND key < ? ORDER BY key LIMIT ?',
+                (key, key + '\U0010ffff', limit)).fetchall()
+        return [Match(k, n, 1.0, c) for k, n, c in rows]
+
+    def search(self,
+               text: str,
+               limit: int = 20,
+               min_score: float = 0.5) -> List[Match]:
+        # Swimmers sharing n-grams with `text`, best first. The score is the
+        # share of the query's n-grams the name has, so a part of a name
+        # (a family name alone, say) finds every name containing it; ties
+        # go to the name closest in length.
+        key = name_key(text)
+        if len(key) < N:
+            return self.prefix(text, limit)
+        grams = ngrams(key)
+        with self.store.lock:
+            rows = self.conn.execute(
+                'SELECT s.key, s.name, s.grams, g.shared, s.records '
+                'FROM (SELECT swimmer_id, '
+                'COUNT(*) AS shared FROM swimmer_grams WHERE gram IN ({}) '
+                'GROUP BY swimmer_id HAVING COUNT(*) >= ?) g '
+                'JOIN swimmers s ON s.id = g.swimmer_id'.format(','.join(
+                    '?' * len(grams))),
+                list(grams) + [max(1, min_score * len(grams))]).fetchall()
+        rows.sort(
+            key=lambda row: (-row[3], abs(row[2] - len(grams)), row[0]))
+        return [
+            Match(k, n, shared / len(grams), c)
+            for k, n, _, shared, c in rows[:limit]
+        ]
@@ -0,0 +1,60 @@
+import numpy as np
+
+from analytics import (fade_ratio, from_columns, from_records, histograms,
+                       leg_splits, percentiles, split_deltas)
+from meet_page_parser import Sex
+from record_page_parser import Record
+from record_store import RecordStore
+
+
+def record(time_cs, laps, age_cls='40~44歳'):
+    r = Record(age_cls=age_cls, q_params={'Y': '2023', 'P': '2'})
+    r.record_cs = time_cs
+    for cs in laps:
+        r.add_lap(secs=cs // 100, one_tenth_secs=cs % 100)
+    return r
+
+
+RECORDS = [
+    record(14000, [3000, 6600, 10600, 14000]),
+    # Split every 25m instead of every 50m.
+    record(16000, [1600, 3400, 5300, 7300, 9500, 11700, 13900, 16000]),
+    # Only the first 100m was timed.
+    record(15000, [3200, 7000], '45~49歳'),
+    record(13000, [], '45~49歳'),
+]
+
+
+def test_leg_splits_and_deltas_are_masked_where_laps_are_missing():
+    m = from_records(RECORDS, Sex.F)
+    legs = leg_splits(m, 4)
+    assert legs[0].tolist() == [3000, 3600, 4000, 3400]
+    assert legs[1].tolist() == [3400, 3900, 4400, 4300]
+    assert legs[2].tolist() == [3200, 3800, None, None]
+    assert legs[3].mask.all()
+
+    deltas = split_deltas(m, 4)
+    assert deltas[0].tolist() == [-500, 100, 500, -100]
+    assert np.ma.allclose(fade_ratio(m)[:2], [7400 / 6600, 8700 / 7300])
+    assert fade_ratio(m).mask.tolist() == [False, False, True, True]
+
+
+def test_grouped_percentiles_and_histograms():
+    m = from_records(RECORDS, Sex.F)
+    p = percentiles(split_deltas(m, 4), m, q=(50, ))
+    assert p[('40~44歳', 'F')].shape == (1, 4)
+    assert np.isnan(p[('45~49歳', 'F')][0, 2])
+
+    h = histograms(m.time_cs, m, bins=2, by='age_cls')
+    assert h[('40~44歳', )][0].tolist() == [1, 1]
+    assert h[('45~49歳', )][0].tolist() == [1, 1]
+    assert h[('40~44歳', )][1] is h[('45~49歳', )][1]
+
+
+def test_record_store_columns_give_the_same_matrix(tmp_path):
+    s = RecordStore(str(tmp_path / 'store'), max_laps=8)
+    s.append(RECORDS)
+    m = from_columns(s.columns(), s.dictionary('age_cls'))
+    expected = leg_splits(from_records(RECORDS), 4)
+    assert leg_splits(m, 4).tolist() == expected.tolist()
+    assert m.age_cls.tolist() == [r.age_cls for r in RECORDS]
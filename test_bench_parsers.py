@@ -0,0 +1,47 @@
+import json
+import os
+
+import pytest
+
+from bench_parsers import (CASES, TESTDATA, Case, case_body, compare, parse,
+                           run)
+from parser_base import BACKENDS
+from record_page_parser import Record
+
+RECORD_FIXTURES = ['record_lap.html', 'record_nolap.html', 'record_relay.html']
+
+
+def expected(fixture):
+    path = os.path.join(TESTDATA, fixture.replace('.html', '.expected.json'))
+    with open(path, encoding='utf-8') as f:
+        return [Record.from_dict(d) for d in json.load(f)]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('fixture', RECORD_FIXTURES)
+def test_fixtures_pin_record_output(fixture, backend):
+    case = Case(fixture, fixture, 1)
+    assert parse(case, case_body(case), backend) == expected(fixture)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_large_pages_repeat_the_fixture_rows(backend):
+    case = Case('large', 'record_nolap.html', 50)
+    rs = parse(case, case_body(case), backend)
+    assert rs == expected('record_nolap.html') * 50
+
+
+def test_run_reports_throughput_and_memory():
+    r = run(CASES[0], 'lxml', min_time=0)
+    assert r.rows == 3
+    assert r.rows_per_sec == pytest.approx(r.pages_per_sec * 3)
+    assert r.peak_kb > 0
+
+
+def test_compare_flags_regressions():
+    base = {'a/lxml': {'pages_per_sec': 100, 'rows': 10, 'peak_kb': 50}}
+    ok = {'a/lxml': {'pages_per_sec': 80, 'rows': 10, 'peak_kb': 60}}
+    assert compare(ok, base, tolerance=0.3) == []
+    bad = {'a/lxml': {'pages_per_sec': 60, 'rows': 9, 'peak_kb': 70}}
+    assert len(compare(bad, base, tolerance=0.3)) == 3
+    assert compare({'new/lxml': bad['a/lxml']}, base) == []
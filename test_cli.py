@@ -0,0 +1,108 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import cli
+from meet_page_parser import Sex, Style
+from mock_server import MockServer, SyntheticSite
+from results_store import ResultsStore
+
+BASE = 'https://www.tdsystem.co.jp/'
+
+
+def test_links_are_read_with_urllib_parse():
+    t = cli.parse_target(BASE + 'ProList.php?Y=2023&M=2&G=0&GL=0&G=48')
+    assert t == cli.Target('meet', BASE, {
+        'Y': '2023', 'M': '2', 'G': '48', 'GL': '0', 'action': 'ProList.php'
+    })
+    t = cli.parse_target(BASE + 'Record.php?Y=2023&M=2&G=0&G=48&P=3&P=12')
+    assert t.kind == 'race' and t.base_url == BASE
+    assert t.q_params == dict(cli.RECORD_DEFAULTS, Y='2023', M='2', G='48',
+                              P='12', action='Record.php')
+    for bad in ('Record.php?Y=2023&M=2&G=48', BASE + 'Record.php?Y=2023&M=2',
+                BASE + 'Index.php?Y=2023&M=2&G=48'):
+        with pytest.raises(ValueError):
+            cli.parse_target(bad)
+
+
+def test_links_are_deduplicated_and_grouped_by_meet():
+    urls = [
+        'Record.php?Y=2023&M=2&G=48&P=3&Cls=40',
+        'Record.php?Y=2023&M=3&G=7&P=1',
+        'Record.php?Y=2023&M=2&G=48&P=3&Cls=999',
+        'Record.php?Y=2023&M=2&G=48&P=5',
+        'Record.php?Y=2023&M=3&G=7&P=2',
+        'ProList.php?Y=2023&M=3&G=7',
+        'Record.php?Y=2023&M=3&G=7&P=4',
+    ]
+    batches = cli.plan(cli.parse_target(BASE + u) for u in urls)
+    assert list(batches) == [(BASE, '2023', '2', '48'),
+                             (BASE, '2023', '3', '7')]
+    first, second = batches.values()
+    assert first.q_params is None and list(first.races) == ['3', '5']
+    assert first.races['3']['Cls'] == '40'
+    # The whole meet is crawled, which covers its races.
+    assert second.q_params['action'] == 'ProList.php' and not second.races
+
+
+def test_a_batch_crawls_every_meet_once(tmp_path, capsys):
+    s = MockServer(site=SyntheticSite(years=(2023, ), meets_per_month=1,
+                                      races_per_meet=4, swimmers_per_class=2))
+    s.start()
+    links = tmp_path / 'links.txt'
+    links.write_text('\n'.join([
+        '# February',
+        s.base_url + 'ProList.php?Y=2023&M=2&G=0&GL=0&G=200',
+        s.base_url + 'Record.php?Y=2023&M=2&G=200&P=1',
+        '',
+        s.base_url + 'Record.php?Y=2023&M=3&G=300&P=2&Cls=40',
+        s.base_url + 'Record.php?Y=2023&M=3&G=300&P=2',
+        s.base_url + 'Entry.php?Y=2023&M=3&G=300',
+    ]))
+    try:
+        code = cli.main([
+            '-f', str(links), '-o', str(tmp_path / 'records.jsonl'),
+            '--store', str(tmp_path / 'results.sqlite3'), '--cache', '',
+            '--rate', '1000'
+        ])
+    finally:
+        s.shutdown()
+        s.server_close()
+    assert code == 1  # Entry.php
+    assert 'Entry.php' in capsys.readouterr().err
+    store = ResultsStore(str(tmp_path / 'results.sqlite3'))
+    c = store.counts()
+    assert c['meets'] == 2 and c['races'] == 4 + 1
+    with open(tmp_path / 'records.jsonl', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == c['records'] > 0
+    # Each meet with what its month page says of it, ProList.php or not
+    assert store.conn.execute(
+        'SELECT COUNT(*) FROM meets WHERE name IS NOT NULL AND '
+        'start_date IS NOT NULL AND course IS NOT NULL').fetchone()[0] == 2
+    # and each race with what its meet page says of it, Record.php or not
+    assert store.conn.execute(
+        'SELECT COUNT(*) FROM races WHERE sex IS NOT NULL AND '
+        'distance IS NOT NULL AND style IS NOT NULL').fetchone()[0] == 5
+    sex, distance, style = store.conn.execute(
+        'SELECT sex, distance, style FROM races JOIN meets '
+        "ON meets.id = races.meet_id WHERE g = '300'").fetchone()
+    found = store.query(sex=Sex[sex], distance=distance, style=Style[style],
+                        year=2023)
+    assert len([r for r in found if r.date.month == 3]) == len(
+        [r for r in records if r['q_params']['G'] == '300'])
+    store.close()
+
+
+def test_parsers_are_not_loaded_until_there_is_something_to_crawl():
+    code = ('import sys, cli\n'
+            'cli.main(["--dry-run", "{}Record.php?Y=2023&M=2&G=48"])\n'
+            'assert not {{"bs4", "lxml", "crawler"}} & set(sys.modules)\n'
+            ).format(BASE)
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run([sys.executable, '-c', code], check=True,
+                         capture_output=True, text=True, cwd=here).stdout
+    assert out == BASE + 'ProList.php?Y=2023&M=2&G=48\tP=1\n'
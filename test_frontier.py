@@ -0,0 +1,129 @@
+import crawler
+from frontier import DONE, FAILED, IN_FLIGHT, PENDING, Frontier
+from meet_page_parser import Race
+from month_page_parser import Meet
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_complete_adds_children_and_skips_known(tmp_path):
+    f = Frontier(str(tmp_path / 'f.sqlite3'))
+    f.add('site', 'root')
+    item = f.claim()
+    f.complete(item, [('month', 'm1', ('2023', 1)),
+                      ('month', 'm2', ('2023', 2))])
+    f.add('site', 'root')
+    assert f.state('root') == DONE
+    assert f.counts() == {DONE: 1, PENDING: 2}
+
+
+def test_failed_items_back_off(tmp_path):
+    clock = FakeClock()
+    f = Frontier(str(tmp_path / 'f.sqlite3'), max_attempts=2,
+                 backoff_sec=10, clock=clock)
+    f.add('race', 'r')
+    f.fail(f.claim(), 'boom')
+    assert f.state('r') == FAILED
+    assert f.claim() is None
+    assert f.next_retry_in() == 10
+    clock.now += 10
+    item = f.claim()
+    assert item.attempts == 1
+    f.fail(item, 'boom')
+    clock.now += 1000
+    assert f.claim() is None
+    assert f.next_retry_in() is None
+
+
+def test_in_flight_items_are_reclaimed_after_restart(tmp_path):
+    path = str(tmp_path / 'f.sqlite3')
+    f = Frontier(path)
+    f.add('meet', 'm')
+    f.claim()
+    f.close()
+    f = Frontier(path)
+    assert f.claim().key == 'm'
+
+
+def test_crawl_all_covers_december_and_resumes(tmp_path, monkeypatch):
+    fetched = []
+    fail_once = {'2023-12'}
+
+    def fetch_meets(base_url, y, m):
+        key = '{}-{:02d}'.format(y, m)
+        if key in fail_once:
+            fail_once.discard(key)
+            raise IOError('network down')
+        fetched.append(key)
+        return [Meet(q_params={'action': 'ProList.php', 'Y': y, 'M': str(m),
+                               'G': '1'})] if m == 12 else []
+
+    def fetch_races(base_url, q_params):
+        return [Race(q_params={'action': 'Record.php', 'P': '1'})]
+
+    monkeypatch.setattr(crawler.Crawler, 'fetch_years', lambda url: ['2023'])
+    monkeypatch.setattr(crawler.Crawler, 'fetch_meets', fetch_meets)
+    monkeypatch.setattr(crawler.Crawler, 'fetch_races', fetch_races)
+    monkeypatch.setattr(crawler.Crawler, 'fetch_records',
+                        lambda url, q_params: ['record'])
+    monkeypatch.setattr(crawler.time, 'sleep', lambda sec: None)
+
+    stored = []
+    path = str(tmp_path / 'f.sqlite3')
+    counts = crawler.crawl_all('http://x/', Frontier(path, backoff_sec=0),
+                               lambda meet, race, rs: stored.extend(rs))
+    assert counts == {DONE: 1 + 12 + 1 + 1}
+    assert '2023-12' in fetched
+    assert stored == ['record']
+
+    fetched.clear()
+    crawler.crawl_all('http://x/', path)
+    assert fetched == []
+
+
+def test_leases_expire_and_are_reclaimed(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / 'f.sqlite3')
+    a = Frontier(path, clock=clock, lease_sec=30, owner='a')
+    b = Frontier(path, clock=clock, lease_sec=30, owner='b')
+    a.add('race', 'r')
+    item = a.claim()
+    assert b.claim() is None
+    assert b.next_retry_in() == 30
+    clock.now += 20
+    assert a.heartbeat(item)
+    clock.now += 20
+    assert b.claim() is None
+
+    # a stops heartbeating, as if it had died.
+    clock.now += 31
+    taken = b.claim()
+    assert taken.key == 'r' and taken.attempts == 1
+    assert not a.heartbeat(item)
+    a.fail(item, 'late')
+    assert b.state('r') == IN_FLIGHT
+    b.complete(taken)
+    assert a.counts() == {DONE: 1}
+    assert a.next_retry_in() is None
+
+
+def test_an_expired_lease_cannot_complete(tmp_path):
+    clock = FakeClock()
+    path = str(tmp_path / 'f.sqlite3')
+    a = Frontier(path, clock=clock, lease_sec=30, owner='a')
+    b = Frontier(path, clock=clock, lease_sec=30, owner='b')
+    a.add('meet', 'm')
+    item = a.claim()
+    clock.now += 31
+    taken = b.claim()
+    # a finishes late, after b took the item over.
+    assert not a.complete(item, [('race', 'r1', None)])
+    assert b.state('m') == IN_FLIGHT and b.state('r1') is None
+    assert b.complete(taken, [('race', 'r2', None)])
+    assert b.state('m') == DONE and b.state('r2') == PENDING
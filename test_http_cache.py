@@ -0,0 +1,90 @@
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fetcher import Fetcher
+from http_cache import CachePolicy, ResponseCache, normalize_url
+from page_archive import PageArchive
+
+
+def test_normalize_url_sorts_and_keeps_last_duplicate():
+    assert normalize_url(
+        'https://WWW.tdsystem.co.jp/ProList.php?Y=2023&M=2&G=0&GL=0&G=48'
+    ) == 'https://www.tdsystem.co.jp/ProList.php?G=48&GL=0&M=2&Y=2023'
+
+
+def test_cache_roundtrip(tmp_path):
+    c = ResponseCache(str(tmp_path / 'cache.sqlite3'))
+    c.put('http://x/Record.php?Y=2018&M=6', b'<html>' * 1000, etag='"a"')
+    e = c.get('http://x/Record.php?M=6&Y=2018')
+    assert e.body == b'<html>' * 1000
+    assert e.etag == '"a"'
+    assert len(c) == 1
+
+
+def test_policy_freezes_old_months():
+    now = datetime.datetime(2023, 6, 15).timestamp()
+    p = CachePolicy(frozen_after_days=60, clock=lambda: now)
+    assert p.is_frozen('http://x/Record.php?Y=2023&M=1&G=1')
+    assert not p.is_frozen('http://x/Record.php?Y=2023&M=5&G=1')
+    assert not p.is_frozen('http://x/')
+
+
+class Handler(BaseHTTPRequestHandler):
+    hits = []
+
+    def do_GET(self):
+        self.__class__.hits.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = b'<html>page</html>'
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_fetcher_revalidates_with_etag(tmp_path):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{}/Record.php?Y=2099&M=1'.format(
+            server.server_port)
+        f = Fetcher(ResponseCache(str(tmp_path / 'cache.sqlite3')))
+        assert f.cached(url) is None
+        assert f.fetch(url) == b'<html>page</html>'
+        assert f.fetch(url) == b'<html>page</html>'
+        assert Handler.hits == [None, '"v1"']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_pages_the_cache_answers_for_are_archived(tmp_path):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{}/Record.php?Y={}&M=1'.format
+        frozen, live = url(server.server_port, 2000), url(
+            server.server_port, 2099)
+        cache = ResponseCache(str(tmp_path / 'cache.sqlite3'))
+        Fetcher(cache).fetch(frozen)
+        Fetcher(cache).fetch(live)
+        # Archiving starts after the pages were cached: a cache hit and a
+        # 304 archive them all the same, once.
+        archive = PageArchive(str(tmp_path / 'archive'))
+        f = Fetcher(cache, archive=archive)
+        for _ in range(2):
+            assert f.cached(frozen) == f.fetch(live) == b'<html>page</html>'
+        assert archive.get(frozen).body == archive.get(live).body
+        assert len(archive) == 2 and len(archive.versions(live)) == 1
+        archive.close()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,89 @@
+import threading
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fetcher import Fetcher
+from http_client import HttpClient
+from mock_server import MockServer, SyntheticSite
+
+
+@pytest.fixture
+def server():
+    s = MockServer(site=SyntheticSite(years=(2023, ), meets_per_month=1,
+                                      races_per_meet=2, swimmers_per_class=8))
+    s.start()
+    yield s
+    s.shutdown()
+    s.server_close()
+
+
+def test_connections_are_kept_alive_and_bodies_gzipped(server):
+    url = server.base_url + 'Record.php?Y=2023&M=1&G=100&P=2&Cls=999'
+    plain = Fetcher(client=HttpClient(headers={'Accept-Encoding':
+                                               'identity'}))
+    expected = plain.fetch(url)
+    plain_bytes = server.stats()['bytes']
+
+    f = Fetcher()
+    for _ in range(5):
+        assert f.fetch(url) == expected
+    stats = server.stats()
+    assert stats['connections'] == 2
+    assert (stats['bytes'] - plain_bytes) / 5 < plain_bytes / 3
+
+
+def test_pool_is_bounded_per_host(server):
+    client = HttpClient(max_connections_per_host=2)
+    url = server.base_url + '?Y=2023&M=1'
+    threads = [
+        threading.Thread(target=client.get, args=(url, ))
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert server.stats()['connections'] == 2
+    with pytest.raises(urllib.error.HTTPError) as e:
+        client.get(server.base_url + 'ProList.php?Y=2023&M=1&G=999')
+    assert e.value.code == 404
+
+
+class ClosingHandler(BaseHTTPRequestHandler):
+    # Answers with keep-alive, then closes the connection anyway, the way a
+    # server dropping idle connections does.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/old':
+            self.send_response(301)
+            self.send_header('Location', '/new')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def test_stale_connections_are_replaced_and_redirects_followed():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ClosingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = HttpClient()
+        base = 'http://127.0.0.1:{}'.format(server.server_port)
+        assert client.get(base + '/a').body == b'/a'
+        assert client.get(base + '/b').body == b'/b'
+        res = client.get(base + '/old')
+        assert res.url == base + '/new' and res.body == b'/new'
+    finally:
+        server.shutdown()
+        server.server_close()
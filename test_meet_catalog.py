@@ -0,0 +1,133 @@
+import datetime
+import time
+
+import pytest
+
+from crawler import Crawler
+from meet_catalog import FreshnessPolicy, MeetCatalog, refresh, update_store
+from mock_server import MockServer, SyntheticSite
+from month_page_parser import Meet
+from rate_limiter import HostRateLimiter
+from results_store import ResultsStore
+
+
+def at(*args) -> float:
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+
+def test_pages_are_fresh_by_when_their_meets_take_place():
+    now = [at(2023, 3, 5, 12)]
+    policy = FreshnessPolicy(clock=lambda: now[0])
+    assert policy.month_max_age(2023, 3) == policy.live_sec
+    assert policy.month_max_age(2023, 2) == policy.live_sec  # settling
+    assert policy.month_max_age(2023, 1) is None
+    assert policy.month_max_age(2023, 4) == policy.upcoming_sec
+    meet = Meet(dates=[datetime.date(2023, 2, 25), datetime.date(2023, 2, 26)],
+                q_params={'Y': '2023', 'M': '2', 'G': '200'})
+    assert policy.meet_max_age(meet) == policy.live_sec
+    now[0] = at(2023, 3, 13, 12)
+    assert policy.meet_max_age(meet) is None
+    assert policy.is_due(None, None)
+    assert not policy.is_due(now[0] - 10**9, None)
+    assert policy.is_due(now[0] - 3600, 3600)
+    assert not policy.is_due(now[0] - 60, 3600)
+
+
+@pytest.fixture
+def site():
+    site = SyntheticSite(years=(2023, ), meets_per_month=1, races_per_meet=3,
+                         swimmers_per_class=1)
+    s = MockServer(site=site)
+    s.start()
+    yield s, site
+    s.shutdown()
+    s.server_close()
+
+
+def test_refresh_asks_only_for_what_may_have_changed(site, tmp_path,
+                                                     monkeypatch):
+    server, synthetic = site
+    monkeypatch.setattr(Crawler, 'limiter', HostRateLimiter(rate=1000))
+    now = [at(2023, 3, 5, 12)]
+    catalog = MeetCatalog(str(tmp_path / 'meets.sqlite3'),
+                          FreshnessPolicy(clock=lambda: now[0]))
+
+    def requests():
+        return server.stats()['requests']
+
+    # Built from scratch: the site, 12 months and 12 meets
+    changes = refresh(server.base_url, catalog)
+    assert changes.pages == requests() == 1 + 12 + 12
+    assert len(changes.meets) == 12 and len(changes.races) == 12 * 3
+    assert not changes.failed
+    assert [m.q_params['G'] for m in catalog.meets(2023)][:2] == [
+        '1200', '1100'
+    ]
+    feb = catalog.meets(2023, 2)[0]
+    assert feb.dates and feb.dates[0].month == 2
+    assert [r.q_params['P'] for r in catalog.races(feb)] == ['1', '2', '3']
+
+    # Two hours later another meet is published every month; only the live
+    # months (February is still settling) are asked for again.
+    now[0] += 2 * 3600
+    synthetic.meets_per_month = 2
+    before = requests()
+    changes = refresh(server.base_url, catalog)
+    assert changes.pages == requests() - before <= 2 + 4
+    assert sorted(m.q_params['G'] for m in changes.meets) == ['201', '301']
+    assert sorted((m.q_params['G'], r.q_params['P'])
+                  for m, r in changes.races) == [
+                      ('201', '1'), ('201', '2'), ('201', '3'),
+                      ('301', '1'), ('301', '2'), ('301', '3')]
+
+    # Nothing is due again within the hour.
+    now[0] += 60
+    assert refresh(server.base_url, catalog) == ([], [], 0, [])
+
+    # Once the year has settled only the list of years is checked.
+    now[0] = at(2024, 2, 1)
+    before = requests()
+    assert refresh(server.base_url, catalog) == ([], [], 1, [])
+    assert requests() - before == 1
+    catalog.close()
+
+
+def test_live_meets_are_crawled_again_until_they_settle(site, tmp_path,
+                                                       monkeypatch):
+    server, synthetic = site
+    monkeypatch.setattr(Crawler, 'limiter', HostRateLimiter(rate=1000))
+    now = [at(2023, 3, 5, 12)]
+    catalog = MeetCatalog(str(tmp_path / 'meets.sqlite3'),
+                          FreshnessPolicy(clock=lambda: now[0]))
+    store = ResultsStore(str(tmp_path / 'results.sqlite3'))
+
+    def counts():
+        return dict(store.conn.execute(
+            'SELECT m.month, COUNT(*) FROM records r '
+            'JOIN races ra ON ra.id = r.race_id '
+            'JOIN meets m ON m.id = ra.meet_id GROUP BY m.month'))
+
+    changes = refresh(server.base_url, catalog)
+    assert update_store(server.base_url, catalog, changes, store) == (36, [])
+    before = counts()
+    # Results come in for races listed before, on the day the March meet
+    # starts: no race is new, but the races of the live meets are crawled
+    # again. Those of the others are left as they were.
+    march = catalog.meets(2023, 3)[0]
+    now[0] = at(2023, 3, march.dates[0].day, 12)
+    live = {
+        m.q_params['M']
+        for m in catalog.meets() if catalog.policy.meet_is_live(m)
+    }
+    assert '3' in live and live <= {'2', '3'}
+    synthetic.swimmers_per_class = 2
+    changes = refresh(server.base_url, catalog)
+    assert not changes.races
+    assert update_store(server.base_url, catalog, changes,
+                        store) == (3 * len(live), [])
+    after = counts()
+    assert all(after[int(m)] > before[int(m)] for m in live)
+    assert {m: after[m] for m in after if str(m) not in live} == {
+        m: before[m] for m in before if str(m) not in live}
+    store.close()
+    catalog.close()
@@ -0,0 +1,108 @@
+import json
+import os
+import urllib.error
+
+import pytest
+
+import metrics
+from fetcher import Fetcher
+from http_cache import ResponseCache
+from mock_server import MockServer
+from month_page_parser import MonthPageParser
+from record_page_parser import RecordPageParser
+from rate_limiter import HostRateLimiter
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'testdata')
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    metrics.REGISTRY.reset()
+    yield
+    metrics.REGISTRY.reset()
+    metrics.profile_parse(0)
+
+
+def read(name):
+    with open(os.path.join(TESTDATA, name), 'rb') as f:
+        return f.read()
+
+
+def test_prometheus_text_and_summary():
+    r = metrics.Registry()
+    c = r.counter('pages_total', 'Pages.', ('kind', ))
+    h = r.histogram('latency_seconds', 'Latency.', (0.1, 1), ('kind', ))
+    c.inc(kind='meet')
+    c.inc(2, kind='meet')
+    for v in (0.05, 0.5, 0.5, 3):
+        h.observe(v, kind='meet')
+    text = r.prometheus()
+    assert '# TYPE pages_total counter\npages_total{kind="meet"} 3\n' in text
+    assert 'latency_seconds_bucket{kind="meet",le="0.1"} 1\n' in text
+    assert 'latency_seconds_bucket{kind="meet",le="1"} 3\n' in text
+    assert 'latency_seconds_bucket{kind="meet",le="+Inf"} 4\n' in text
+    assert 'latency_seconds_count{kind="meet"} 4\n' in text
+    s = r.summary()['latency_seconds']['meet']
+    assert (s['count'], s['sum'], s['p50'], s['p99']) == (4, 4.05, 1,
+                                                          float('inf'))
+
+    other = metrics.Registry()
+    other.counter('pages_total', 'Pages.', ('kind', )).inc(kind='meet')
+    r.merge(other.drain())
+    assert c.value(kind='meet') == 4
+    assert other.summary() == {}
+
+
+@pytest.mark.parametrize('backend', ['bs4', 'lxml'])
+def test_parsers_record_timings_rows_and_empty_pages(backend):
+    body = read('record_nolap.html')
+    p = RecordPageParser.from_source(body, {'P': '3'}, '35~39歳',
+                                     backend=backend)
+    assert len(list(p.iter_records())) == 4
+    labels = {'parser': 'record', 'backend': backend}
+    assert metrics.PARSE_LOAD_SECONDS.count(**labels) == 1
+    assert metrics.PARSE_EXTRACT_SECONDS.count(**labels) == 1
+    assert metrics.PARSE_ROWS.values[('record', backend)][1] == 4
+    assert metrics.NORMALIZE_SECONDS.value(**labels) > 0
+
+    MonthPageParser.from_source(body, backend=backend).get_meets()
+    assert metrics.EMPTY_PAGES.value(parser='month', backend=backend) == 1
+
+
+def test_fetcher_and_limiter_metrics(tmp_path):
+    server = MockServer()
+    server.start()
+    try:
+        f = Fetcher(ResponseCache(str(tmp_path / 'cache.sqlite3')))
+        url = server.base_url + '?Y=2023&M=2'
+        assert f.cached(url) is None
+        body = f.fetch(url)
+        with pytest.raises(urllib.error.HTTPError):
+            f.fetch(server.base_url + 'ProList.php?Y=1999&M=1&G=0')
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert metrics.CACHE_LOOKUPS.value(result='miss') == 1
+    assert metrics.FETCH_SECONDS.count(status=200) == 1
+    assert metrics.FETCH_BYTES.values[()][1] == len(body)
+    assert metrics.FETCH_ERRORS.value(status=404) == 1
+
+    HostRateLimiter(rate=1000, burst=1).acquire('http://x/')
+    assert metrics.THROTTLE_SECONDS.count() == 1
+
+
+def test_sampling_profiler_and_summary_reporter(tmp_path):
+    profiler = metrics.profile_parse(rate=1.0)
+    RecordPageParser.from_source(read('record_lap.html'),
+                                 backend='lxml').get_records()
+    assert profiler.samples > 0
+    names = {f[2] for f in profiler.stats().stats}
+    assert {'__iter_records', 'load'} <= names
+
+    path = str(tmp_path / 'metrics.json')
+    reporter = metrics.SummaryReporter(interval=60, path=path).start()
+    reporter.stop()
+    with open(path, encoding='utf-8') as f:
+        summary = json.load(f)
+    assert summary['tdsystem_parse_rows']['record,lxml']['count'] == 1
@@ -0,0 +1,142 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from crawler import Crawler
+from fetcher import Fetcher
+from http_cache import ResponseCache
+from meet_page_parser import MeetPageParser, Sex, Style
+from mock_server import Faults, MockServer, SyntheticSite
+from month_page_parser import MonthPageParser
+from rate_limiter import HostRateLimiter
+from record_page_parser import RecordPageParser
+
+
+@pytest.fixture
+def server():
+    s = MockServer(site=SyntheticSite(years=(2023, 2022), meets_per_month=2,
+                                      races_per_meet=8, swimmers_per_class=5))
+    s.start()
+    yield s
+    s.shutdown()
+    s.server_close()
+
+
+def get(url):
+    with urllib.request.urlopen(url) as res:
+        return res.read()
+
+
+def test_pages_parse_like_the_real_site(server):
+    p = MonthPageParser.from_source(
+        get(server.base_url + '?Y=2023&M=2'), year=2023, month=2)
+    assert p.get_available_years() == ['2023', '2022']
+    meets = p.get_meets()
+    assert [m.q_params['G'] for m in meets] == ['200', '201']
+    assert meets[0].dates[0].month == 2 and meets[0].course
+
+    # Duplicated keys: the last value wins, as on the real site.
+    races = MeetPageParser.from_source(
+        get(server.base_url + 'ProList.php?Y=2023&M=2&G=0&GL=0&G=200')
+    ).get_races()[1:]
+    assert len(races) == 8
+    assert (races[0].sex, races[0].distance, races[0].style) == (
+        Sex.F, 200, Style.IM)
+    assert races[6].distance == 200 and races[6].style == Style.MR
+
+    url = (server.base_url +
+           'Record.php?Y=2023&M=2&G=200&GL=0&S=2&L=1&P=1&Cls=40&Lap={}')
+    body = get(url.format(1))
+    p = RecordPageParser.from_source(body)
+    assert p.get_query_params()['P'] == '1'
+    assert p.get_available_classes()['40'] == '40〜44歳'
+    for backend in ('bs4', 'lxml'):
+        rs = RecordPageParser.from_source(
+            body, p.get_query_params(), '40〜44歳',
+            backend=backend).get_records()
+        assert rs and all(len(r.lap_cs) == 4 for r in rs)
+        assert all(r.lap_cs[-1] == r.record_cs for r in rs)
+        assert [r.rank for r in rs] == list(range(1, len(rs) + 1))
+    assert body == get(url.format(1))
+    rs = RecordPageParser.from_source(get(url.format(0))).get_records()
+    assert all(r.lap_cs is None for r in rs)
+
+
+def test_unknown_pages(server):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        get(server.base_url + 'ProList.php?Y=2023&M=2&G=299')
+    assert e.value.code == 404
+    body = get(server.base_url + 'Record.php?Y=2023&M=2&G=200&Cls=999')
+    assert RecordPageParser.from_source(body).get_records() is None
+
+
+def test_fault_injection_and_stats():
+    s = MockServer(faults=Faults(throttle_rate=1.0, retry_after=7))
+    s.start()
+    try:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            get(s.base_url)
+        assert e.value.code == 429
+        assert e.value.headers['Retry-After'] == '7'
+        s.faults = Faults(latency=0.05, unavailable_rate=0.5, seed=1)
+        codes = []
+        for _ in range(10):
+            try:
+                get(s.base_url)
+                codes.append(200)
+            except urllib.error.HTTPError as e:
+                codes.append(e.code)
+        assert set(codes) == {200, 503}
+        stats = s.stats()
+        assert stats['requests'] == 11
+        assert stats['statuses'][429] == 1
+        assert stats['latency']['p50'] >= 0.05
+    finally:
+        s.shutdown()
+        s.server_close()
+
+
+def test_recorded_pages_are_served_from_the_cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'))
+    cache.put('https://www.tdsystem.co.jp/Record.php?P=2&Y=2023', b'saved')
+    s = MockServer(cache=cache)
+    s.start()
+    try:
+        assert get(s.base_url + 'Record.php?Y=2023&P=2') == b'saved'
+    finally:
+        s.shutdown()
+        s.server_close()
+
+
+def test_crawler_fans_out_only_to_classes_it_has_not_seen(monkeypatch):
+    monkeypatch.setattr(Crawler, 'limiter', HostRateLimiter(rate=1000))
+    monkeypatch.setattr(Crawler, 'fetcher', Fetcher())
+    params = {'action': 'Record.php', 'Y': '2023', 'M': '2', 'G': '200',
+              'GL': '0', 'S': '1', 'Lap': '1', 'P': '1', 'Cls': '999'}
+    got = []
+    for headings in (True, False):
+        s = MockServer(site=SyntheticSite(swimmers_per_class=3,
+                                          class_headings=headings))
+        s.start()
+        try:
+            got.append(Crawler.fetch_records(s.base_url, params))
+            requests = s.stats()['requests']
+            # Asked for one class, the page is reused for that class.
+            Crawler.fetch_records(s.base_url, dict(params, Cls='40'))
+            assert s.stats()['requests'] - requests == 1 + 12
+        finally:
+            s.shutdown()
+            s.server_close()
+        assert requests == (1 if headings else 1 + 13)
+    assert got[0] == got[1] and len(got[0]) > 13
+    monkeypatch.setattr(Crawler, 'streaming', True)
+    s = MockServer(site=SyntheticSite(swimmers_per_class=3,
+                                      class_headings=False))
+    s.start()
+    try:
+        assert Crawler.fetch_records(s.base_url, params) == got[0]
+    finally:
+        s.shutdown()
+        s.server_close()
+    assert (got[0][-1].age_cls, got[0][-1].q_params['Cls']) == ('80〜84歳', '80')
@@ -0,0 +1,145 @@
+import os
+
+import pytest
+
+import pipeline
+from fetcher import Fetcher
+from http_cache import ResponseCache
+from mock_server import MockServer, SyntheticSite
+from page_archive import PageArchive, import_cache, main, reparse
+from results_store import ResultsStore
+from swimmer_index import SwimmerIndex
+
+URL = 'https://www.tdsystem.co.jp/Record.php?Y=2023&M=2&G=0&G=48&P=3'
+
+
+def test_pages_are_kept_by_version_across_segments(tmp_path):
+    a = PageArchive(str(tmp_path), segment_bytes=200)
+    assert a.put(URL, b'<html>1</html>' * 20, fetched_at=1.0)
+    assert not a.put(URL, b'<html>1</html>' * 20)  # Nothing new
+    assert a.put(URL.replace('G=0&', ''), b'<html>2</html>', fetched_at=2.0)
+    assert a.put('https://www.tdsystem.co.jp/', b'top', 200)
+    page = a.get('https://www.tdsystem.co.jp/Record.php?P=3&G=48&M=2&Y=2023')
+    assert page.body == b'<html>2</html>' and page.fetched_at == 2.0
+    assert page.params == {'Y': '2023', 'M': '2', 'G': '48', 'P': '3'}
+    assert [v.body[:8] for v in a.versions(URL)] == [b'<html>1<', b'<html>2<']
+    assert a.get(URL + '&Cls=40') is None
+    assert [p.body for p in a][-1] == b'top'
+    assert len(a) == 3 and a.stats()['segments'] == 2
+    a.close()
+
+
+def test_the_index_is_recovered_from_the_segments(tmp_path):
+    a = PageArchive(str(tmp_path))
+    for i in range(3):
+        a.put('{}&Cls={}'.format(URL, i), b'page %d' % i)
+    a.close()
+    segment = tmp_path / 'segment-000001.dat'
+    with open(segment, 'ab') as f:
+        f.write(b'TDPA\x10\x00')  # Torn by a crash mid-write
+    os.remove(tmp_path / 'index.sqlite3')
+
+    a = PageArchive(str(tmp_path))
+    assert len(a) == 3
+    assert a.get(URL + '&Cls=1').body == b'page 1'
+    assert a.put(URL + '&Cls=3', b'page 3')
+    a.close()
+    a = PageArchive(str(tmp_path))
+    assert [p.body for p in a] == [b'page 0', b'page 1', b'page 2', b'page 3']
+    a.close()
+
+
+def test_cache_imports_into_the_archive(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'))
+    for i in range(250):
+        cache.put('{}&Cls={}'.format(URL, i), b'page %d' % i, fetched_at=i)
+    cache.close()
+    a = PageArchive(str(tmp_path / 'archive'))
+    assert import_cache(a, str(tmp_path / 'cache.sqlite3')) == 250
+    assert a.get(URL + '&Cls=249') == (URL + '&Cls=249', dict(
+        Y='2023', M='2', G='48', P='3', Cls='249'), 249, 200, b'page 249')
+    a.close()
+
+
+@pytest.fixture
+def crawled(tmp_path):
+    # A live crawl of the mock site into a store, archiving every page
+    s = MockServer(site=SyntheticSite(years=(2023, ), meets_per_month=1,
+                                      races_per_meet=2, swimmers_per_class=2))
+    s.start()
+    archive = PageArchive(str(tmp_path / 'archive'))
+    store = ResultsStore(str(tmp_path / 'crawled.sqlite3'))
+    try:
+        stats = pipeline.crawl_all(s.base_url, store.add, parse_workers=1,
+                                   rate=1000, burst=10,
+                                   fetcher=Fetcher(archive=archive))
+        assert stats['failed'] == 0
+    finally:
+        s.shutdown()
+        s.server_close()
+        store.close()
+        archive.close()
+    return s.base_url
+
+
+def rows(path):
+    store = ResultsStore(path)
+    try:
+        return store.counts(), sorted(
+            (r.meet_name, r.sex.name, r.distance, r.style.name,
+             r.record.age_cls, r.record.rank, r.record.name,
+             r.record.record_cs, tuple(r.record.lap_cs or ()))
+            for r in store.query())
+    finally:
+        store.close()
+
+
+def test_reparse_rebuilds_the_store_offline(crawled, tmp_path):
+    # The server is gone: every page comes from the archive.
+    path = str(tmp_path / 'rebuilt.sqlite3')
+    store = ResultsStore(path)
+    store.conn.execute("INSERT INTO meets (year, month, g) "
+                       "VALUES (1999, 1, 'stale')")
+    store.conn.commit()
+    store.close()
+    archive = PageArchive(str(tmp_path / 'archive'))
+    stats = reparse(archive, path, crawled, parse_workers=2)
+    archive.close()
+    assert stats['failed'] == 0 and stats['records'] > 0
+    assert rows(path) == rows(str(tmp_path / 'crawled.sqlite3'))
+    assert not os.path.exists(path + '.rebuild')
+    store = ResultsStore(path)
+    name = store.conn.execute('SELECT name FROM records').fetchone()[0]
+    assert SwimmerIndex(store).lookup(name)
+    store.close()
+
+    assert main([str(tmp_path / 'archive'), 'reparse', path, '--base-url',
+                 crawled, '--workers', '1']) == 0
+    assert rows(path) == rows(str(tmp_path / 'crawled.sqlite3'))
+
+
+
+def test_reparse_keeps_the_store_when_pages_are_missing(crawled, tmp_path):
+    full = PageArchive(str(tmp_path / 'archive'))
+    partial = PageArchive(str(tmp_path / 'partial'))
+    skipped = None
+    for page in full:
+        if skipped is None and '&P=' in page.url:
+            skipped = page.url
+            continue
+        partial.put(page.url, page.body, page.status, page.fetched_at)
+    path = str(tmp_path / 'results.sqlite3')
+    assert reparse(full, path, crawled, parse_workers=1)['replaced']
+    full.close()
+    partial.close()
+    before = rows(path)
+
+    # The race behind the missing page would be lost: the store is kept and
+    # the rebuilt one left aside, unless forced.
+    args = [str(tmp_path / 'partial'), 'reparse', path, '--base-url',
+            crawled, '--workers', '1']
+    assert main(args) == 1
+    assert rows(path) == before and os.path.exists(path + '.rebuild')
+    assert main(args + ['--force']) == 1
+    assert not os.path.exists(path + '.rebuild')
+    assert rows(path)[0]['records'] < before[0]['records']
@@ -0,0 +1,84 @@
+import os
+
+import metrics
+from parse_cache import PARSER_MODULES, ParseCache, parser_version
+from pipeline import Task, parse_page
+from record_page_parser import RecordPageParser
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'testdata')
+
+
+def read(name):
+    with open(os.path.join(TESTDATA, name), 'rb') as f:
+        return f.read()
+
+
+def test_parse_runs_once_per_body_and_args():
+    body = read('record_nolap.html')
+    cache = ParseCache()
+    calls = []
+
+    def parse():
+        calls.append(1)
+        return RecordPageParser.from_source(body, {'Cls': '35'},
+                                            '35〜39歳').get_records()
+
+    first = cache.parse(body, parse, 'class', '35')
+    again = cache.parse(body, parse, 'class', '35')
+    assert again == first and again is not first
+    assert len(calls) == 1
+    cache.parse(body, parse, 'class', '40')
+    cache.parse(body + b' ', parse, 'class', '35')
+    assert len(calls) == 3
+    assert metrics.PARSE_CACHE_LOOKUPS.value(result='hit') >= 1
+
+
+def test_lru_is_bounded():
+    cache = ParseCache(max_entries=2)
+    keys = [cache.key(b'page', i) for i in range(3)]
+    cache.put(keys[0], 0)
+    cache.put(keys[1], 1)
+    assert cache.get(keys[0]) == 0
+    cache.put(keys[2], 2)
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == 0 and len(cache) == 2
+
+    cache = ParseCache(max_bytes=100)
+    cache.put(keys[0], b'x' * 60)
+    cache.put(keys[1], b'y' * 60)
+    assert cache.get(keys[0]) is None and len(cache) == 1
+
+
+def test_persists_until_parser_changes(tmp_path):
+    path = str(tmp_path / 'parses.sqlite3')
+    body = read('record_lap.html')
+    task = Task('race', 'http://x/Record.php?P=2', (None, None))
+    cache = ParseCache(path=path, max_entries=10)
+    key = cache.key(body, task)
+    cache.put(key, parse_page(task, body, 'http://x/', 'lxml'))
+    cache.close()
+
+    cache = ParseCache(path=path)
+    assert len(cache.get(key).children) == 2
+    cache.close()
+    assert ParseCache(path=path, version='other').get(key) is None
+    assert len(ParseCache(path=path)) == 0
+    assert len(parser_version()) == 16
+
+
+def test_the_table_is_bounded_by_bytes_too(tmp_path):
+    path = str(tmp_path / 'parses.sqlite3')
+    cache = ParseCache(path=path, max_bytes=1000)
+    keys = [cache.key(b'page', i) for i in range(3)]
+    for k in keys:
+        cache.put(k, b'x' * 400)
+    cache.close()
+    cache = ParseCache(path=path, max_bytes=1000)
+    assert len(cache) == 2 and cache.get(keys[0]) is None
+    cache.close()
+    # Reopened with a smaller bound, the table is trimmed to it.
+    cache = ParseCache(path=path, max_bytes=500)
+    assert len(cache) == 1 and cache.get(keys[2]) == b'x' * 400
+    cache.close()
+    assert parser_version() != parser_version(PARSER_MODULES[:-1])
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from meet_page_parser import MeetPageParser
+from month_page_parser import MonthPageParser
+from record_page_parser import RecordPageParser
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'testdata')
+
+
+def read(name):
+    with open(os.path.join(TESTDATA, name), 'rb') as f:
+        return f.read()
+
+
+def chunks(body, size=97):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+def test_month_page_backends_agree():
+    body = read('month.html')
+    bs4 = MonthPageParser.from_source(body, year=2023, month=2)
+    lx = MonthPageParser.from_source(
+        body, year=2023, month=2, backend='lxml')
+    assert lx.get_available_years() == bs4.get_available_years()
+    assert lx.get_meets() == bs4.get_meets()
+    assert len(lx.get_meets()) == 3
+
+
+def test_meet_page_backends_agree():
+    body = read('meet.html')
+    bs4 = MeetPageParser.from_source(body).get_races()
+    lx = MeetPageParser.from_source(body, backend='lxml').get_races()
+    assert lx == bs4
+    assert len(lx) == 5
+    assert list(MeetPageParser.from_source(body).iter_races()) == bs4
+    assert list(MeetPageParser.iter_stream(chunks(body))) == bs4
+
+
+@pytest.mark.parametrize(
+    'name', ['record_lap.html', 'record_nolap.html', 'record_relay.html'])
+def test_record_page_backends_agree(name):
+    body = read(name)
+    bs4 = RecordPageParser.from_source(body)
+    lx = RecordPageParser.from_source(body, backend='lxml')
+    params = bs4.get_query_params()
+    assert lx.get_query_params() == params
+    classes = bs4.get_available_classes()
+    assert lx.get_available_classes() == classes
+
+    cls = list(classes.keys())[-1]
+    bs4 = RecordPageParser.from_source(body, params, classes[cls])
+    lx = RecordPageParser.from_source(
+        body, params, classes[cls], backend='lxml')
+    assert lx.get_records() == bs4.get_records()
+    assert bs4.get_records()
+    assert list(lx.iter_records()) == bs4.get_records()
+    assert list(RecordPageParser.iter_stream(chunks(body), params,
+                                             classes[cls])) == bs4.get_records()
+
+
+def test_streamed_records_come_out_as_their_rows_close():
+    body = read('record_lap.html')
+    fed = []
+
+    def source():
+        for chunk in chunks(body, 256):
+            fed.append(len(chunk))
+            yield chunk
+
+    stream = RecordPageParser.iter_stream(source(), {'Cls': '40'})
+    first = next(stream)
+    assert first.lap_cs and sum(fed) < len(body)
+    assert [first] + list(stream) == RecordPageParser.from_source(
+        body, {'Cls': '40'}).get_records()
+
+
+RECORD_ROWS = '''<html><body><table>
+<tr><th>順位</th><th>氏名</th><th>所属</th><th>記録</th></tr>
+<tr><td align="center">１</td><td valign="top">
+<a href="Swimmer.php?N=1">山田　太郎</a></td>
+<td valign="top" nowrap>ＡＢＣ</td><td align="right">1:02.34</td></tr>
+<tr><td>2</td><td valign="top" class="x">無効</td>
+<td><td valign="top">鈴木 次郎</td></td><td>１:05.00</td></tr>
+<tr><td></td><td valign="top">佐藤 三郎</td><td>棄権</td></tr>
+</table></body></html>'''
+
+
+@pytest.mark.parametrize('backend', ['bs4', 'lxml'])
+def test_record_rows_are_read_from_cells(backend):
+    records = RecordPageParser.from_source(
+        RECORD_ROWS.encode('utf-8'), {'Cls': '1'}, '25〜29歳',
+        backend=backend).get_records()
+    assert [(r.rank, r.name.strip(), r.record_cs) for r in records] == [
+        (1, '山田　太郎', 6234), (2, '鈴木 次郎', 6500)]
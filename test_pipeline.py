@@ -0,0 +1,114 @@
+import os
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+from meet_page_parser import Race
+from month_page_parser import Meet
+from parse_cache import ParseCache
+from pipeline import Pipeline, Task, crawl_records, parse_page
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'testdata')
+
+PAGES = {
+    ('/ProList.php', None): 'meet.html',
+    ('/Record.php', '2'): 'record_lap.html',
+    ('/Record.php', '3'): 'record_nolap.html',
+    ('/Record.php', '9'): 'record_relay.html',
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        name = PAGES.get((url.path, params.get('P')))
+        if not name:
+            self.send_error(404)
+            return
+        with open(os.path.join(TESTDATA, name), 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_port)
+
+
+def test_parse_page_fans_out_race_into_classes():
+    with open(os.path.join(TESTDATA, 'record_lap.html'), 'rb') as f:
+        body = f.read()
+    race = Race(q_params={'action': 'Record.php', 'P': '2'})
+    r = parse_page(
+        Task('race', 'http://x/Record.php?P=2', (None, race)), body,
+        'http://x/', 'lxml')
+    # The page shows 40~44歳 already: only the other classes are fetched.
+    assert [c.context[3] for c in r.children] == ['25~29歳', '45~49歳']
+    assert 'Cls=45' in r.children[1].url
+    assert r.records and {x.age_cls for x in r.records} == {'40~44歳'}
+
+
+def test_pipeline_crawls_meet_with_process_pool():
+    server, base_url = serve()
+    try:
+        meet = Meet(q_params={'action': 'ProList.php', 'Y': '2023',
+                              'M': '2', 'G': '48'})
+        got = []
+        p = Pipeline(base_url, fetch_workers=2, parse_workers=2,
+                     queue_size=2, rate=1000, burst=10)
+        stats = p.run([Task('meet', base_url + 'ProList.php?G=48', meet)],
+                      lambda meet, race, rs: got.append((race.distance, rs)))
+        # P=5 and the header row of the race list have no page.
+        assert stats['failed'] == 2
+        assert sorted(len(rs) for _, rs in got) == [2, 2, 3, 3, 3, 4]
+        assert all(rs[0].q_params['P'] for _, rs in got)
+        # Parse metrics recorded in the worker processes are merged back.
+        assert metrics.PARSE_ROWS.count(parser='record', backend='lxml') >= 6
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_crawl_records():
+    server, base_url = serve()
+    try:
+        rs = crawl_records(base_url, {'action': 'Record.php', 'P': '3'},
+                           parse_workers=1, rate=1000)
+        assert [r.rank for r in rs] == [1, 2, 2, 4]
+        assert rs[0].age_cls == '35〜39歳'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_pipeline_reuses_parse_results():
+    server, base_url = serve()
+    try:
+        cache = ParseCache()
+        hits = metrics.PARSE_CACHE_LOOKUPS.value(result='hit')
+        runs = []
+        for _ in range(2):
+            got = []
+            p = Pipeline(base_url, fetch_workers=1, parse_workers=1,
+                         rate=1000, burst=10, parse_cache=cache)
+            p.run([Task('race', base_url + 'Record.php?P=3',
+                        (None, Race(q_params={'action': 'Record.php',
+                                              'P': '3'})))],
+                  lambda meet, race, rs: got.extend(rs))
+            runs.append(got)
+        assert runs[1] == runs[0] and runs[0]
+        # The race page, which shows its only class
+        assert metrics.PARSE_CACHE_LOOKUPS.value(result='hit') - hits == 1
+    finally:
+        server.shutdown()
+        server.server_close()
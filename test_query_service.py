@@ -0,0 +1,192 @@
+import asyncio
+import datetime
+import json
+from array import array
+
+from meet_page_parser import Race, Sex, Style
+from month_page_parser import Course, Meet
+from query_service import LruCache, QueryService
+from record_page_parser import Record
+from results_store import ResultsStore
+from swimmer_index import SwimmerIndex
+
+
+def meet(g, day):
+    return Meet(dates=[datetime.date(2023, 2, day)], name='大会{}'.format(g),
+                course=Course.SHORT, venue='会場',
+                q_params={'Y': '2023', 'M': '2', 'G': g})
+
+
+def add_race(store, g, day, times, p='1'):
+    q = {'Y': '2023', 'M': '2', 'G': g, 'P': p, 'Cls': '40'}
+    records = []
+    for rank, (name, cs) in enumerate(times, 1):
+        r = Record(age_cls='40〜44歳', rank=rank, name=name, q_params=q)
+        r.record_cs = cs
+        r.lap_cs = array('i', [cs * k // 4 for k in range(1, 5)])
+        records.append(r)
+    store.add(meet(g, day), Race(Sex.F, 200, Style.IM, q), records)
+
+
+def make_store(path):
+    store = ResultsStore(path)
+    add_race(store, '1', 5, [('山田 花子', 15000), ('佐藤 恵', 15500),
+                             ('鈴木 愛', 16000)])
+    add_race(store, '2', 19, [('山田　花子', 14900)])
+    return store
+
+
+def get(service, target):
+    status, body = asyncio.run(service.reply(target))
+    return status, json.loads(body)
+
+
+def test_lru_cache_drops_the_least_recently_used():
+    c = LruCache(max_entries=2, max_bytes=10)
+    c.put('a', b'12')
+    c.put('b', b'34')
+    assert c.get('a') == b'12'
+    c.put('c', b'56')
+    assert c.get('b') is None and len(c) == 2
+    c.put('d', b'7890123')
+    assert list(c.entries) == ['c', 'd'] and c.size == 9
+
+
+def test_events_swimmers_and_splits(tmp_path):
+    store = make_store(str(tmp_path / 'results.sqlite3'))
+    service = QueryService(store.path, workers=2, page_size=2)
+
+    async def run(*targets):
+        await service.check_generation()
+        return [await service.reply(t) for t in targets]
+
+    (s1, events), (s2, page2), (s3, splits), (s4, bad), (s5, missing) = [
+        (status, json.loads(body)) for status, body in asyncio.run(run(
+            '/events?sex=f&distance=200&style=IM',
+            '/events?sex=F&distance=200&style=IM&offset=2',
+            '/splits?distance=200&style=IM&legs=2',
+            '/events?distance=200&style=BUTTERFLY',
+            '/nowhere'))
+    ]
+    assert s1 == s2 == s3 == 200 and (s4, s5) == (400, 404)
+    assert [r['time_cs'] for r in events['results']] == [14900, 15000]
+    assert events['next'] == 2 and page2['next'] is None
+    assert [r['name'] for r in page2['results']] == ['佐藤 恵', '鈴木 愛']
+    assert events['results'][0]['laps_cs'] == [3725, 7450, 11175, 14900]
+    group, = splits['groups']
+    assert group['key'] == {'age_cls': '40〜44歳'} and group['count'] == 4
+    assert group['legs_cs'][0][2] == 7625  # Median first half
+    assert group['fade_ratio'][2] == 1.0
+
+    # Without the swimmer index only the name as written is found.
+    status, history = get(service, '/swimmers/%E5%B1%B1%E7%94%B0%20%E8%8A'
+                          '%B1%E5%AD%90')
+    assert status == 200 and len(history['results']) == 1
+    assert SwimmerIndex(store, create=False).lag() is None  # Nor made one
+    SwimmerIndex(store).update()
+    service.cache.clear()
+    status, history = get(service, '/swimmers/山田花子')
+    assert history['name'] == '山田花子'
+    assert [r['date'] for r in history['results']] == [
+        '2023-02-05', '2023-02-19'
+    ]
+    store.close()
+    asyncio.run(service.close())
+
+
+def test_records_ingested_after_the_index_was_built(tmp_path):
+    store = make_store(str(tmp_path / 'results.sqlite3'))
+    SwimmerIndex(store).update()
+    add_race(store, '3', 26, [('山田 花子', 14800)])
+    service = QueryService(store.path, workers=1)
+    # Behind the store, the index is not used at all.
+    assert len(service.swimmer('山田 花子', {})['results']) == len(
+        store.query(name='山田 花子')) == 2
+
+    async def run():
+        await service.check_generation()
+        first = await service.reply('/swimmers/山田花子')
+        add_race(store, '4', 27, [('山田花子', 14700)])
+        assert await service.check_generation()
+        return first, await service.reply('/swimmers/山田花子')
+
+    first, after = asyncio.run(run())
+    assert [r['time_cs'] for r in json.loads(first[1])['results']] == [
+        15000, 14900, 14800
+    ]
+    assert len(json.loads(after[1])['results']) == 4
+    assert SwimmerIndex(store, create=False).lag() == 0
+    store.close()
+    asyncio.run(service.close())
+
+
+def test_replies_are_cached_until_a_batch_is_ingested(tmp_path):
+    store = make_store(str(tmp_path / 'results.sqlite3'))
+    service = QueryService(store.path, workers=2)
+    calls = []
+    events = service.events
+    service.events = lambda params: calls.append(params) or events(params)
+    target = '/events?distance=200&style=IM&limit=1'
+
+    async def run():
+        await service.check_generation()
+        first = await service.reply(target)
+        again = await service.reply(target)
+        assert not await service.check_generation()
+        # Another connection, as a crawler would, ingests a faster time.
+        writer = ResultsStore(store.path)
+        add_race(writer, '3', 26, [('高橋 舞', 14000)])
+        writer.close()
+        assert await service.check_generation()
+        return first, again, await service.reply(target)
+
+    first, again, after = asyncio.run(run())
+    assert first == again and len(calls) == 2
+    assert json.loads(after[1])['results'][0]['time_cs'] == 14000
+    store.close()
+    asyncio.run(service.close())
+
+
+def test_concurrent_requests_over_keep_alive(tmp_path):
+    store = make_store(str(tmp_path / 'results.sqlite3'))
+    store.close()
+    service = QueryService(str(tmp_path / 'results.sqlite3'), workers=4)
+    calls = []
+    splits = service.splits
+    service.splits = lambda params: calls.append(params) or splits(params)
+
+    async def client(port, n):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        statuses = []
+        for i in range(n):
+            target = '/splits?distance=200&style=IM' if i % 2 else '/health'
+            writer.write('GET {} HTTP/1.1\r\nHost: x\r\n\r\n'.format(
+                target).encode())
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line == b'\r\n':
+                    break
+                k, _, v = line.decode().partition(':')
+                if k.lower() == 'content-length':
+                    length = int(v)
+            json.loads(await reader.readexactly(length))
+            statuses.append(status)
+        writer.close()
+        return statuses
+
+    async def run():
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.gather(
+                *[client(port, 4) for _ in range(100)])
+        finally:
+            await service.close()
+
+    statuses = asyncio.run(run())
+    assert all(s == 200 for ss in statuses for s in ss)
+    # Computed once, however many asked for it at the same time
+    assert len(calls) == 1
@@ -0,0 +1,51 @@
+import datetime
+
+from meet_page_parser import Sex, Style
+from month_page_parser import Course
+from rankings import Ranking, RankingKey, Rankings, season
+from results_store import ResultsStore
+from test_results_store import meet, race, record
+
+KEY = RankingKey(Sex.F, 200, Style.IM, Course.SHORT, '40~44歳', 2022)
+
+
+def test_rank_percentile_and_top():
+    r = Ranking()
+    r.add([300, 100, 200, 200], ['c', 'a', 'b', 'b2'])
+    assert len(r) == 4
+    assert r.percentile(200) == 75.0
+    assert [e.time_cs for e in r.top(3)] == [100, 200, 200]
+    assert [r.rank(t) for t in (50, 100, 150, 200, 250, 400)] == [
+        1, 1, 2, 2, 4, 5]
+    assert r.percentile(400) == 0.0
+    assert Ranking().percentile(100) is None
+    assert season(datetime.date(2023, 3, 31)) == 2022
+    assert season(datetime.date(2023, 4, 1)) == 2023
+
+
+def test_batches_merge_and_recrawls_replace(tmp_path):
+    rk = Rankings()
+    assert rk.add(meet(), race(), [record(1, 'A', 165.3),
+                                   record(2, 'B', 170.5)]) == 2
+    assert rk.add(meet(g='50', day=20), race(g='50'),
+                  [record(1, 'C', 160, g='50'),
+                   record(2, 'D', 200, g='50', cls='45')]) == 2
+    assert [e.name for e in rk.top(KEY)] == ['C', 'A', 'B']
+    assert rk.rank(KEY, 16800) == 3
+
+    # The same page again changes nothing; a corrected time moves.
+    assert rk.add(meet(), race(), [record(1, 'A', 165.3)]) == 0
+    assert rk.add(meet(), race(), [record(1, 'A', 175)]) == 1
+    assert [e.name for e in rk.top(KEY)] == ['C', 'B', 'A']
+    assert rk.percentile(KEY, 16000) == 100.0
+
+    s = ResultsStore(str(tmp_path / 'results.sqlite3'))
+    s.add(meet(), race(), [record(1, 'A', 175), record(2, 'B', 170.5)])
+    s.add(meet(g='50', day=20), race(g='50'), [
+        record(1, 'C', 160, g='50'),
+        record(2, 'D', 200, g='50', cls='45')
+    ])
+    stored = Rankings.from_store(s)
+    assert set(stored.keys()) == set(rk.keys())
+    for key in rk.keys():
+        assert stored.top(key) == rk.top(key)
@@ -0,0 +1,54 @@
+import asyncio
+
+from rate_limiter import HostRateLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_burst_is_free():
+    clock = FakeClock()
+    b = TokenBucket(rate=1, burst=3, clock=clock)
+    assert [b.reserve() for _ in range(3)] == [0, 0, 0]
+
+
+def test_waits_queue_up_after_burst():
+    clock = FakeClock()
+    b = TokenBucket(rate=2, burst=1, clock=clock)
+    assert b.reserve() == 0
+    assert b.reserve() == 0.5
+    assert b.reserve() == 1.0
+
+
+def test_refill_is_capped_at_burst():
+    clock = FakeClock()
+    b = TokenBucket(rate=1, burst=2, clock=clock)
+    b.reserve()
+    b.reserve()
+    clock.now = 100
+    assert [b.reserve() for _ in range(3)] == [0, 0, 1.0]
+
+
+def test_buckets_are_per_host():
+    clock = FakeClock()
+    limiter = HostRateLimiter(rate=1, burst=1, clock=clock)
+    assert limiter.bucket('https://a.example/x?Y=1') is limiter.bucket(
+        'https://A.example/y')
+    assert limiter.bucket('https://a.example/') is not limiter.bucket(
+        'https://b.example/')
+
+
+def test_acquire_async_sleeps_for_reservation():
+    b = TokenBucket(rate=100, burst=1)
+
+    async def run():
+        return [await b.acquire_async() for _ in range(3)]
+
+    waits = asyncio.run(run())
+    assert waits[0] == 0
+    assert all(w > 0 for w in waits[1:])
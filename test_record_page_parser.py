@@ -0,0 +1,53 @@
+import pickle
+from datetime import timedelta
+
+from parser_base import QueryParams
+from record_page_parser import Record
+
+
+def test_times_are_centiseconds_with_timedelta_views():
+    r = Record()
+    r.set_record(mins=2, secs=45, one_tenth_secs=30)
+    r.add_lap(secs=36, one_tenth_secs=12)
+    r.add_lap(mins=1, secs=19, one_tenth_secs=80)
+    assert r.record_cs == 16530
+    assert r.record == timedelta(minutes=2, seconds=45, milliseconds=300)
+    assert list(r.lap_cs) == [3612, 7980]
+    assert r.lap == [timedelta(seconds=36.12), timedelta(seconds=79.8)]
+
+
+def test_query_params_are_interned_and_immutable():
+    a = Record(q_params={'Y': '2023', 'P': '2'}, age_cls='40~44歳')
+    b = Record(q_params={'Y': '2023', 'P': '2'}, age_cls='40~44歳')
+    assert a.q_params is b.q_params
+    assert isinstance(a.q_params, QueryParams)
+    assert a.q_params == {'Y': '2023', 'P': '2'}
+    assert a.q_params.copy() == {'Y': '2023', 'P': '2'}
+    try:
+        a.q_params['Y'] = '2024'
+        assert False
+    except TypeError:
+        pass
+
+
+def test_pickle_roundtrip_reinterns():
+    r = Record(rank=1, name='A', record=timedelta(seconds=26.48),
+               lap=[timedelta(seconds=26.48)], q_params={'P': '3'})
+    r2 = pickle.loads(pickle.dumps(r))
+    assert r2 == r
+    assert r2.q_params is r.q_params
+
+
+def test_unpickles_records_saved_before_slots():
+    r = Record.__new__(Record)
+    r.__setstate__({
+        'age_cls': '13・14歳',
+        'rank': 1,
+        'record': timedelta(seconds=134, microseconds=740000),
+        'lap': [timedelta(seconds=30, microseconds=10000)],
+        'name': 'A',
+        'q_params': {'P': '2'}
+    })
+    assert r.record_cs == 13474
+    assert list(r.lap_cs) == [3001]
+    assert r.q_params == {'P': '2'}
@@ -0,0 +1,54 @@
+import os
+import pickle
+from datetime import timedelta
+
+import numpy as np
+
+from record_page_parser import Record
+from record_store import MISSING, RecordStore, from_pickle
+
+
+def record(rank, name, secs, laps=(), cls='40~44歳', p='2'):
+    r = Record(age_cls=cls, rank=rank, name=name,
+               q_params={'Y': '2023', 'M': '02', 'G': '48', 'P': p})
+    r.record = timedelta(seconds=secs) if secs is not None else None
+    r.lap = [timedelta(seconds=l) for l in laps] or None
+    return r
+
+
+def test_append_and_memory_map(tmp_path):
+    path = str(tmp_path / 'store')
+    s = RecordStore(path, max_laps=4)
+    s.append([record(1, 'A', 165.3, (36.12, 79.8)), record(2, 'B', None)])
+    s.append([record(1, 'A', 26.48, cls='35~39歳', p='3')])
+
+    s = RecordStore(path)
+    c = s.columns()
+    assert isinstance(c.time_cs, np.memmap)
+    assert c.time_cs.tolist() == [16530, MISSING, 2648]
+    assert c.lap_count.tolist() == [2, 0, 0]
+    assert c.laps[0].tolist() == [3612, 7980, MISSING, MISSING]
+    assert s.decode('name', c.name) == ['A', 'B', 'A']
+    assert c.race[0] == c.race[1] != c.race[2]
+    assert s.lookup('age_cls', '35~39歳') == c.age_cls[2]
+
+
+def test_interrupted_append_is_discarded(tmp_path):
+    path = str(tmp_path / 'store')
+    s = RecordStore(path)
+    s.append([record(1, 'A', 30)])
+    with open(os.path.join(path, 'time_cs.bin'), 'ab') as f:
+        f.write(b'\xff' * 12)
+    s = RecordStore(path)
+    s.append([record(2, 'B', 31)])
+    assert s.columns().time_cs.tolist() == [3000, 3100]
+
+
+def test_from_pickle(tmp_path):
+    rs = [record(1, 'A', 134.74, (30.01, 63.29, 98.84, 134.74))]
+    pkl = str(tmp_path / 'records.pickle')
+    with open(pkl, 'wb') as f:
+        pickle.dump(rs, f, pickle.HIGHEST_PROTOCOL)
+    s = from_pickle(pkl, str(tmp_path / 'store'))
+    assert len(s) == 1
+    assert s.columns().laps[0, :4].tolist() == [3001, 6329, 9884, 13474]
@@ -0,0 +1,77 @@
+import datetime
+from datetime import timedelta
+
+from meet_page_parser import Race, Sex, Style
+from month_page_parser import Course, Meet
+from record_page_parser import Record
+from results_store import ResultsStore, StoreSink
+
+
+def meet(g='48', day=5):
+    return Meet(dates=[datetime.date(2023, 2, day)], name='春季大会',
+                course=Course.SHORT, venue='辰巳',
+                q_params={'Y': '2023', 'M': '02', 'G': g})
+
+
+def race(p='2', sex=Sex.F, g='48'):
+    return Race(sex=sex, distance=200, style=Style.IM,
+                q_params={'Y': '2023', 'M': '02', 'G': g, 'P': p})
+
+
+def record(rank, name, secs, laps=(), cls='40', g='48', p='2'):
+    r = Record(age_cls='{}~{}歳'.format(cls, int(cls) + 4), rank=rank,
+               name=name, q_params={'Y': '2023', 'M': '02', 'G': g, 'P': p,
+                                    'Cls': cls})
+    r.record = timedelta(seconds=secs)
+    r.lap = [timedelta(seconds=l) for l in laps] or None
+    return r
+
+
+def test_add_is_idempotent_and_queryable(tmp_path):
+    s = ResultsStore(str(tmp_path / 'results.sqlite3'))
+    rs = [record(2, 'B', 170.5), record(1, 'A', 165.3, (36.12, 79.8))]
+    assert s.add(meet(), race(), rs) == 2
+    s.add(meet(), race(), rs)
+    s.add(meet(), race(p='3', sex=Sex.M), [record(1, 'C', 150, p='3')])
+    assert s.counts() == {'meets': 1, 'races': 2, 'records': 3, 'laps': 2}
+
+    found = s.query(sex=Sex.F, distance=200, style=Style.IM, year=2023,
+                    cls='40')
+    assert [f.record for f in found] == [rs[1], rs[0]]
+    assert found[0].meet_name == '春季大会'
+    assert found[0].date == datetime.date(2023, 2, 5)
+    assert found[0].course == Course.SHORT
+    assert s.query(name='C')[0].sex == Sex.M
+    assert s.query(year=2022) == []
+    assert len(s.query(limit=1, offset=2)) == 1
+
+
+def test_records_before_their_meet_are_filled_in_later(tmp_path):
+    s = ResultsStore(str(tmp_path / 'results.sqlite3'))
+    with StoreSink(s, batch_size=1) as sink:
+        sink.write_all([record(1, 'A', 160), record(1, 'D', 140, cls='45')])
+    assert s.query(cls='45')[0].meet_name is None
+
+    s.add(meet(), race())
+    r = s.query(age_cls='45~49歳')[0]
+    assert (r.meet_name, r.sex, r.distance) == ('春季大会', Sex.F, 200)
+    assert s.counts()['races'] == 1
+
+
+def test_merge_shards_without_duplicates(tmp_path):
+    a = ResultsStore(str(tmp_path / 'a.sqlite3'))
+    b = ResultsStore(str(tmp_path / 'b.sqlite3'))
+    a.add(meet(), race(), [record(1, 'A', 165.3, (36.12, 79.8))])
+    b.add(None, race(), [record(1, 'A', 165.3, (36.12, 79.8)),
+                         record(2, 'B', 170.5)])
+    b.add(meet(g='49'), race(g='49'), [record(1, 'C', 150, g='49')])
+    a.close()
+    b.close()
+    s = ResultsStore(str(tmp_path / 'results.sqlite3'))
+    assert s.merge(str(tmp_path / 'a.sqlite3')) == 1
+    assert s.merge(str(tmp_path / 'b.sqlite3')) == 3
+    s.merge(str(tmp_path / 'b.sqlite3'))
+    assert s.counts() == {'meets': 2, 'races': 2, 'records': 3, 'laps': 2}
+    found = s.query(name='A')
+    assert found[0].meet_name == '春季大会'
+    assert list(found[0].record.lap_cs) == [3612, 7980]
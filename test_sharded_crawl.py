@@ -0,0 +1,30 @@
+from mock_server import MockServer, SyntheticSite
+from results_store import ResultsStore
+from sharded_crawl import crawl_sharded
+
+
+def test_workers_share_the_frontier_and_merge_into_one_store(tmp_path):
+    s = MockServer(site=SyntheticSite(years=(2023, ), meets_per_month=1,
+                                      races_per_meet=2, swimmers_per_class=2))
+    s.start()
+    try:
+        counts = crawl_sharded(s.base_url, str(tmp_path / 'f.sqlite3'),
+                               str(tmp_path / 'results.sqlite3'), workers=3,
+                               rate=1000, lease_sec=10)
+    finally:
+        s.shutdown()
+        s.server_close()
+    # The site, 12 months, 12 meets and 36 races (the header row of each
+    # meet page included), each crawled once
+    assert counts == {'done': 1 + 12 + 12 + 36}
+    assert not [p for p in tmp_path.iterdir() if '.shard' in p.name]
+    store = ResultsStore(str(tmp_path / 'results.sqlite3'))
+    c = store.counts()
+    assert c['meets'] == 12 and c['races'] == 24
+    assert c['records'] == store.conn.execute(
+        'SELECT COUNT(*) FROM (SELECT DISTINCT race_id, cls, rank, name '
+        'FROM records)').fetchone()[0] > 0
+    # The merge brings the swimmer index up to date.
+    assert store.conn.execute('SELECT last_record_id FROM '
+                              'swimmer_index_state').fetchone() == \
+        store.conn.execute('SELECT MAX(id) FROM records').fetchone()
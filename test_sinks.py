@@ -0,0 +1,51 @@
+import csv
+import pickle
+import sqlite3
+from datetime import timedelta
+
+from record_page_parser import Record
+from sinks import JsonlSink, PickleSink, load_records, open_sink
+
+
+def records(n):
+    rs = []
+    for i in range(n):
+        r = Record(age_cls='40~44歳', rank=i + 1, name='N{}'.format(i),
+                   q_params={'Y': '2023', 'P': '2', 'Cls': '40'})
+        r.record = timedelta(seconds=160 + i)
+        r.lap = [timedelta(seconds=36), timedelta(seconds=160 + i)]
+        rs.append(r)
+    return rs
+
+
+def test_batches_are_flushed_incrementally(tmp_path):
+    path = str(tmp_path / 'out.jsonl')
+    sink = JsonlSink(path, batch_size=2)
+    for r in records(3):
+        sink.write(r)
+    assert len(list(load_records(path))) == 2
+    sink.close()
+    assert list(load_records(path)) == records(3)
+
+
+def test_pickle_sink_reads_back_old_single_list_files(tmp_path):
+    path = str(tmp_path / 'records.pickle')
+    with open(path, 'wb') as f:
+        pickle.dump(records(2), f, pickle.HIGHEST_PROTOCOL)
+    with PickleSink(path, batch_size=1) as sink:
+        sink.write_all(records(3)[2:])
+    assert [r.rank for r in load_records(path)] == [1, 2, 3]
+
+
+def test_csv_and_sqlite_sinks(tmp_path):
+    with open_sink(str(tmp_path / 'out.csv')) as sink:
+        sink.write_all(records(2))
+    with open(str(tmp_path / 'out.csv'), encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    assert rows[1]['lap_cs'] == '3600 16100'
+    assert rows[1]['Cls'] == '40'
+
+    with open_sink(str(tmp_path / 'out.sqlite3'), batch_size=1) as sink:
+        sink.write_all(records(3))
+    conn = sqlite3.connect(str(tmp_path / 'out.sqlite3'))
+    assert conn.execute('SELECT COUNT(*) FROM records').fetchone()[0] == 3
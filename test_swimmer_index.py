@@ -0,0 +1,42 @@
+import datetime
+
+from results_store import ResultsStore
+from swimmer_index import SwimmerIndex, name_key
+from test_results_store import meet, race, record
+
+
+def test_name_variants_share_a_key():
+    assert name_key('山田　太郎') == name_key('山田 太郎') == name_key('山田太郎')
+    assert name_key('ＹＡＭＡＤＡ Taro') == 'yamadataro'
+
+
+def test_index_updates_incrementally(tmp_path):
+    s = ResultsStore(str(tmp_path / 'results.sqlite3'))
+    ix = SwimmerIndex(s)
+    s.add(meet(g='50', day=20), race(g='50'), [
+        record(1, '山田 太郎', 160, g='50'),
+        record(2, '山田 花子', 170, g='50')
+    ])
+    assert ix.update() == 2
+    s.add(meet(), race(), [record(3, '山田　太郎', 165),
+                           record(1, '鈴木 一郎', 150)])
+    assert ix.update() == 2
+    assert ix.update() == 0
+
+    postings = ix.lookup('山田太郎')
+    assert [p.date for p in postings] == [datetime.date(2023, 2, 5),
+                                          datetime.date(2023, 2, 20)]
+    assert [r.record.record_cs for r in ix.results('山田 太郎')] == [
+        16500, 16000]
+
+    assert [m.name for m in ix.prefix('山田')] == ['山田 太郎', '山田 花子']
+    assert ix.prefix('山田')[0].records == 2
+    assert [m.name for m in ix.search('山田太朗')][:1] == ['山田 太郎']
+    assert {m.name for m in ix.search('山田')} == {'山田 太郎', '山田 花子'}
+    assert ix.search('佐藤 次郎') == []
+
+    # The index lives in the store's database.
+    s.close()
+    s = ResultsStore(str(tmp_path / 'results.sqlite3'))
+    ix = SwimmerIndex(s)
+    assert ix.update() == 0 and len(ix.lookup('山田 太郎')) == 2